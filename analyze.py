@@ -1,16 +1,19 @@
-import spacy
-from spacy.lang.zh.examples import sentences
-from spacy import displacy
 from collections import Counter
+from dataclasses import dataclass, field, fields, asdict
+import math
 import statistics
-from textblob import TextBlob
+import time
 from tabulate import tabulate
 
+import prompt_registry
+# spaCy itself is never imported here: callers pass in a loaded pipeline
+# (see backend/nlp_registry.py), which keeps importing this module cheap.
+
 # helper function that outputs a dictionary of avg, s.d., range, & oscillation of the list.
 def variance_measures(input_list):
     sd = statistics.stdev(input_list) if len(input_list) > 1 else 0
     avg = sum(input_list) / len(input_list) if len(input_list) > 0 else 0
-    rnge = max(input_list) - min(input_list)
+    rnge = max(input_list) - min(input_list) if len(input_list) > 0 else 0
     if len(input_list) < 2:
         osc = 0
     else:
@@ -34,189 +37,443 @@ def output_variance(variance_dict, measure_name):
     print(measure_name)
     print(tabulate(data, tablefmt="grd") + '\n')
 
-def text_analyze_eng(input_text, nlp_en):
-    
-    tokens = [] # list of tokens (not excluding PUNCT)
-    lemmas = [] # list of lemmas of ADJ, ADV, INTJ, NOUN, SCONJ, VERB or PROPN
-    sent_lengths = [] # list of each sentence's length (not excluding PUNCT)
-    token_lengths = [] # list of each token's (exclude PUNCT) length
-    morphs = [] # a list of lists; each sublist is a sentence; each item is a token's morphs
 
-    doc = nlp_en(input_text)
-    print("Pipeline:", nlp_en.pipe_names)
+# sqrt(n/m) for ints, correctly rounded to a float with the same round-to-odd method
+# statistics.stdev uses, so stdevs computed from exact sums match variance_measures bit for bit.
+def _sqrt_of_frac(n, m):
+    q = (n.bit_length() - m.bit_length() - 109) // 2 # 109 = 2 * 53 (float mantissa) + 3
+    if q >= 0:
+        numerator = _isqrt_of_frac_rto(n, m << 2 * q) << q
+        denominator = 1
+    else:
+        numerator = _isqrt_of_frac_rto(n << -2 * q, m)
+        denominator = 1 << -q
+    return numerator / denominator
 
-    for sent in doc.sents:
-        # parse into sentences (sent)
-        sent_lengths.append(len(sent))
-        # print(f"\nSentence: {sent.text}")
-        morphs.append([])
-        for token in sent:
-            # Convert morph to string first
-            morph_str = str(token.morph)
-            morph_list = morph_str.split('|') if morph_str else []
-            if len(morph_list) != 0: morphs[-1].append(morph_list) 
-            tokens.append(token)
-            if token.pos_ != 'PUNCT':
-                token_lengths.append(len(token))
-            if token.pos_ in ('ADJ', 'ADV', 'INTJ', 'NOUN', 'SCONJ', 'VERB', 'PROPN'):
-                lemmas.append(token.lemma_)
-
-    # displacy.serve(doc, style="dep", compact=True)
-    # Extract all part-of-speech tags from tokens list
-    pos_list = [token.pos_ for token in tokens] # part of speech
-    dep_list = [token.dep_ for token in tokens] # dependency
-    verb_tense_list = [token.tag_ for token in tokens if token.tag_.startswith('V')] # verb tenses
-    pos_freq_tbl = Counter(pos_list) #frequency table of pos
-    dep_freq_tbl = Counter(dep_list) #frequency table of dependency
-    verb_tense_freq_tbl = Counter(verb_tense_list)
-    lemma_freq_tbl = Counter(lemmas) #frequency table of lemmas for commonly seen words
-
-    # print(morphs[:2])
-    # print(tokens)
-
-    sent_length_variance = variance_measures(sent_lengths)
-    token_length_variance = variance_measures(token_lengths)
-
-    print(f"Part of Speech: {pos_freq_tbl}\n")
-    print(f"Dependency: {dep_freq_tbl}\n")
-    print(f"Verb Tenses: {verb_tense_freq_tbl}\n")
-    
-    print(f"Repetition / Motifs: {lemma_freq_tbl}\n")
-    print(sent_lengths)
-    output_variance(sent_length_variance, 'Sentence Length (words)')
-    print(token_lengths)
-    output_variance(token_length_variance, "Token Length (char)(excluding PUNCT)")
-    
 
-    # Counting clauses per sentence
-    clause_deps = ['ccomp', 'xcomp', 'advcl', 'relcl', 'conj']
-    clauses_per_sent = []
-    for sent in doc.sents:
-        clause_count = sum(1 for token in sent if token.dep_ in clause_deps) + 1 # +1 for the main clause; total clauses per sentence
-        clauses_per_sent.append(clause_count)
-    
-    clause_freq_variance = variance_measures(clauses_per_sent)
-    print(clauses_per_sent)
-    output_variance(clause_freq_variance, "Clauses per sentence")
-
-    # assembling prompt
-    with open("prompts/prompt_template.txt", "r", encoding="utf-8") as file:
-        prompt_template = file.read()
-    final_prompt = prompt_template.format(
-        text_excerpt=input_text[:500],  # limit to first 500 characters or so
-        avg_sentence_length=round(sent_length_variance['average'], 2),
-        std_sentence_length=round(sent_length_variance['stdev'], 2),
-        range_sentence_length=sent_length_variance['range'],
-        osc_sentence_length=sent_length_variance['oscillation_ratio'],
-
-        avg_token_length=round(token_length_variance['average'], 2),
-        std_token_length=round(token_length_variance['stdev'], 2),
-        range_token_length=token_length_variance['range'],
-        osc_token_length=token_length_variance['oscillation_ratio'],
-
-        avg_clauses_per_sentence=round(clause_freq_variance['average'], 2),
-        std_clauses_per_sentence=round(clause_freq_variance['stdev'], 2),
-        range_clauses_per_sentence=clause_freq_variance['range'],
-        osc_clauses_per_sentence=clause_freq_variance['oscillation_ratio'],
-
-        pos_freq=dict(pos_freq_tbl),
-        dep_freq=dict(dep_freq_tbl),
-        verb_tense_freq=dict(verb_tense_freq_tbl),
-        lemma_freq=lemma_freq_tbl.most_common(5),
-        morphs_sample=morphs[:2]
-    )
-    return final_prompt
+def _isqrt_of_frac_rto(n, m):
+    a = math.isqrt(n // m)
+    return a | (a * a * m != n)
 
 
-def text_analyze_chn(input_text, nlp_cn):
-    # nlp = spacy.load("en_core_web_md")
-    tokens = [] # list of tokens (not excluding PUNCT)
-    lemmas = [] # list of lemmas of ADJ, ADV, INTJ, NOUN, SCONJ, VERB or PROPN
-    sent_lengths = [] # list of each sentence's length (not excluding PUNCT)
-    token_lengths = [] # list of each token's (exclude PUNCT) length
-    morphs = [] # a list of lists; each sublist is a sentence; each item is a token's morphs
+# Mergeable summary of an integer series (sentence lengths, token lengths, clauses).
+# Keeps exact sums for the mean/stdev plus min/max and the first/last values and
+# number of changes needed for the oscillation ratio, so summaries of consecutive
+# pieces of a series merge() into the summary of the whole series, and
+# as_variance() returns exactly what variance_measures(series) would.
+@dataclass
+class RunningStats:
+    count: int = 0
+    total: int = 0
+    sum_sq: int = 0
+    min: int | None = None
+    max: int | None = None
+    first: int | None = None
+    last: int | None = None
+    changes: int = 0 # adjacent values that differ
 
-    doc = nlp_cn(input_text)
-    print("Pipeline:", nlp_cn.pipe_names)
+    def add(self, value):
+        if self.count == 0:
+            self.first = self.min = self.max = value
+        else:
+            if value != self.last:
+                self.changes += 1
+            self.min = min(self.min, value)
+            self.max = max(self.max, value)
+        self.last = value
+        self.count += 1
+        self.total += value
+        self.sum_sq += value * value
 
-    for sent in doc.sents:
-        # parse into sentences (sent)
-        sent_lengths.append(len(sent))
-        print(f"\nSentence: {sent.text}")
-        morphs.append([])
+    @classmethod
+    def from_values(cls, values):
+        stats = cls()
+        for value in values:
+            stats.add(value)
+        return stats
+
+    # Appends the series summarized by other (which must come after this one)
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.first, self.min, self.max = other.first, other.min, other.max
+        else:
+            self.changes += other.last is not None and self.last != other.first
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+        self.last = other.last
+        self.count += other.count
+        self.total += other.total
+        self.sum_sq += other.sum_sq
+        self.changes += other.changes
+        return self
+
+    def as_variance(self):
+        n = self.count
+        if n < 2:
+            sd = 0
+            osc = 0
+        else:
+            # sample variance = (n * sum(x^2) - sum(x)^2) / (n * (n - 1))
+            sd = _sqrt_of_frac(n * self.sum_sq - self.total * self.total, n * (n - 1))
+            osc = self.changes / (n - 1)
+        return {
+            'average': self.total / n if n > 0 else 0,
+            'stdev': sd,
+            'range': self.max - self.min if n > 0 else 0,
+            'oscillation_ratio': osc
+        }
+
+    def to_dict(self):
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+
+# Bump whenever a metric's definition changes, so stored features are recomputed
+FEATURES_VERSION = 2
+
+CONTENT_POS = frozenset(('ADJ', 'ADV', 'INTJ', 'NOUN', 'SCONJ', 'VERB', 'PROPN')) # POS whose lemmas count as motifs
+CLAUSE_DEPS = frozenset(('ccomp', 'xcomp', 'advcl', 'relcl', 'conj'))
+
+# Feature profiles. "full" computes every metric; "lite" skips the ones that need a
+# dependency parse (dep_freq and clauses per sentence), so its pipelines run without
+# the parser: tagger only, with rule-based sentence splitting (see backend/nlp_registry.py).
+PROFILES = ('full', 'lite')
+DEFAULT_PROFILE = 'full'
+
+
+def uses_dependencies(profile):
+    return profile == 'full'
+
+
+# Every linguistic metric extracted from one text.
+# Plain data (Counters, int lists, nested lists of str), so it can be cached,
+# serialized with to_dict()/from_dict() and reused by the server and the CLI.
+# The variance dicts are computed once by the extractor that built the object.
+@dataclass
+class TextFeatures:
+    language: str | None
+    pos_freq: Counter = field(default_factory=Counter) # frequency table of pos
+    dep_freq: Counter = field(default_factory=Counter) # frequency table of dependency
+    verb_tense_freq: Counter = field(default_factory=Counter)
+    lemma_freq: Counter = field(default_factory=Counter) # frequency table of lemmas for commonly seen words
+    sent_lengths: list = field(default_factory=list) # each sentence's length (not excluding PUNCT)
+    token_lengths: list = field(default_factory=list) # each token's (exclude PUNCT) length
+    clauses_per_sent: list = field(default_factory=list)
+    morphs_sample: list = field(default_factory=list) # morphs of the first 2 sentences, one sublist per sentence
+    sent_length_variance: dict = field(default_factory=dict)
+    token_length_variance: dict = field(default_factory=dict)
+    clause_freq_variance: dict = field(default_factory=dict)
+    # RunningStats.to_dict() for 'sent_lengths', 'token_lengths' and 'clauses_per_sent';
+    # mergeable across texts. The three lists above stay empty for documents analyzed
+    # in chunks (long_text_features), these summaries are always filled in.
+    running_stats: dict = field(default_factory=dict)
+    profile: str = DEFAULT_PROFILE # the dependency metrics are left empty by the "lite" profile
+
+    def has_dependencies(self):
+        return uses_dependencies(self.profile)
+
+    # JSON-friendly summary (used by the batch API); metrics the profile skipped are None
+    def summary(self):
+        dependencies = self.has_dependencies()
+        return {
+            'profile': self.profile,
+            'sentence_length': self.sent_length_variance,
+            'token_length': self.token_length_variance,
+            'clauses_per_sentence': self.clause_freq_variance if dependencies else None,
+            'pos_freq': dict(self.pos_freq),
+            'dep_freq': dict(self.dep_freq) if dependencies else None,
+            'verb_tense_freq': dict(self.verb_tense_freq),
+            'lemma_freq': self.lemma_freq.most_common(5),
+            'morphs_sample': self.morphs_sample,
+        }
+
+    def to_dict(self):
+        # asdict() would rebuild the Counters from (key, value) pairs, so copy fields by hand
+        data = {f.name: getattr(self, f.name) for f in fields(self)}
+        for key in ('pos_freq', 'dep_freq', 'verb_tense_freq', 'lemma_freq'):
+            data[key] = dict(data[key])
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        for key in ('pos_freq', 'dep_freq', 'verb_tense_freq', 'lemma_freq'):
+            data[key] = Counter(data.get(key) or {})
+        return cls(**data)
+
+
+# Computes every metric in a single pass over the parsed Doc.
+# Only plain counters and int lists are kept (never the Token objects themselves).
+# Under a profile without dependencies, dep_freq and clauses_per_sent stay empty.
+def extract_features(doc, lang, debug=False, profile=DEFAULT_PROFILE):
+    dependencies = uses_dependencies(profile)
+    pos_freq = Counter()
+    dep_freq = Counter()
+    verb_tense_freq = Counter()
+    lemma_freq = Counter()
+    sent_lengths = []
+    token_lengths = []
+    clauses_per_sent = []
+    morphs_sample = []
+
+    for sent_index, sent in enumerate(doc.sents):
+        if debug and lang == 'zh-cn':
+            print(f"\nSentence: {sent.text}")
+        clause_count = 1 # +1 for the main clause; total clauses per sentence
+        keep_morphs = sent_index < 2
+        if keep_morphs:
+            morphs_sample.append([])
         for token in sent:
-            # Convert morph to string first
-            morph_str = str(token.morph)
-            morph_list = morph_str.split('|') if morph_str else []
-            if len(morph_list) != 0: morphs[-1].append(morph_list) 
-            tokens.append(token)
-            if token.pos_ != 'PUNCT':
+            pos = token.pos_
+            dep = token.dep_
+            tag = token.tag_
+            pos_freq[pos] += 1
+            if dependencies:
+                dep_freq[dep] += 1
+            if tag.startswith('V'):
+                verb_tense_freq[tag] += 1 # verb tenses
+            if pos != 'PUNCT':
                 token_lengths.append(len(token))
-            if token.pos_ in ('ADJ', 'ADV', 'INTJ', 'NOUN', 'SCONJ', 'VERB', 'PROPN'):
-                lemmas.append(token.lemma_)
-
-    # displacy.serve(doc, style="dep", compact=True)
-    # Extract all part-of-speech tags from tokens list
-    pos_list = [token.pos_ for token in tokens] # part of speech
-    dep_list = [token.dep_ for token in tokens] # dependency
-    verb_tense_list = [token.tag_ for token in tokens if token.tag_.startswith('V')] # verb tenses
-    pos_freq_tbl = Counter(pos_list) #frequency table of pos
-    dep_freq_tbl = Counter(dep_list) #frequency table of dependency
-    verb_tense_freq_tbl = Counter(verb_tense_list)
-    lemma_freq_tbl = Counter(lemmas) #frequency table of lemmas for commonly seen words
-
-    # print(morphs[:2])
-    # print(tokens)
-
-    sent_length_variance = variance_measures(sent_lengths)
-    token_length_variance = variance_measures(token_lengths)
-
-    print(f"Part of Speech: {pos_freq_tbl}\n")
-    print(f"Dependency: {dep_freq_tbl}\n")
-    print(f"Verb Tenses: {verb_tense_freq_tbl}\n")
-    
-    print(f"Repetition / Motifs: {lemma_freq_tbl}\n")
-    print(sent_lengths)
-    output_variance(sent_length_variance, 'Sentence Length (words)')
-    print(token_lengths)
-    output_variance(token_length_variance, "Token Length (char)(excluding PUNCT)")
-    
+            if pos in CONTENT_POS:
+                lemma_freq[token.lemma_] += 1
+            if dependencies and dep in CLAUSE_DEPS:
+                clause_count += 1
+            if keep_morphs:
+                morph_str = str(token.morph)
+                if morph_str:
+                    morphs_sample[-1].append(morph_str.split('|'))
+        sent_lengths.append(len(sent))
+        if dependencies:
+            clauses_per_sent.append(clause_count)
 
-    # Counting clauses per sentence
-    clause_deps = ['ccomp', 'xcomp', 'advcl', 'relcl', 'conj']
-    clauses_per_sent = []
-    for sent in doc.sents:
-        clause_count = sum(1 for token in sent if token.dep_ in clause_deps) + 1 # +1 for the main clause; total clauses per sentence
-        clauses_per_sent.append(clause_count)
-    
-    clause_freq_variance = variance_measures(clauses_per_sent)
-    print(clauses_per_sent)
-    output_variance(clause_freq_variance, "Clauses per sentence")
-
-    # assembling prompt
-    with open("prompts/prompt_template.txt", "r", encoding="utf-8") as file:
-        prompt_template = file.read()
-    final_prompt = prompt_template.format(
-        text_excerpt=input_text[:500],  # limit to first 500 characters or so
-        avg_sentence_length=round(sent_length_variance['average'], 2),
-        std_sentence_length=round(sent_length_variance['stdev'], 2),
-        range_sentence_length=sent_length_variance['range'],
-        osc_sentence_length=sent_length_variance['oscillation_ratio'],
-
-        avg_token_length=round(token_length_variance['average'], 2),
-        std_token_length=round(token_length_variance['stdev'], 2),
-        range_token_length=token_length_variance['range'],
-        osc_token_length=token_length_variance['oscillation_ratio'],
-
-        avg_clauses_per_sentence=round(clause_freq_variance['average'], 2),
-        std_clauses_per_sentence=round(clause_freq_variance['stdev'], 2),
-        range_clauses_per_sentence=clause_freq_variance['range'],
-        osc_clauses_per_sentence=clause_freq_variance['oscillation_ratio'],
-
-        pos_freq=dict(pos_freq_tbl),
-        dep_freq=dict(dep_freq_tbl),
-        verb_tense_freq=dict(verb_tense_freq_tbl),
-        lemma_freq=lemma_freq_tbl.most_common(5),
-        morphs_sample=morphs[:2]
+    features = TextFeatures(
+        language=lang,
+        pos_freq=pos_freq,
+        dep_freq=dep_freq,
+        verb_tense_freq=verb_tense_freq,
+        lemma_freq=lemma_freq,
+        sent_lengths=sent_lengths,
+        token_lengths=token_lengths,
+        clauses_per_sent=clauses_per_sent,
+        morphs_sample=morphs_sample,
+        sent_length_variance=variance_measures(sent_lengths),
+        token_length_variance=variance_measures(token_lengths),
+        clause_freq_variance=variance_measures(clauses_per_sent),
+        running_stats={
+            'sent_lengths': RunningStats.from_values(sent_lengths).to_dict(),
+            'token_lengths': RunningStats.from_values(token_lengths).to_dict(),
+            'clauses_per_sent': RunningStats.from_values(clauses_per_sent).to_dict(),
+        },
+        profile=profile,
     )
-    return final_prompt
+    if debug:
+        print_features(features)
+    return features
+
+
+def print_features(features):
+    print(f"Part of Speech: {features.pos_freq}\n")
+    print(f"Dependency: {features.dep_freq}\n")
+    print(f"Verb Tenses: {features.verb_tense_freq}\n")
+    
+    print(f"Repetition / Motifs: {features.lemma_freq}\n")
+    print(features.sent_lengths)
+    output_variance(features.sent_length_variance, 'Sentence Length (words)')
+    print(features.token_lengths)
+    output_variance(features.token_length_variance, "Token Length (char)(excluding PUNCT)")
+    print(features.clauses_per_sent)
+    output_variance(features.clause_freq_variance, "Clauses per sentence")
+
+
+# Feature extraction backends; both produce identical TextFeatures.
+# "numpy" (analyze_numpy.py) reads whole attribute columns with Doc.to_array and is
+# much faster on long documents; "python" is the per-token reference implementation.
+DEFAULT_BACKEND = "numpy"
+
+def features_from_doc(doc, lang, debug=False, backend=DEFAULT_BACKEND, profile=DEFAULT_PROFILE):
+    if backend == "numpy" and not debug: # debug output is printed by the reference path
+        from analyze_numpy import extract_features_np
+        return extract_features_np(doc, lang, profile=profile)
+    return extract_features(doc, lang, debug=debug, profile=profile)
+
+
+# Parses input_text with the given pipeline and returns its TextFeatures.
+# Nothing is printed unless debug is set. Texts longer than the pipeline's
+# max_length are analyzed in chunks (see long_text_features).
+# If a timings dict is given, the seconds spent parsing and extracting features
+# are added to its 'parse' and 'features' entries.
+# nlp must have the components the profile needs (a parser for "full").
+def text_features(input_text, nlp, lang, debug=False, backend=DEFAULT_BACKEND, timings=None, profile=DEFAULT_PROFILE):
+    if len(input_text) > nlp.max_length:
+        return long_text_features([input_text], nlp, lang, backend=backend, timings=timings, profile=profile)
+    start = time.perf_counter()
+    doc = nlp(input_text)
+    parsed = time.perf_counter()
+    if debug:
+        print("Pipeline:", nlp.pipe_names)
+        # from spacy import displacy; displacy.serve(doc, style="dep", compact=True)
+    features = features_from_doc(doc, lang, debug=debug, backend=backend, profile=profile)
+    _add_timings(timings, parsed - start, time.perf_counter() - parsed)
+    return features
+
+
+def _add_timings(timings, parse_seconds, feature_seconds):
+    if timings is not None:
+        timings['parse'] = timings.get('parse', 0.0) + parse_seconds
+        timings['features'] = timings.get('features', 0.0) + feature_seconds
+
+
+# Folds the TextFeatures of consecutive chunks of one document into the document's
+# TextFeatures: frequency tables are summed (keeping first-occurrence order) and the
+# length / clause series are merged as RunningStats, so nothing per-token is kept.
+class FeatureAccumulator:
+    def __init__(self, lang, profile=DEFAULT_PROFILE):
+        self.lang = lang
+        self.profile = profile
+        self.pos_freq = Counter()
+        self.dep_freq = Counter()
+        self.verb_tense_freq = Counter()
+        self.lemma_freq = Counter()
+        self.morphs_sample = []
+        self.stats = {name: RunningStats() for name in ('sent_lengths', 'token_lengths', 'clauses_per_sent')}
+
+    def add(self, features):
+        self.pos_freq.update(features.pos_freq)
+        self.dep_freq.update(features.dep_freq)
+        self.verb_tense_freq.update(features.verb_tense_freq)
+        self.lemma_freq.update(features.lemma_freq)
+        if len(self.morphs_sample) < 2:
+            self.morphs_sample.extend(features.morphs_sample[:2 - len(self.morphs_sample)])
+        for name, stats in self.stats.items():
+            stats.merge(RunningStats.from_dict(features.running_stats[name]))
+
+    def result(self):
+        return TextFeatures(
+            language=self.lang,
+            pos_freq=self.pos_freq,
+            dep_freq=self.dep_freq,
+            verb_tense_freq=self.verb_tense_freq,
+            lemma_freq=self.lemma_freq,
+            morphs_sample=self.morphs_sample,
+            sent_length_variance=self.stats['sent_lengths'].as_variance(),
+            token_length_variance=self.stats['token_lengths'].as_variance(),
+            clause_freq_variance=self.stats['clauses_per_sent'].as_variance(),
+            running_stats={name: stats.to_dict() for name, stats in self.stats.items()},
+            profile=self.profile,
+        )
+
+
+LONG_TEXT_CHUNK_CHARS = 100_000
+SENTENCE_END_CHARS = '.!?。！？…'
+
+# Best place to cut buffer at or before limit: the last paragraph break, else the
+# last sentence end, else the last whitespace, else limit itself.
+def _chunk_cut(buffer, limit):
+    cut = buffer.rfind('\n\n', 0, limit)
+    if cut > 0:
+        return cut + 2
+    cut = max(buffer.rfind(char, 0, limit) for char in SENTENCE_END_CHARS)
+    if cut > 0:
+        return cut + 1
+    cut = max(buffer.rfind(' ', 0, limit), buffer.rfind('\n', 0, limit))
+    return cut + 1 if cut > 0 else limit
+
+
+# Re-slices a stream of text pieces (e.g. an upload read block by block) into chunks
+# of at most max_chars, cut at paragraph or sentence boundaries where possible.
+# Push-style: feed() returns the chunks completed so far, close() the remainder.
+class TextChunker:
+    def __init__(self, max_chars=LONG_TEXT_CHUNK_CHARS):
+        self.max_chars = max_chars
+        self.buffer = ''
+
+    def feed(self, piece):
+        self.buffer += piece
+        chunks = []
+        while len(self.buffer) >= self.max_chars:
+            cut = _chunk_cut(self.buffer, self.max_chars)
+            chunk, self.buffer = self.buffer[:cut], self.buffer[cut:]
+            if chunk.strip():
+                chunks.append(chunk)
+        return chunks
+
+    def close(self):
+        chunk, self.buffer = self.buffer, ''
+        return [chunk] if chunk.strip() else []
+
+
+def iter_text_chunks(pieces, max_chars=LONG_TEXT_CHUNK_CHARS):
+    chunker = TextChunker(max_chars)
+    for piece in pieces:
+        yield from chunker.feed(piece)
+    yield from chunker.close()
+
+
+# Long-document mode: parses the text chunk by chunk with nlp.pipe and folds each
+# chunk's features into a FeatureAccumulator, so memory stays flat whatever the
+# input size (and spaCy's max_length never applies). pieces is any iterable of str.
+def long_text_features(pieces, nlp, lang, max_chars=LONG_TEXT_CHUNK_CHARS, backend=DEFAULT_BACKEND, timings=None,
+                       profile=DEFAULT_PROFILE):
+    accumulator = FeatureAccumulator(lang, profile)
+    docs = nlp.pipe(iter_text_chunks(pieces, max_chars), batch_size=1)
+    while True:
+        start = time.perf_counter()
+        doc = next(docs, None) # chunking and parsing happen here
+        if doc is None:
+            break
+        parsed = time.perf_counter()
+        accumulator.add(features_from_doc(doc, lang, backend=backend, profile=profile))
+        _add_timings(timings, parsed - start, time.perf_counter() - parsed)
+    return accumulator.result()
+
+
+# Short hash of the prompt templates and their feature encoding (prompt_registry.py);
+# part of the analysis cache key, so editing a template invalidates previously
+# generated analyses. Analyses of "lite" features get their own version, so they are
+# never served for a "full" request (or the other way round).
+def prompt_version(profile=DEFAULT_PROFILE):
+    version = prompt_registry.registry.version()
+    return version if profile == DEFAULT_PROFILE else f"{version}-{profile}"
+
+
+# Prompt for the Gemini analysis, in the template of the features' language
+def build_prompt(input_text, features):
+    return prompt_registry.registry.render(features, text=input_text)
+
+
+# Batch analysis: routes each text to a language (lang_router), groups texts per language and
+# streams every group through nlp.pipe, which batches the model work and can
+# fan out over n_process worker processes. Returns one result per input text,
+# in input order: {"language", "features"} or {"language", "error"}.
+# get_nlp(lang) must return a loaded pipeline with the components the profile needs,
+# or None if lang is unsupported.
+def analyze_batch(texts, get_nlp, batch_size=64, n_process=1, backend=DEFAULT_BACKEND, profile=DEFAULT_PROFILE):
+    from lang_router import route_language
+
+    results = [None] * len(texts)
+    groups = {} # lang -> indices into texts
+    for i, text in enumerate(texts):
+        if not text or not text.strip():
+            results[i] = {'language': None, 'error': 'No text provided.'}
+            continue
+        lang = route_language(text)
+        if lang == 'unknown':
+            results[i] = {'language': None, 'error': 'Language could not be detected.'}
+            continue
+        groups.setdefault(lang, []).append(i)
+
+    for lang, indices in groups.items():
+        nlp = get_nlp(lang)
+        if nlp is None:
+            for i in indices:
+                results[i] = {'language': lang, 'error': f'Unsupported language detected: {lang}'}
+            continue
+        docs = nlp.pipe((texts[i] for i in indices), batch_size=batch_size, n_process=n_process)
+        for i, doc in zip(indices, docs):
+            results[i] = {'language': lang, 'features': features_from_doc(doc, lang, backend=backend, profile=profile).summary()}
+    return results
@@ -0,0 +1,148 @@
+# NumPy backend for the feature extractor in analyze.py.
+# Instead of reading token.pos_, token.dep_, ... one token at a time, it pulls
+# whole attribute columns out of the Doc with Doc.to_array and computes the
+# frequency tables, per-sentence counts and variance statistics as array ops.
+# Results are identical to analyze.extract_features / analyze.variance_measures
+# (same values, same Counter ordering, same float rounding).
+
+from collections import Counter
+
+import numpy as np
+
+from analyze import TextFeatures, RunningStats, CONTENT_POS, CLAUSE_DEPS, DEFAULT_PROFILE, uses_dependencies
+
+# Doc.to_array accepts attribute names, so spaCy itself need not be imported here
+ATTRS = ["POS", "DEP", "TAG", "LENGTH", "SENT_START", "MORPH", "LEMMA"]
+POS_COL, DEP_COL, TAG_COL, LENGTH_COL, SENT_START_COL, MORPH_COL, LEMMA_COL = range(len(ATTRS))
+
+
+# RunningStats of an integer array, from exact (int64 -> Python int) sums
+def running_stats_np(values):
+    values = np.asarray(values, dtype=np.int64)
+    if values.size == 0:
+        return RunningStats()
+    return RunningStats(
+        count=int(values.size),
+        total=int(values.sum()),
+        sum_sq=int(np.dot(values, values)),
+        min=int(values.min()),
+        max=int(values.max()),
+        first=int(values[0]),
+        last=int(values[-1]),
+        changes=int(np.count_nonzero(values[1:] != values[:-1])),
+    )
+
+
+# Array version of analyze.variance_measures for integer-valued data (same results)
+def variance_measures_np(values):
+    return running_stats_np(values).as_variance()
+
+
+# Counts of each distinct value in column, decoded to strings and ordered by
+# first occurrence (the order Counter(list) would have produced).
+def _freq_table(column, strings):
+    if column.size == 0:
+        return Counter()
+    keys, first, counts = np.unique(column, return_index=True, return_counts=True)
+    order = np.argsort(first, kind="stable")
+    return Counter({strings[int(k)]: int(c) for k, c in zip(keys[order], counts[order])})
+
+
+def _pos_freq_table(pos_ids, strings):
+    if pos_ids.size == 0:
+        return Counter()
+    counts = np.bincount(pos_ids)
+    first = np.empty(counts.size, dtype=np.int64)
+    # assigning in reverse leaves each id's first position as the final write
+    first[pos_ids[::-1]] = np.arange(pos_ids.size - 1, -1, -1)
+    present = np.flatnonzero(counts)
+    present = present[np.argsort(first[present], kind="stable")]
+    return Counter({strings[int(p)]: int(counts[p]) for p in present})
+
+
+def _morph_string(vocab, key, cache):
+    # Same as str(token.morph): the FEATS string, or "" for an empty analysis
+    morph_str = cache.get(key)
+    if morph_str is None:
+        morph_str = vocab.strings[key]
+        if morph_str == vocab.morphology.EMPTY_MORPH:
+            morph_str = ""
+        cache[key] = morph_str
+    return morph_str
+
+
+def extract_features_np(doc, lang, profile=DEFAULT_PROFILE):
+    if "sents" in doc.user_hooks or not doc.has_annotation("SENT_START"):
+        # custom sentence hooks (or the missing-annotation error) are only honoured by doc.sents
+        from analyze import extract_features
+        return extract_features(doc, lang, profile=profile)
+    dependencies = uses_dependencies(profile)
+
+    strings = doc.vocab.strings
+    cols = doc.to_array(ATTRS)
+    pos = cols[:, POS_COL]
+    dep = cols[:, DEP_COL]
+    n_tokens = len(doc)
+
+    # Sentence ids: a new sentence starts at token 0 and wherever SENT_START == 1
+    # (exactly how Doc.sents splits a parsed doc)
+    is_start = cols[:, SENT_START_COL] == 1
+    if n_tokens:
+        is_start[0] = True
+    sent_ids = np.cumsum(is_start) - 1
+    n_sents = int(is_start.sum())
+    sent_lengths = np.bincount(sent_ids, minlength=n_sents)
+
+    if dependencies:
+        clause_hashes = np.array([strings[d] for d in CLAUSE_DEPS], dtype=np.uint64)
+        is_clause = np.isin(dep, clause_hashes)
+        # +1 for the main clause; total clauses per sentence
+        clauses_per_sent = np.bincount(sent_ids, weights=is_clause, minlength=n_sents).astype(np.int64) + 1
+    else:
+        clauses_per_sent = np.zeros(0, dtype=np.int64)
+
+    # POS values are small enum ids, so they are counted with bincount
+    pos_ids = pos.astype(np.int64)
+    punct_id = strings["PUNCT"]
+    token_lengths = cols[pos_ids != punct_id, LENGTH_COL].astype(np.int64)
+    content_ids = np.array([strings[p] for p in CONTENT_POS], dtype=np.int64)
+    content_mask = np.isin(pos_ids, content_ids)
+
+    tag_freq = _freq_table(cols[:, TAG_COL], strings)
+    verb_tense_freq = Counter({tag: c for tag, c in tag_freq.items() if tag.startswith('V')}) # verb tenses
+
+    # Morph sample: only the first two sentences are needed, so decode just those tokens
+    morphs_sample = []
+    morph_cache = {}
+    sent_start = 0
+    for sent_length in sent_lengths[:2].tolist():
+        sent_morphs = []
+        for key in cols[sent_start:sent_start + sent_length, MORPH_COL].tolist():
+            morph_str = _morph_string(doc.vocab, key, morph_cache)
+            if morph_str:
+                sent_morphs.append(morph_str.split('|'))
+        morphs_sample.append(sent_morphs)
+        sent_start += sent_length
+
+    stats = {
+        'sent_lengths': running_stats_np(sent_lengths),
+        'token_lengths': running_stats_np(token_lengths),
+        'clauses_per_sent': running_stats_np(clauses_per_sent),
+    }
+
+    return TextFeatures(
+        language=lang,
+        pos_freq=_pos_freq_table(pos_ids, strings),
+        dep_freq=_freq_table(dep, strings) if dependencies else Counter(),
+        verb_tense_freq=verb_tense_freq,
+        lemma_freq=_freq_table(cols[content_mask, LEMMA_COL], strings),
+        sent_lengths=sent_lengths.tolist(),
+        token_lengths=token_lengths.tolist(),
+        clauses_per_sent=clauses_per_sent.tolist(),
+        morphs_sample=morphs_sample,
+        sent_length_variance=stats['sent_lengths'].as_variance(),
+        token_length_variance=stats['token_lengths'].as_variance(),
+        clause_freq_variance=stats['clauses_per_sent'].as_variance(),
+        running_stats={name: stat.to_dict() for name, stat in stats.items()},
+        profile=profile,
+    )
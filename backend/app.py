@@ -1,27 +1,28 @@
-import spacy
+from dotenv import load_dotenv
+load_dotenv() # before the backend modules below read their settings from the environment
+
 from fastapi import FastAPI, Body, Request
-from fastapi.responses import JSONResponse
-from slowapi import Limiter
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
-from langdetect import detect
-from analyze import text_analyze_chn, text_analyze_eng
-from google import genai
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from analyze import DEFAULT_PROFILE, PROFILES
+from backend import jobs, metrics, near_duplicates, nlp_registry, parse_pool, pipeline, ratelimit, style_index, user_profiles
+from backend.cache import analysis_cache, text_hash
+import json
+import logging
 import os
-from dotenv import load_dotenv
+
+# Leveled logging instead of prints; debug messages cost a level check unless LOG_LEVEL=DEBUG
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING"),
+                    format="%(asctime)s %(levelname)s %(name)s: %(message)s")
 
 # DB:
-from fastapi import Depends, HTTPException, Header
+from fastapi import Depends, HTTPException, Header, Query
 from sqlmodel import Session, select
+from sqlalchemy.exc import IntegrityError
+from starlette.concurrency import run_in_threadpool
 from typing import Annotated
 from typing import List # helper to display all users & records
 
-load_dotenv()
-api_key = os.getenv("GEMINI_API_KEY")
 app = FastAPI() #creating FastAPI application "server"
-client = genai.Client(api_key=api_key)
-nlp_en = None
-nlp_cn = None
 
 # entry point for web app
 
@@ -32,28 +33,21 @@ nlp_cn = None
 # they get a fresh clean Session with no data conflicts.
 # Tags are purely for Documentation Organization (grouped together under their headers).
 
-# Initialize Limiter
-limiter = Limiter(key_func=get_remote_address)
-app.state.limiter = limiter
-
-# Handle rate limit exceeded
-@app.exception_handler(RateLimitExceeded)
-async def rate_limit_handler(request: Request, exc: RateLimitExceeded):
-    return JSONResponse(
-        status_code=429,
-        content={"error": "Rate limit exceeded. Please try again later."}
-    )
-
 from fastapi.middleware.cors import CORSMiddleware
 from backend.middleware import RSignatureMiddleware # Custom HMAC-SHA256 signature middleware
 
+# Innermost: token-bucket rate limits shared by all workers (backend/ratelimit.py);
+# inside the stage timings, which tell it whether a request called Gemini
+app.add_middleware(ratelimit.RateLimitMiddleware)
+# Per-request stage timings are reported in a Server-Timing header
+app.add_middleware(metrics.ServerTimingMiddleware)
 app.add_middleware(RSignatureMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],   # during dev allow all; in prod restrict to site
     allow_credentials=True,
     allow_methods=["*"],
-    allow_headers=["*", "X-rSec-Timestamp", "X-rSec-Signature", "x-user-id"], # expose custom headers to CORS
+    allow_headers=["*", "X-rSec-Timestamp", "X-rSec-Signature", "X-rSec-Content-SHA256", "x-user-id"], # expose custom headers to CORS
 )
 
 # --- IMPORT FROM BACKEND MODULE ---
@@ -70,6 +64,38 @@ SessionDep = Annotated[Session, Depends(get_session)]
 @app.on_event("startup")
 def on_startup():
     create_db_and_tables()
+    # Load and warm up the spaCy pipelines once; they stay resident for every request.
+    # Already done (and shared copy-on-write) when preloaded by the gunicorn master.
+    nlp_registry.preload()
+    pipeline.warm_up()
+    # Parse workers are forked after the preload so they share the pipelines
+    parse_pool.start()
+    # Near-duplicate index: persisted signatures, missing records indexed in the background
+    near_duplicates.start()
+    # Style vectors of stored records, for /similar
+    style_index.start()
+
+# Background job workers (backend/jobs.py) run as tasks on this process's event loop
+@app.on_event("startup")
+async def start_jobs():
+    jobs.start()
+
+@app.on_event("shutdown")
+async def stop_jobs():
+    await jobs.stop() # before the parse pool goes away; unfinished jobs are queued again
+
+@app.on_event("shutdown")
+def on_shutdown():
+    parse_pool.shutdown()
+
+# Parser queue full: tell the client to back off instead of queueing without bound
+@app.exception_handler(parse_pool.ParsePoolBusy)
+async def parse_pool_busy_handler(request: Request, exc: parse_pool.ParsePoolBusy):
+    return JSONResponse(
+        status_code=503,
+        content={"error": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
 
 # Dependency for Mock Auth ("Login")
 def get_current_user(
@@ -104,9 +130,14 @@ def create_record(record: AnalysisRecord, session: SessionDep) -> AnalysisRecord
     if not user:
         raise HTTPException(status_code=404, detail="User in record not found")
 
+    record.input_hash = text_hash(record.input)
     session.add(record)
-    session.commit()
+    try:
+        session.commit()
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail="A record for this input already exists")
     session.refresh(record)
+    near_duplicates.add(record.id, record.input)
     return record
 
 @app.get("/records/{record_id}", response_model=AnalysisRecord, tags=["Database"])
@@ -125,12 +156,91 @@ def read_record(
    
     return record
 
-# Helper endpoint to see everyone in the DB
-@app.get("/debug/db", tags=["Debug"])
-def read_all_data(session: Session = Depends(get_session)):
-    users = session.exec(select(User)).all()
-    records = session.exec(select(AnalysisRecord)).all()
-    return {"users": users, "records": records}
+# Listings are keyset-paginated: pass the last id of a page as after_id to get the next
+# one. Each page is a single index range scan however large the tables grow, and
+# records are listed without their (compressed) bodies; read those via /records/{id}.
+MAX_PAGE_SIZE = 200
+
+@app.get("/users/", tags=["Database"])
+def list_users(
+    session: SessionDep,
+    after_id: int = Query(0, ge=0),
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+):
+    users = session.exec(
+        select(User).where(User.id > after_id).order_by(User.id).limit(limit)
+    ).all()
+    return {"users": users, "next_after_id": users[-1].id if len(users) == limit else None}
+
+@app.get("/users/{user_id}/records", tags=["Database"])
+def list_user_records(
+    user_id: int,
+    after_id: int = Query(0, ge=0),
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    current_user: User = Depends(get_current_user),
+    session: Session = Depends(get_session)
+):
+    # same ownership rule as read_record
+    if current_user.id != user_id:
+        raise HTTPException(status_code=403, detail="Not authorized to access these records")
+    rows = session.exec(
+        select(AnalysisRecord.id, AnalysisRecord.input_hash, AnalysisRecord.profile, AnalysisRecord.language,
+               AnalysisRecord.llm_model, AnalysisRecord.prompt_version)
+        .where(AnalysisRecord.owner_id == user_id, AnalysisRecord.id > after_id)
+        .order_by(AnalysisRecord.id)
+        .limit(limit)
+    ).all()
+    records = [dict(row._mapping) for row in rows]
+    return {"records": records, "next_after_id": records[-1]["id"] if len(records) == limit else None}
+
+# A user's style across all their records: merged frequency tables and length / clause
+# statistics, maintained as each record is stored (backend/user_profiles.py), so this
+# reads a single row however many records the user has.
+@app.get("/users/{user_id}/profile", tags=["Database"])
+def read_user_profile(
+    user_id: int,
+    current_user: User = Depends(get_current_user)
+):
+    # same ownership rule as read_record
+    if current_user.id != user_id:
+        raise HTTPException(status_code=403, detail="Not authorized to access this profile")
+    return user_profiles.load_profile(user_id)
+
+# Stylistically closest stored records (by their feature vectors, backend/style_index.py)
+# to one of the user's records (?record_id=) or to a new text (?text=). Only ids and
+# similarities are returned; no Gemini call is made.
+MAX_SIMILAR = 100
+
+@app.get("/similar", tags=["Database"])
+async def similar_records(
+    record_id: int | None = Query(None),
+    text: str | None = Query(None),
+    k: int = Query(10, ge=1, le=MAX_SIMILAR),
+    current_user: User = Depends(get_current_user),
+    session: Session = Depends(get_session)
+):
+    if (record_id is None) == (not text or not text.strip()):
+        raise HTTPException(status_code=422, detail="Pass either record_id or text")
+    if record_id is not None:
+        record_owner = session.exec(select(AnalysisRecord.owner_id).where(AnalysisRecord.id == record_id)).first()
+        if record_owner is None:
+            raise HTTPException(status_code=404, detail="Record not found")
+        # same ownership rule as read_record
+        if current_user.id != record_owner:
+            raise HTTPException(status_code=403, detail="Not authorized to access this record")
+    try:
+        lang, matches = await pipeline.similar_styles(record_id=record_id, text=text, k=k)
+    except pipeline.AnalysisError as e:
+        return {"error": str(e)}
+    return {"language": lang,
+            "results": [{"record_id": match_id, "similarity": similarity} for match_id, similarity in matches]}
+
+# Prometheus scrape endpoint (stage histograms, cache hit/miss counters, in-flight work).
+# Exempt from request signing like /docs; it carries no user data.
+@app.get("/metrics", include_in_schema=False)
+def read_metrics():
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
 
 # Basic Root Endpoint
 
@@ -138,55 +248,167 @@ def read_all_data(session: Session = Depends(get_session)):
 async def root():
     return {"message": "T3xtAnlys API is up and *running*!"}
 
+# Feature profile of an analysis: "full" (default) or "lite", which skips the
+# dependency metrics and parses with a tagger-only pipeline, several times faster.
+def profile_error(profile):
+    if profile not in PROFILES:
+        return f"Unknown profile: {profile}. Expected one of: {', '.join(PROFILES)}"
+    return None
+
 @app.post("/analyze")
-@limiter.limit("30/minute;500/day")
 async def analyze_text(
     request: Request, 
     payload: dict = Body(...),
-    session = Depends(get_session)):
+    current_user: User = Depends(get_current_user)):
     text = payload.get("text", "")
     if not text.strip():
         return {"error": "No text provided."}
-    lang = detect(text)
-
-    # 1. Cache check
-    existing_record = session.exec(
-        select(AnalysisRecord).where(AnalysisRecord.input == text)
-    ).first()
-    if existing_record:
-        return {"language": lang, "analysis": existing_record.output}
-    
-    # 2. Cache not hit scenario - analyze
-    print(text)
-    if lang == "en":
-        global nlp_en
-        if not nlp_en:
-            nlp_en = spacy.load("en_core_web_sm")
-        prompt = text_analyze_eng(text, nlp_en)
-        nlp_en = None
-    elif lang == "zh-cn":
-        global nlp_cn
-        if not nlp_cn:
-            nlp_cn = spacy.load("zh_core_web_sm")
-        prompt = text_analyze_chn(text, nlp_cn)
-        nlp_cn = None
-    else:
-        return {"error": f"Unsupported language detected: {lang}"}
-    
+    profile = payload.get("profile", DEFAULT_PROFILE)
+    if profile_error(profile):
+        return {"error": profile_error(profile)}
+    # "reuse_similar": true serves the analysis of an already analyzed near-duplicate
+    # text (similarity >= "similarity_threshold") and names the record it came from
+    reuse_similar = bool(payload.get("reuse_similar", False))
+    threshold = payload.get("similarity_threshold", near_duplicates.NEAR_DUP_THRESHOLD)
+    if not isinstance(threshold, (int, float)) or not 0 < threshold <= 1:
+        return {"error": "similarity_threshold must be a number in (0, 1]."}
+    # Blocking stages run in the threadpool and Gemini is awaited (backend/pipeline.py),
+    # so a slow analysis never stalls other requests on this worker.
     try:
-        print("Gemini request sent")
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=prompt
-        )
-    except Exception as e:
-        return {"error": f"AI generation failed: {str(e)}"}
-    
-    print("Gemini response received")
-    
-    # 3. Save new AnalysisRecord to DB
-    new_record = AnalysisRecord(input=text, output=response.text, owner_id=1) #TODO: owner_id is now default =1 for testing
-    session.add(new_record)
-    session.commit()
-    print("New analysis cached")
-    return {"language": lang, "analysis": response.text}
+        if reuse_similar:
+            lang, analysis, match = await pipeline.analyze_reusing_similar(
+                text, current_user.id, profile, threshold)
+        else:
+            (lang, analysis), match = await pipeline.analyze(text, current_user.id, profile), None
+    except pipeline.AnalysisError as e:
+        return {"error": str(e)}
+    response = {"language": lang, "profile": profile, "analysis": analysis}
+    if match:
+        response["matched"] = match
+    return response
+
+# Background variant of /analyze: the job is queued and its id returned at once; the
+# result is fetched with GET /jobs/{id} (?wait=seconds to long-poll until it finishes).
+# Takes the same payload as /analyze; invalid payloads are rejected with 422.
+MAX_JOB_WAIT = 30 # seconds
+
+@app.post("/jobs", status_code=202, tags=["Jobs"])
+async def create_job(
+    request: Request,
+    payload: dict = Body(...),
+    current_user: User = Depends(get_current_user)):
+    text = payload.get("text", "")
+    if not text.strip():
+        raise HTTPException(status_code=422, detail="No text provided.")
+    profile = payload.get("profile", DEFAULT_PROFILE)
+    if profile_error(profile):
+        raise HTTPException(status_code=422, detail=profile_error(profile))
+    reuse_similar = bool(payload.get("reuse_similar", False))
+    threshold = payload.get("similarity_threshold", near_duplicates.NEAR_DUP_THRESHOLD)
+    if not isinstance(threshold, (int, float)) or not 0 < threshold <= 1:
+        raise HTTPException(status_code=422, detail="similarity_threshold must be a number in (0, 1].")
+    job_id, status = await jobs.enqueue(current_user.id, text, profile, reuse_similar,
+                                float(threshold) if reuse_similar else None)
+    return {"job_id": job_id, "status": status}
+
+@app.get("/jobs/{job_id}", tags=["Jobs"])
+async def read_job(
+    job_id: int,
+    wait: float = Query(0, ge=0, le=MAX_JOB_WAIT),
+    current_user: User = Depends(get_current_user)):
+    job = await run_in_threadpool(jobs.load_job, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    # same ownership rule as read_record
+    if current_user.id != job["owner_id"]:
+        raise HTTPException(status_code=403, detail="Not authorized to access this job")
+    if wait and job["status"] not in jobs.FINISHED:
+        job = await jobs.wait(job_id, wait)
+    return job
+
+# Streaming variant of /analyze (NDJSON, one event per line): the language and metrics
+# are sent as soon as they are computed, then Gemini output chunks as they arrive.
+@app.post("/analyze/stream")
+async def analyze_text_stream(
+    request: Request,
+    payload: dict = Body(...),
+    current_user: User = Depends(get_current_user)):
+    text = payload.get("text", "")
+    if not text.strip():
+        return {"error": "No text provided."}
+    profile = payload.get("profile", DEFAULT_PROFILE)
+    if profile_error(profile):
+        return {"error": profile_error(profile)}
+
+    parse_pool.ensure_capacity() # reject with 503 now, before the stream has started
+
+    async def ndjson():
+        async for event in pipeline.analyze_stream(text, current_user.id, profile):
+            yield json.dumps(event, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+# Long-document upload: the request body is the raw UTF-8 text (any size), read and
+# parsed chunk by chunk instead of being sent whole inside a JSON payload.
+# ?llm=true also generates the style analysis from the merged features and stores it
+# as one of the user's records (uploads over pipeline.MAX_STORED_UPLOAD_BYTES get 413),
+# ?profile=lite skips the dependency metrics.
+@app.post("/analyze/upload")
+async def analyze_upload(
+    request: Request,
+    llm: bool = False,
+    profile: str = DEFAULT_PROFILE,
+    current_user: User = Depends(get_current_user)):
+    if profile_error(profile):
+        return {"error": profile_error(profile)}
+    try:
+        return await pipeline.analyze_upload(request.stream(), current_user.id, with_llm=llm, profile=profile)
+    except pipeline.UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except pipeline.AnalysisError as e:
+        return {"error": str(e)}
+
+# Parser pool load: queue depth and worker utilization
+@app.get("/debug/parse-pool", tags=["Debug"])
+def parse_pool_stats():
+    return parse_pool.stats()
+
+# Explicitly drops in-memory cache entries for a model and/or prompt version
+# (DB rows are only reused while they match the current versions anyway).
+@app.post("/debug/cache/invalidate", tags=["Debug"])
+def invalidate_cache(payload: dict = Body(default={})):
+    removed = analysis_cache.invalidate_versions(
+        model=payload.get("model"), prompt_version=payload.get("prompt_version"))
+    return {"removed": removed}
+
+
+# Batch analysis for ingestion jobs: features only (no Gemini call, no caching).
+# Texts are grouped by language and parsed with nlp.pipe in the parse pool, split over
+# up to n_process of its workers; results keep input order. A full pool answers 503.
+MAX_BATCH_TEXTS = 1000
+
+def positive_int(payload, name, default):
+    value = payload.get(name, default)
+    if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+        raise HTTPException(status_code=422, detail=f"'{name}' must be a positive integer")
+    return value
+
+# n_process splits the batch across the parse pool, so it is capped at its worker count
+@app.post("/analyze/batch")
+async def analyze_text_batch(
+    request: Request,
+    payload: dict = Body(...),
+    current_user: User = Depends(get_current_user)):
+    texts = payload.get("texts")
+    if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+        raise HTTPException(status_code=422, detail="'texts' must be a list of strings")
+    if len(texts) > MAX_BATCH_TEXTS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BATCH_TEXTS} texts per batch")
+    batch_size = positive_int(payload, "batch_size", 64)
+    n_process = min(positive_int(payload, "n_process", 1), max(parse_pool.PARSE_WORKERS, 1))
+    profile = payload.get("profile", DEFAULT_PROFILE)
+    if profile_error(profile):
+        raise HTTPException(status_code=422, detail=profile_error(profile))
+
+    results = await parse_pool.parse_batch(texts, profile, batch_size=batch_size, parts=n_process)
+    return {"results": results}
@@ -0,0 +1,120 @@
+# Analysis cache helpers.
+# Texts are identified by the SHA-256 of their normalized form (AnalysisRecord.input_hash),
+# so the DB lookup is a unique-index probe on a 64-char key instead of a full-text compare.
+# An in-process LRU/TTL tier sits in front of SQLite: repeated submissions are answered
+# from memory without a DB round-trip or language detection.
+# Entries are keyed on (text hash, LLM model, prompt version); changing either version
+# makes older entries unreachable, and invalidate() drops them explicitly.
+
+import asyncio
+import hashlib
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_text(text):
+    # Only changes that never alter the analysis: unicode form, line endings, outer whitespace
+    text = unicodedata.normalize("NFC", text)
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text.strip()
+
+
+def text_hash(text):
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class TTLCache:
+    # Bounded, thread-safe LRU map whose entries also expire ttl seconds after insertion
+
+    def __init__(self, maxsize=1024, ttl=3600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict() # key -> (expires_at, value), least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, predicate=None):
+        # Drops every entry whose key satisfies predicate (all entries if None); returns the count
+        with self._lock:
+            if predicate is None:
+                removed = len(self._data)
+                self._data.clear()
+                return removed
+            stale = [key for key in self._data if predicate(key)]
+            for key in stale:
+                del self._data[key]
+            return len(stale)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class AnalysisCache(TTLCache):
+    # Keys are (input_hash, llm_model, prompt_version); values are (language, analysis text)
+
+    def invalidate_versions(self, model=None, prompt_version=None):
+        # Drops entries produced by the given model and/or prompt version
+        return self.invalidate(lambda key: (model is None or key[1] == model)
+                               and (prompt_version is None or key[2] == prompt_version))
+
+
+analysis_cache = AnalysisCache(
+    maxsize=int(os.getenv("ANALYSIS_CACHE_SIZE", "4096")),
+    ttl=float(os.getenv("ANALYSIS_CACHE_TTL", "3600")),
+)
+
+
+class SingleFlight:
+    # Coalesces concurrent asyncio calls with the same key: the first caller starts
+    # the work, later callers await the same task, so duplicate submissions share
+    # one parse, one Gemini call and one DB write. Keys are forgotten once done.
+
+    def __init__(self):
+        self._flights = {}
+
+    async def run(self, key, fn):
+        task = self._flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._flights[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        # shield: one caller disconnecting must not cancel the work for the others
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        if not task.cancelled():
+            task.exception() # mark as retrieved even if every waiter went away
+
+    def __len__(self):
+        return len(self._flights)
+
+
+analysis_flights = SingleFlight()
@@ -1,11 +1,36 @@
+import os
+import zlib
 from typing import Annotated
 
 from fastapi import Depends, FastAPI, HTTPException, Query
 from sqlmodel import Field, Session, SQLModel, create_engine, select
+from sqlalchemy import Column, Index, LargeBinary, UniqueConstraint, event
+from sqlalchemy.types import TypeDecorator
 
 # FastAPI & SQL tutorial: 
 # https://fastapi.tiangolo.com/tutorial/sql-databases/#create-the-app-with-a-single-model
 
+# Text bodies (inputs, LLM outputs) are stored as zlib-compressed UTF-8 BLOBs and are
+# never indexed: lookups go through input_hash, so the bodies only need to be read back.
+# Rows written before compression hold plain TEXT and are returned as-is.
+class CompressedText(TypeDecorator):
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else zlib.compress(value.encode("utf-8"))
+
+    def process_result_value(self, value, dialect):
+        return decompress_text(value)
+
+
+def decompress_text(value):
+    # str for a stored body, whether compressed (bytes) or legacy plain text
+    if value is None or isinstance(value, str):
+        return value
+    return zlib.decompress(value).decode("utf-8")
+
+
 # Creating Database models
 class User(SQLModel, table=True): # represents a table in the db, not just a data model
     id: int | None = Field(default=None, primary_key=True)
@@ -15,15 +40,74 @@ class User(SQLModel, table=True): # represents a table in the db, not just a dat
 
 class AnalysisRecord(SQLModel, table=True):
     # "Child" table
+    # One record per text and profile: "full" and "lite" analyses of a text are kept side by side
+    __table_args__ = (Index("ix_analysisrecord_input_hash_profile", "input_hash", "profile", unique=True),)
     id: int | None = Field(default=None, primary_key=True)
     # !! we link this record to a specific user
-    owner_id: int = Field(foreign_key="user.id") # enforces that this number must exist in the User table
-    
-    input: str = Field(index=True) # input text, index created by SQLModel for faster lookups
-    output: str = Field(index=True) # output text, indexed
+    owner_id: int = Field(foreign_key="user.id", index=True) # enforces that this number must exist in the User table
+    # (indexed for per-owner listings; SQLite appends the id, so "owner_id = ? AND id > ?" is one range scan)
+
+    input: str = Field(sa_column=Column(CompressedText, nullable=False)) # input text, compressed, not indexed
+    output: str = Field(sa_column=Column(CompressedText, nullable=False)) # output text, compressed, not indexed
+
+    # Cache key: SHA-256 of the normalized input (backend/cache.py); unique together with
+    # the profile, so lookups never compare whole documents. NULL only for legacy duplicate rows.
+    input_hash: str | None = Field(default=None)
+    # Feature profile of the analysis (analyze.PROFILES); "/upload" appended for the
+    # analyses of uploads, which are generated from an excerpt
+    profile: str = Field(default="full", sa_column_kwargs={"server_default": "full"})
+    language: str | None = Field(default=None) # detected language of the input
+    # The output is only reused while both match the server's current settings
+    llm_model: str | None = Field(default=None)
+    prompt_version: str | None = Field(default=None)
+
+class FeatureRecord(SQLModel, table=True):
+    # Extracted linguistic features (analyze.TextFeatures), stored independently of the
+    # LLM output so prompt or model changes never require re-parsing the text.
+    __table_args__ = (UniqueConstraint("input_hash", "pipeline"),) # one row per text per pipeline version
+    id: int | None = Field(default=None, primary_key=True)
+    input_hash: str # same key as AnalysisRecord.input_hash
+    pipeline: str # spaCy pipeline + feature extractor version (backend/feature_store.py)
+    data: bytes # zlib-compressed JSON of TextFeatures.to_dict()
+
+class UserStyleProfile(SQLModel, table=True):
+    # A user's records' features merged into one (backend/user_profiles.py), updated in
+    # the transaction that inserts each new record, so reading it never touches the records.
+    user_id: int = Field(foreign_key="user.id", primary_key=True)
+    records: int = Field(default=0) # records merged in
+    last_record_id: int = Field(default=0) # highest AnalysisRecord.id merged in
+    data: bytes # zlib-compressed JSON: {"languages": {lang: records}, "features": TextFeatures.to_dict()}
+
+class AnalysisJob(SQLModel, table=True):
+    # Background analysis queued through POST /jobs and run by the in-process workers
+    # (backend/jobs.py). status: queued -> running -> done | failed; a running job whose
+    # lease expired (its worker died) goes back to queued.
+    # Workers claim "status = ? ORDER BY id" - one range scan of the (status, id) index.
+    __table_args__ = (Index("ix_analysisjob_status_id", "status", "id"),)
+    id: int | None = Field(default=None, primary_key=True)
+    owner_id: int = Field(foreign_key="user.id")
+    status: str = Field(default="queued")
+    input: str = Field(sa_column=Column(CompressedText, nullable=False)) # compressed, not indexed
+    input_hash: str = Field(index=True) # an identical unfinished job is reused instead of queued twice
+    profile: str = Field(default="full")
+    reuse_similar: bool = Field(default=False)
+    similarity_threshold: float | None = Field(default=None)
+
+    attempts: int = Field(default=0)
+    worker: str | None = Field(default=None) # "host:pid" of the process running it
+    lease_expires: float | None = Field(default=None)
+    created_at: float
+    started_at: float | None = Field(default=None)
+    finished_at: float | None = Field(default=None)
+
+    # Result: the record holding the analysis (a near-duplicate's when reused), or an error
+    record_id: int | None = Field(default=None)
+    language: str | None = Field(default=None)
+    similarity: float | None = Field(default=None)
+    error: str | None = Field(default=None)
 
 # Creating an Engine (holds connection to the db)
-sqlite_file_name = "database.db"
+sqlite_file_name = os.getenv("DATABASE_FILE", "database.db")
 sqlite_url = f"sqlite:///{sqlite_file_name}"
 
 # Allows FastAPI to use the same SQLite db in different threads,
@@ -31,10 +115,80 @@ sqlite_url = f"sqlite:///{sqlite_file_name}"
 connect_args = {"check_same_thread": False}
 engine = create_engine(sqlite_url, connect_args=connect_args)
 
+# Applied to every new connection. WAL lets readers run while a write is in progress
+# and turns each commit into an append; synchronous=NORMAL is durable across crashes
+# of the process in WAL mode (only an OS crash can lose the last commits).
+SQLITE_PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "cache_size=-65536", # KiB, i.e. 64 MiB page cache per connection
+    "temp_store=MEMORY",
+    "mmap_size=268435456",
+)
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(f"PRAGMA {pragma}")
+    cursor.close()
+
 
 # Creating the Tables
 def create_db_and_tables(): 
     SQLModel.metadata.create_all(engine) # create tables for all table models
+    migrate_analysis_record()
+
+# create_all() never alters existing tables, so columns added to AnalysisRecord
+# after a database was created are added here (and input hashes backfilled).
+# Records from before profiles were keyed separately get theirs from the prompt version.
+# Databases from before compression also lose their full-text indexes and have their
+# plain-text bodies compressed (once; run VACUUM afterwards to give the space back).
+def migrate_analysis_record():
+    from backend.cache import text_hash
+
+    with engine.begin() as conn:
+        existing = {row[1] for row in conn.exec_driver_sql("PRAGMA table_info(analysisrecord)")}
+        for column in ("input_hash", "language", "llm_model", "prompt_version"):
+            if column not in existing:
+                conn.exec_driver_sql(f"ALTER TABLE analysisrecord ADD COLUMN {column} VARCHAR")
+        if "llm_model" not in existing:
+            # every record written before versioning came from this model
+            conn.exec_driver_sql("UPDATE analysisrecord SET llm_model = 'gemini-2.5-flash'")
+        if "profile" not in existing:
+            conn.exec_driver_sql("ALTER TABLE analysisrecord ADD COLUMN profile VARCHAR NOT NULL DEFAULT 'full'")
+            conn.exec_driver_sql("UPDATE analysisrecord SET profile = 'lite' WHERE prompt_version LIKE '%-lite'")
+
+        seen = set(conn.exec_driver_sql(
+            "SELECT input_hash, profile FROM analysisrecord WHERE input_hash IS NOT NULL").fetchall())
+        rows = conn.exec_driver_sql(
+            "SELECT id, input, profile FROM analysisrecord WHERE input_hash IS NULL ORDER BY id").fetchall()
+        for record_id, text, profile in rows:
+            digest = text_hash(decompress_text(text))
+            if (digest, profile) in seen: # older duplicates keep a NULL hash (allowed by the unique index)
+                continue
+            seen.add((digest, profile))
+            conn.exec_driver_sql("UPDATE analysisrecord SET input_hash = ? WHERE id = ?", (digest, record_id))
+        conn.exec_driver_sql("DROP INDEX IF EXISTS ix_analysisrecord_input_hash") # unique on the hash alone
+        conn.exec_driver_sql(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_analysisrecord_input_hash_profile"
+            " ON analysisrecord (input_hash, profile)")
+        conn.exec_driver_sql(
+            "CREATE INDEX IF NOT EXISTS ix_analysisrecord_owner_id ON analysisrecord (owner_id)")
+        conn.exec_driver_sql("DROP INDEX IF EXISTS ix_analysisrecord_input")
+        conn.exec_driver_sql("DROP INDEX IF EXISTS ix_analysisrecord_output")
+
+        while True: # in batches; compressed rows no longer match the query
+            legacy = conn.exec_driver_sql(
+                "SELECT id, input, output FROM analysisrecord"
+                " WHERE typeof(input) = 'text' OR typeof(output) = 'text' LIMIT 1000").fetchall()
+            if not legacy:
+                break
+            for record_id, text, output in legacy:
+                conn.exec_driver_sql("UPDATE analysisrecord SET input = ?, output = ? WHERE id = ?", (
+                    zlib.compress(decompress_text(text).encode("utf-8")),
+                    zlib.compress(decompress_text(output).encode("utf-8")),
+                    record_id))
 
 # Creating session dependency
 def get_session():
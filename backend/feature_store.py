@@ -0,0 +1,64 @@
+# Persistent cache of extracted NLP features (FeatureRecord), separate from the
+# LLM output cache. Rows are keyed by text hash and pipeline version, so a new
+# prompt template or LLM model reuses them, while upgrading spaCy, a model
+# package or the extractor (analyze.FEATURES_VERSION) recomputes them. Each feature
+# profile other than the default has its own versions.
+
+import json
+import zlib
+
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import select
+
+from analyze import DEFAULT_PROFILE, FEATURES_VERSION, TextFeatures
+from backend.database.models import FeatureRecord
+
+
+def pipeline_version(nlp, profile=DEFAULT_PROFILE, chunked=False):
+    # e.g. "en_core_web_sm-3.8.0/spacy-3.8.7/features-2", ".../features-2/lite";
+    # features merged from a chunked parse (uploads) are ".../features-2/chunked[/lite]"
+    import spacy
+    meta = nlp.meta
+    version = (f"{meta.get('lang')}_{meta.get('name')}-{meta.get('version')}"
+               f"/spacy-{spacy.about.__version__}/features-{FEATURES_VERSION}")
+    if chunked:
+        version += "/chunked"
+    return version if profile == DEFAULT_PROFILE else f"{version}/{profile}"
+
+
+def encode_features(features):
+    return zlib.compress(json.dumps(features.to_dict(), separators=(",", ":"), ensure_ascii=False).encode("utf-8"))
+
+
+def decode_features(data):
+    return TextFeatures.from_dict(json.loads(zlib.decompress(data)))
+
+
+def load_features(session, input_hash, pipeline):
+    record = session.exec(
+        select(FeatureRecord).where(FeatureRecord.input_hash == input_hash, FeatureRecord.pipeline == pipeline)
+    ).first()
+    return decode_features(record.data) if record else None
+
+
+def load_any_features(session, input_hashes):
+    # input hash -> stored TextFeatures of any pipeline version, for consumers that only
+    # need some features (rebuilds, backfills); full-profile features are preferred
+    rows = session.exec(
+        select(FeatureRecord.input_hash, FeatureRecord.pipeline, FeatureRecord.data)
+        .where(FeatureRecord.input_hash.in_(list(input_hashes)))
+    ).all() if input_hashes else []
+    chosen = {}
+    for input_hash, pipeline, data in rows:
+        if input_hash not in chosen or not pipeline.endswith("/lite"):
+            chosen[input_hash] = data
+    return {input_hash: decode_features(data) for input_hash, data in chosen.items()}
+
+
+def save_features(session, input_hash, pipeline, features):
+    # Committed right away so the parse is kept even if a later stage (e.g. the LLM call) fails
+    session.add(FeatureRecord(input_hash=input_hash, pipeline=pipeline, data=encode_features(features)))
+    try:
+        session.commit()
+    except IntegrityError: # stored concurrently by another request
+        session.rollback()
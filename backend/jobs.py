@@ -0,0 +1,270 @@
+# Background analyses (POST /jobs, GET /jobs/{id}), queued in the AnalysisJob table.
+# Enqueueing is one INSERT: the request returns a job id right away, whatever the
+# analysis will cost. JOB_WORKERS worker loops per app process each claim up to
+# JOB_BATCH queued jobs with a single UPDATE ... RETURNING (SQLite serializes writers,
+# so a job is never claimed twice, also across gunicorn workers) and run them through
+# the same pipeline as /analyze. Throughput is therefore set by the worker count, not by
+# how many clients are waiting.
+#
+# Claimed jobs hold a lease of JOB_LEASE seconds; jobs still running when their lease
+# expires (the process died) are queued again, and fail after JOB_MAX_ATTEMPTS claims.
+# A clean shutdown puts the jobs it was running back into the queue.
+#
+# Waiting: a finished job wakes the long-polls in its own process at once; jobs
+# finished by another process are seen by re-reading the row every JOB_POLL_INTERVAL.
+# Finished jobs are deleted after JOB_RETENTION_HOURS.
+
+import asyncio
+import logging
+import os
+import socket
+import time
+
+from sqlalchemy import delete, update
+from sqlmodel import Session, select
+from starlette.concurrency import run_in_threadpool
+
+from backend import parse_pool, pipeline
+from backend.cache import text_hash
+from backend.database.models import AnalysisJob, AnalysisRecord, engine
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4")) # worker loops per app process (0: enqueue only)
+JOB_BATCH = int(os.getenv("JOB_BATCH", "4")) # jobs claimed (and run concurrently) per loop
+JOB_LEASE = float(os.getenv("JOB_LEASE", "300")) # seconds; longer than any single analysis
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "0.5")) # seconds between checks for other processes' work
+JOB_RETENTION_HOURS = float(os.getenv("JOB_RETENTION_HOURS", "168"))
+HOUSEKEEPING_EVERY = 60 # seconds between lease / retention sweeps
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+FINISHED = (DONE, FAILED)
+
+_wakeup = None # asyncio.Event set when a job is queued in this process
+_waiters = {} # job id -> [asyncio.Event set when this process finishes it, waiting requests]
+_tasks = []
+
+
+def worker_name():
+    # "host:pid" of this process; read when used, since gunicorn imports this module in
+    # the master (preload_app) and the workers are forked from it
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+# --- database ---------------------------------------------------------------
+
+def insert_job(owner_id, text, profile, reuse_similar, threshold):
+    # (id, status) of the new job, or of an identical one of the same owner that has not finished
+    input_hash = text_hash(text)
+    with Session(engine) as session:
+        existing = session.exec(
+            select(AnalysisJob.id, AnalysisJob.status).where(
+                AnalysisJob.input_hash == input_hash, AnalysisJob.owner_id == owner_id,
+                AnalysisJob.profile == profile, AnalysisJob.reuse_similar == reuse_similar,
+                AnalysisJob.similarity_threshold == threshold,
+                AnalysisJob.status.in_((QUEUED, RUNNING)))
+        ).first()
+        if existing is not None:
+            return existing.id, existing.status
+        job = AnalysisJob(owner_id=owner_id, input=text, input_hash=input_hash, profile=profile,
+                          reuse_similar=reuse_similar, similarity_threshold=threshold, created_at=time.time())
+        session.add(job)
+        session.commit()
+        return job.id, QUEUED
+
+
+def claim_jobs(limit):
+    # Marks up to limit queued jobs as running under this process's lease; returns them
+    now = time.time()
+    queued = select(AnalysisJob.id).where(AnalysisJob.status == QUEUED).order_by(AnalysisJob.id).limit(limit)
+    statement = (
+        update(AnalysisJob).where(AnalysisJob.id.in_(queued))
+        .values(status=RUNNING, worker=worker_name(), lease_expires=now + JOB_LEASE,
+                started_at=now, attempts=AnalysisJob.attempts + 1)
+        .returning(AnalysisJob.id, AnalysisJob.owner_id, AnalysisJob.input, AnalysisJob.profile,
+                   AnalysisJob.reuse_similar, AnalysisJob.similarity_threshold)
+    )
+    with engine.begin() as conn:
+        return sorted(conn.execute(statement).all(), key=lambda job: job.id)
+
+
+def finish_job(job_id, status, **result):
+    with engine.begin() as conn:
+        conn.execute(
+            update(AnalysisJob).where(AnalysisJob.id == job_id, AnalysisJob.worker == worker_name())
+            .values(status=status, finished_at=time.time(), lease_expires=None, **result)
+        )
+
+
+def requeue_job(job_id):
+    # Back to the queue without counting the attempt (the parser was busy)
+    with engine.begin() as conn:
+        conn.execute(
+            update(AnalysisJob).where(AnalysisJob.id == job_id, AnalysisJob.worker == worker_name())
+            .values(status=QUEUED, worker=None, lease_expires=None, attempts=AnalysisJob.attempts - 1)
+        )
+
+
+def release_jobs():
+    # Shutdown: jobs this process was running go back to the queue
+    with engine.begin() as conn:
+        conn.execute(
+            update(AnalysisJob).where(AnalysisJob.status == RUNNING, AnalysisJob.worker == worker_name())
+            .values(status=QUEUED, worker=None, lease_expires=None, attempts=AnalysisJob.attempts - 1)
+        )
+
+
+def housekeeping():
+    # Requeues (or fails) jobs with an expired lease and deletes old finished jobs
+    now = time.time()
+    expired = (AnalysisJob.status == RUNNING, AnalysisJob.lease_expires < now)
+    with engine.begin() as conn:
+        conn.execute(
+            update(AnalysisJob).where(*expired, AnalysisJob.attempts >= JOB_MAX_ATTEMPTS)
+            .values(status=FAILED, finished_at=now, lease_expires=None,
+                    error=f"Gave up after {JOB_MAX_ATTEMPTS} attempts.")
+        )
+        requeued = conn.execute(
+            update(AnalysisJob).where(*expired).values(status=QUEUED, worker=None, lease_expires=None)
+        ).rowcount
+        conn.execute(
+            delete(AnalysisJob).where(AnalysisJob.status.in_(FINISHED),
+                                      AnalysisJob.finished_at < now - JOB_RETENTION_HOURS * 3600)
+        )
+    if requeued:
+        logger.warning("Requeued %d jobs whose worker stopped responding", requeued)
+    return requeued
+
+
+def load_job(job_id):
+    # Public view of a job (dict, with the analysis once done), or None. The input is not read.
+    with Session(engine) as session:
+        job = session.exec(
+            select(AnalysisJob.id, AnalysisJob.owner_id, AnalysisJob.status, AnalysisJob.profile,
+                   AnalysisJob.attempts, AnalysisJob.created_at, AnalysisJob.started_at,
+                   AnalysisJob.finished_at, AnalysisJob.record_id, AnalysisJob.language,
+                   AnalysisJob.similarity, AnalysisJob.error)
+            .where(AnalysisJob.id == job_id)
+        ).first()
+        if job is None:
+            return None
+        view = {key: value for key, value in job._mapping.items() if value is not None}
+        if job.status == DONE:
+            view["analysis"] = session.exec(
+                select(AnalysisRecord.output).where(AnalysisRecord.id == job.record_id)).first()
+    return view
+
+
+def record_id_for(text, profile):
+    with Session(engine) as session:
+        return session.exec(select(AnalysisRecord.id).where(
+            AnalysisRecord.input_hash == text_hash(text), AnalysisRecord.profile == profile)).first()
+
+
+# --- workers ----------------------------------------------------------------
+
+async def run_job(job):
+    try:
+        if job.reuse_similar:
+            lang, _, match = await pipeline.analyze_reusing_similar(
+                job.input, job.owner_id, job.profile, job.similarity_threshold)
+        else:
+            (lang, _), match = await pipeline.analyze(job.input, job.owner_id, job.profile), None
+        if match:
+            result = {"record_id": match["record_id"], "similarity": match["similarity"]}
+        else:
+            result = {"record_id": await run_in_threadpool(record_id_for, job.input, job.profile)}
+        await run_in_threadpool(finish_job, job.id, DONE, language=lang, **result)
+    except pipeline.AnalysisError as e:
+        await run_in_threadpool(finish_job, job.id, FAILED, error=str(e))
+    except parse_pool.ParsePoolBusy as e:
+        await run_in_threadpool(requeue_job, job.id)
+        await asyncio.sleep(e.retry_after) # leave the parser to the interactive requests
+        return
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logger.exception("Job %s failed", job.id)
+        await run_in_threadpool(finish_job, job.id, FAILED, error="Internal error.")
+    waiter = _waiters.pop(job.id, None)
+    if waiter is not None:
+        waiter[0].set()
+
+
+async def worker_loop():
+    while True:
+        _wakeup.clear() # before claiming, so a job queued meanwhile is not missed
+        try:
+            claimed = await run_in_threadpool(claim_jobs, JOB_BATCH)
+        except Exception:
+            logger.exception("Claiming jobs failed")
+            claimed = []
+        if claimed:
+            results = await asyncio.gather(*(run_job(job) for job in claimed), return_exceptions=True)
+            for job, result in zip(claimed, results):
+                if isinstance(result, Exception): # left running; requeued when its lease expires
+                    logger.error("Job %s could not be completed: %r", job.id, result)
+            continue
+        try: # queued here: woken at once; queued by another process: seen at the next poll
+            await asyncio.wait_for(_wakeup.wait(), JOB_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def housekeeping_loop():
+    while True:
+        try:
+            await run_in_threadpool(housekeeping)
+        except Exception:
+            logger.exception("Job housekeeping failed")
+        await asyncio.sleep(HOUSEKEEPING_EVERY)
+
+
+def start():
+    # Called from the app's startup, inside the event loop
+    global _wakeup
+    _wakeup = asyncio.Event()
+    if JOB_WORKERS <= 0:
+        return
+    _tasks.append(asyncio.create_task(housekeeping_loop()))
+    _tasks.extend(asyncio.create_task(worker_loop()) for _ in range(JOB_WORKERS))
+
+
+async def stop():
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+    if JOB_WORKERS > 0:
+        await run_in_threadpool(release_jobs)
+
+
+# --- API --------------------------------------------------------------------
+
+async def enqueue(owner_id, text, profile, reuse_similar=False, threshold=None):
+    # (job id, status)
+    job_id, status = await run_in_threadpool(insert_job, owner_id, text, profile, reuse_similar, threshold)
+    if _wakeup is not None:
+        _wakeup.set()
+    return job_id, status
+
+
+async def wait(job_id, timeout):
+    # load_job() once the job has finished or timeout seconds have passed
+    deadline = time.monotonic() + timeout
+    while True:
+        job = await run_in_threadpool(load_job, job_id)
+        remaining = deadline - time.monotonic()
+        if job is None or job["status"] in FINISHED or remaining <= 0:
+            return job
+        waiter = _waiters.setdefault(job_id, [asyncio.Event(), 0])
+        waiter[1] += 1
+        try:
+            await asyncio.wait_for(waiter[0].wait(), min(remaining, JOB_POLL_INTERVAL))
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            waiter[1] -= 1
+            if waiter[1] == 0 and _waiters.get(job_id) is waiter:
+                del _waiters[job_id]
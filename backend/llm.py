@@ -0,0 +1,89 @@
+# Gemini access for the API.
+# Calls go through the async client, so a slow generation only suspends its own
+# request instead of blocking the uvicorn worker's event loop. A semaphore caps
+# how many generations are in flight at once and every call has a timeout.
+
+import asyncio
+import os
+
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL") # e.g. a proxy, or bench/gemini_stub.py
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "8"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60")) # seconds per Gemini call
+
+_client = None # created on first use (google.genai is slow to import)
+_semaphore = None
+in_flight = 0 # generations currently running (observable load)
+
+
+class LLMError(Exception):
+    pass
+
+
+def get_client():
+    global _client
+    if _client is None:
+        from google import genai
+        http_options = {"base_url": GEMINI_BASE_URL} if GEMINI_BASE_URL else None
+        _client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"), http_options=http_options)
+    return _client
+
+
+def _get_semaphore():
+    # created lazily so it belongs to the event loop of the worker that uses it
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(LLM_MAX_IN_FLIGHT)
+    return _semaphore
+
+
+async def generate(prompt, model=None, timeout=None):
+    # Returns the generated text; raises LLMError on failure or timeout
+    global in_flight
+    model = model or GEMINI_MODEL
+    timeout = timeout or LLM_TIMEOUT
+    async with _get_semaphore():
+        in_flight += 1
+        try:
+            response = await asyncio.wait_for(
+                get_client().aio.models.generate_content(model=model, contents=prompt),
+                timeout=timeout,
+            )
+        except asyncio.TimeoutError:
+            raise LLMError(f"timed out after {timeout:g}s")
+        except Exception as e:
+            raise LLMError(str(e)) from e
+        finally:
+            in_flight -= 1
+    return response.text
+
+
+async def generate_stream(prompt, model=None, timeout=None):
+    # Async generator of text chunks as Gemini produces them. The timeout applies to
+    # the wait for each chunk, so long generations are fine as long as they progress.
+    global in_flight
+    model = model or GEMINI_MODEL
+    timeout = timeout or LLM_TIMEOUT
+    async with _get_semaphore():
+        in_flight += 1
+        try:
+            stream = await asyncio.wait_for(
+                get_client().aio.models.generate_content_stream(model=model, contents=prompt),
+                timeout=timeout,
+            )
+            iterator = stream.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(iterator.__anext__(), timeout=timeout)
+                except StopAsyncIteration:
+                    break
+                if chunk.text:
+                    yield chunk.text
+        except asyncio.TimeoutError:
+            raise LLMError(f"timed out after {timeout:g}s")
+        except LLMError:
+            raise
+        except Exception as e:
+            raise LLMError(str(e)) from e
+        finally:
+            in_flight -= 1
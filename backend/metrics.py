@@ -0,0 +1,100 @@
+# Request instrumentation: stage timers, Prometheus metrics and Server-Timing.
+# `with stage("parse"):` times a block; record("parse", seconds) reports a duration
+# measured elsewhere (e.g. inside a parse worker process). Every duration is
+# observed in the t3xt_stage_seconds histogram and, when it happens while serving a
+# request, summed into that request's Server-Timing header by ServerTimingMiddleware
+# (per-request timings live in a context variable, which the threadpool and the
+# analysis tasks inherit).
+# Under gunicorn with several workers, set PROMETHEUS_MULTIPROC_DIR to an empty
+# directory so that /metrics aggregates every worker instead of whichever answered.
+
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest,
+)
+
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+stage_seconds = Histogram("t3xt_stage_seconds", "Time spent in each analysis stage",
+                          ["stage"], buckets=STAGE_BUCKETS)
+cache_requests = Counter("t3xt_cache_requests_total", "Cache lookups by tier (memory, db, features, similar) and result",
+                         ["tier", "result"])
+parse_rejected = Counter("t3xt_parse_rejected_total", "Parses refused because the parser queue was full")
+rate_limited = Counter("t3xt_rate_limited_total", "Requests refused by the rate limiter", ["policy"])
+in_flight = Gauge("t3xt_in_flight", "Work in progress (requests, analyses, parses, llm calls)",
+                  ["kind"], multiprocess_mode="livesum")
+
+_timings = ContextVar("server_timings", default=None) # stage -> seconds for the current request
+
+
+def record(name, seconds):
+    stage_seconds.labels(name).observe(seconds)
+    timings = _timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def current_timings():
+    # stage -> seconds timed so far while serving the current request (None outside one)
+    return _timings.get()
+
+
+def cache_result(tier, hit):
+    cache_requests.labels(tier, "hit" if hit else "miss").inc()
+
+
+def render():
+    # (body, content type) of the Prometheus text exposition
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+def server_timing(timings, total):
+    entries = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in timings.items()]
+    entries.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(entries)
+
+
+class ServerTimingMiddleware:
+    # Pure ASGI; collects the stages timed while a request is handled and sends them
+    # as a Server-Timing header. For streamed responses the header leaves with the
+    # first bytes, so it only lists the stages finished by then.
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        timings = {}
+        token = _timings.set(timings)
+        start = time.perf_counter()
+
+        async def timed_send(message):
+            if message["type"] == "http.response.start":
+                header = server_timing(timings, time.perf_counter() - start)
+                message["headers"] = list(message.get("headers", [])) + [(b"server-timing", header.encode())]
+            await send(message)
+
+        try:
+            with in_flight.labels("requests").track_inprogress():
+                await self.app(scope, receive, timed_send)
+        finally:
+            _timings.reset(token)
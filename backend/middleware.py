@@ -1,97 +1,270 @@
 # This is a custom security layer middleware that enforces Message Integrity
-# and Anti-Replay protection for all sensitive API endpoints. It intercepts 
-# incoming HTTP requests before they reach the route handlers, verifying 
-# that the request was generated by a trusted client and has not been 
-# tampered with during transit. 
+# and Anti-Replay protection for all sensitive API endpoints. It intercepts
+# incoming HTTP requests before they reach the route handlers, verifying
+# that the request was generated by a trusted client and has not been
+# tampered with during transit.
 
 # It uses HMAC-SHA256 hashing
-# and a 300 seconds time window to prevent replay attacks. 
+# and a 300 seconds time window to prevent replay attacks.
 # The key is stored as an environment variable.
 
-# FastAPI is built on top of the Starlette framework, and creating 
-# custom middleware would mean to inherit from BaseHTTPMiddleware.
+# It is a plain ASGI middleware (a class with async __call__(scope, receive, send))
+# rather than a BaseHTTPMiddleware subclass: no extra task and queue per request,
+# and the body is never collected into one bytes object. Each body chunk is fed to
+# the hash as it arrives and handed downstream as the same message object.
+# The signature is always checked before the route handler (and the rate limiter)
+# runs: bodies signed directly are read ahead, up to MAX_SIGNED_BODY_BYTES (16 MiB by
+# default, far above any JSON payload); larger ones (uploads) declare their SHA-256 in
+# the X-rSec-Content-SHA256 header, which is signed in place of the body, and are
+# streamed with the end held back until the body matched that digest. The client side
+# is described in the README ("Request signing").
+# A signature is accepted once: seen signatures are kept until they fall out of
+# the time window, so a captured request cannot be replayed inside it either. They
+# are kept in a SQLite file shared by all worker processes (REPLAY_CACHE_DB).
 
-# https://fastapi.tiangolo.com/tutorial/middleware/
+# https://asgi.readthedocs.io/en/latest/specs/www.html
+# https://www.starlette.io/middleware/#pure-asgi-middleware
 
 
 import hmac
 import hashlib
+import logging
+import sqlite3
 import time
 import os
-from fastapi import FastAPI
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request
+from collections import deque, OrderedDict
+from starlette.datastructures import Headers
 from starlette.responses import JSONResponse
-from starlette.types import Message
-
-class RSignatureMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        secret_key = os.getenv("RSEC_SECRET_KEY") # load from environment variable
-        if not secret_key:
-             return JSONResponse(
-                 status_code=500, 
-                 content={"error": "Server configuration error (Missing rSec Signature Secret)"})
-        # We cannot call response = await call_next(request) because then it goes to the route handler first
-        # and we want to verify the request BEFORE it reaches the route handler. 
-        # (call_next essentially means calling the next middleware in line or the actual route handler).
-        # We will call it at the end after verification.
+
+from backend.database.models import sqlite_file_name
+from backend.shared_store import SharedStore
+
+logger = logging.getLogger(__name__)
+
+TIME_WINDOW_ALLOWED = 300 # Allowed time window setting to prevent replay attacks
+SAFE_PATHS = frozenset(["/docs", "/docs#", "/openapi.json", "/redoc", "/metrics"])
+# Largest body signed directly (read ahead in memory); larger ones must be signed
+# through CONTENT_DIGEST_HEADER
+MAX_SIGNED_BODY_BYTES = int(os.getenv("MAX_SIGNED_BODY_BYTES", str(16 * 1024 * 1024)))
+CONTENT_DIGEST_HEADER = "X-rSec-Content-SHA256" # hex SHA-256 of the body
+REPLAY_CACHE_DB = os.getenv("REPLAY_CACHE_DB", f"{sqlite_file_name}.replay")
+
+
+class SeenSignatures:
+    # Bounded set of accepted signatures, each kept until its request's timestamp
+    # leaves the time window (after that the timestamp check rejects it anyway).
+    # Once full, the oldest entries are dropped first.
+
+    def __init__(self, maxsize=100_000, window=TIME_WINDOW_ALLOWED):
+        self.maxsize = maxsize
+        self.window = window
+        self._data = OrderedDict() # signature -> expires_at (wall clock), oldest first
+
+    def _prune(self, now):
+        while self._data:
+            signature, expires_at = next(iter(self._data.items()))
+            if expires_at >= now and len(self._data) < self.maxsize:
+                break
+            del self._data[signature]
+
+    def __contains__(self, signature):
+        expires_at = self._data.get(signature)
+        return expires_at is not None and expires_at >= time.time()
+
+    def add(self, signature, timestamp):
+        # Records signature; False if it was already seen (a replay)
+        now = time.time()
+        self._prune(now)
+        if signature in self:
+            return False
+        self._data[signature] = max(timestamp, now) + self.window
+        return True
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SharedSeenSignatures:
+    # SeenSignatures in a SQLite file shared by every worker process (backend/shared_store.py),
+    # so a replay sent to another gunicorn worker, or after a restart, is rejected too.
+    # If the store stays locked, the process-local cache stands in for that request.
+    PRUNE_EVERY = 60 # seconds
+
+    def __init__(self, path=REPLAY_CACHE_DB, window=TIME_WINDOW_ALLOWED):
+        self.store = SharedStore(path, [
+            "CREATE TABLE IF NOT EXISTS seen (signature TEXT PRIMARY KEY, expires REAL NOT NULL) WITHOUT ROWID"])
+        self.window = window
+        self.local = SeenSignatures(window=window)
+        self._pruned = 0.0
+
+    def __contains__(self, signature):
+        try:
+            with self.store.connection() as conn:
+                row = conn.execute("SELECT expires FROM seen WHERE signature = ?", (signature,)).fetchone()
+        except sqlite3.Error:
+            return signature in self.local
+        return row is not None and row[0] >= time.time()
+
+    def add(self, signature, timestamp):
+        # Records signature; False if it was already seen (a replay). An expired entry is
+        # taken over; a live one makes the upsert change nothing.
+        now = time.time()
+        try:
+            with self.store.connection() as conn:
+                added = conn.execute(
+                    "INSERT INTO seen (signature, expires) VALUES (?, ?)"
+                    " ON CONFLICT (signature) DO UPDATE SET expires = excluded.expires WHERE seen.expires < ?",
+                    (signature, max(timestamp, now) + self.window, now)).rowcount == 1
+                if now - self._pruned > self.PRUNE_EVERY:
+                    self._pruned = now
+                    conn.execute("DELETE FROM seen WHERE expires < ?", (now,))
+        except sqlite3.Error as e:
+            logger.warning("Shared replay cache unavailable, using this process's: %s", e)
+            return self.local.add(signature, timestamp)
+        return added
+
+
+class _BodyDigest:
+    # Checks a streamed body against the SHA-256 declared in CONTENT_DIGEST_HEADER
+
+    def __init__(self, declared):
+        self.sha = hashlib.sha256()
+        self.declared = declared
+        self.result = None # None until the whole body was hashed, then True / False
+
+    def update(self, message):
+        self.sha.update(message.get("body", b""))
+        if not message.get("more_body", False):
+            self.result = hmac.compare_digest(self.sha.hexdigest(), self.declared)
+
+
+class RSignatureMiddleware:
+    def __init__(self, app, secret_key=None, seen_signatures=None):
+        self.app = app
+        # read once; the 500 below still applies if it is missing
+        secret_key = secret_key or os.getenv("RSEC_SECRET_KEY") # load from environment variable
+        self.secret_key = secret_key.encode() if secret_key else None
+        self.seen = seen_signatures if seen_signatures is not None else SharedSeenSignatures()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        if not self.secret_key:
+            return await self.error(scope, receive, send, 500, "Server configuration error (Missing rSec Signature Secret)")
 
         # 1. Exclude "safe" paths so the middleware doesn't block itself
-        safe_paths = ["/docs", "/docs#", "/openapi.json", "/redoc"]
-        if request.url.path in safe_paths:
-            return await call_next(request)
-        
+        path = scope["path"]
+        if path in SAFE_PATHS:
+            return await self.app(scope, receive, send)
+
         # 2. Get headers
         # In our CORS middleware we need to expose them so client in a browser can see those custom headers
-        rSec_Timestamp = request.headers.get("X-rSec-Timestamp") # time of the request
-        rSec_Signature = request.headers.get("X-rSec-Signature") 
+        headers = Headers(scope=scope)
+        rSec_Timestamp = headers.get("X-rSec-Timestamp") # time of the request
+        rSec_Signature = headers.get("X-rSec-Signature")
         if not rSec_Timestamp or not rSec_Signature:
-            return JSONResponse(status_code=400, content={"error": "Missing Security Headers"})
+            return await self.error(scope, receive, send, 400, "Missing Security Headers")
 
         # 3. Replay protection
         current_time = time.time()
-        time_window_allowed = 300 # Allowed time window setting to prevent replay attacks
         try:
-            # Check for Replay Attack (Drift)
-            if abs(current_time - int(rSec_Timestamp)) > time_window_allowed:
-                return JSONResponse(status_code=403, content={"error": "Request expired."})
+            timestamp = int(rSec_Timestamp)
         except ValueError:
-            return JSONResponse(status_code=400, content={"error": "Invalid Timestamp Format"})
-        
-        # 4. Handle body consumption
-        body_bytes = await request.body()
-        # Create a new receive function for the downstream request
-        async def receive() -> Message:
-            return {"type": "http.request", "body": body_bytes, "more_body": False}
-        # Create a new Request object with the same scope and the new receive function
-        request = Request(request.scope, receive)
-
-        # 5. Reconstruct the signature
-        user_id = request.headers.get("x-user-id")
+            return await self.error(scope, receive, send, 400, "Invalid Timestamp Format")
+        # Check for Replay Attack (Drift)
+        if abs(current_time - timestamp) > TIME_WINDOW_ALLOWED:
+            return await self.error(scope, receive, send, 403, "Request expired.")
+        # Check for Replay Attack (same signed request again); cheap, before any body is read.
+        # The query string is signed with the path, so a signature is never valid for
+        # another query and the signature alone identifies the request.
+        if rSec_Signature in self.seen:
+            return await self.error(scope, receive, send, 403, "Replayed request.")
+
+        user_id = headers.get("x-user-id")
         if not user_id:
-            return JSONResponse(status_code=400, content={"error": "Missing x-user-id header"})
-        method = request.method
-        path = request.url.path
-        body_str = body_bytes.decode()
-
-        message = f"{user_id}.{rSec_Timestamp}.{method}.{path}.{body_str}"
-        reconstructed_signature = hmac.new(
-            secret_key.encode(),
-            message.encode(),
-            hashlib.sha256
-        ).hexdigest()
-
-        # 6. Compare the signatures with hmac.compare_digest
-        if not hmac.compare_digest(rSec_Signature, reconstructed_signature):
-            return JSONResponse(
-                status_code=403,
-                content={"error": "Invalid signature."}
-            )
-        
-        # 7. Putting the reconstructed signature back into the request
-        response = await call_next(request)
-        response.headers["X-rSec-Timestamp"] = str(current_time) # HTTP header must be str
-        response.headers["X-rSec-Signature"] = reconstructed_signature
-        
-        # 8. Pass response
-        return response
\ No newline at end of file
+            return await self.error(scope, receive, send, 400, "Missing x-user-id header")
+
+        # 4. Check the signature: HMAC(key, "{user_id}.{ts}.{method}.{target}." + body) where
+        # target is the path, followed by "?" and the raw query string if there is one,
+        # and body is the hex SHA-256 from CONTENT_DIGEST_HEADER for digest-signed requests
+        target = path
+        if scope.get("query_string"):
+            target += "?" + scope["query_string"].decode("latin-1")
+        mac = hmac.new(self.secret_key, f"{user_id}.{rSec_Timestamp}.{scope['method']}.{target}.".encode(),
+                       hashlib.sha256)
+        pending = deque()
+        declared = headers.get(CONTENT_DIGEST_HEADER)
+        if declared is None:
+            # whole body read ahead and hashed, so the handler only ever sees verified requests
+            check = None
+            size = 0
+            more = True
+            while more:
+                message = await receive()
+                if message["type"] != "http.request":
+                    return # client went away
+                size += len(message.get("body", b""))
+                if size > MAX_SIGNED_BODY_BYTES:
+                    return await self.error(scope, receive, send, 413,
+                                            f"Bodies over {MAX_SIGNED_BODY_BYTES} bytes must be signed "
+                                            f"through the {CONTENT_DIGEST_HEADER} header")
+                mac.update(message.get("body", b""))
+                pending.append(message)
+                more = message.get("more_body", False)
+        else:
+            declared = declared.strip().lower()
+            mac.update(declared.encode())
+            check = _BodyDigest(declared)
+        digest = mac.hexdigest()
+        if not hmac.compare_digest(rSec_Signature.encode(), digest.encode()):
+            return await self.error(scope, receive, send, 403, "Invalid signature.")
+        if not self.seen.add(rSec_Signature, timestamp):
+            return await self.error(scope, receive, send, 403, "Replayed request.")
+
+        # 5. Digest-signed bodies stream to the handler chunk by chunk; the final chunk is
+        # only delivered after the body matched the digest, otherwise the handler sees a disconnect
+        async def verified_receive():
+            if pending:
+                return pending.popleft()
+            if check is not None and check.result is False:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if check is not None and check.result is None and message["type"] == "http.request":
+                check.update(message)
+                if check.result is False:
+                    return {"type": "http.disconnect"}
+            return message
+
+        # 6. Nothing is sent to the client before the body matched: a handler that
+        # answers without reading its whole body waits here for the rest to be hashed
+        state = {"started": False}
+
+        async def signed_send(message):
+            while check is not None and check.result is None:
+                if (await verified_receive())["type"] != "http.request":
+                    break
+            if check is not None and check.result is not True:
+                return
+            if message["type"] == "http.response.start":
+                state["started"] = True
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-rsec-timestamp", str(current_time).encode()), # HTTP header must be str
+                    (b"x-rsec-signature", digest.encode()),
+                ]
+            await send(message)
+
+        # 7. Pass request on
+        def rejected():
+            return check is not None and check.result is False
+
+        try:
+            await self.app(scope, verified_receive, signed_send)
+        except Exception:
+            if not rejected():
+                raise
+        if rejected() and not state["started"]:
+            await self.error(scope, receive, send, 403, f"Body does not match {CONTENT_DIGEST_HEADER}.")
+
+    @staticmethod
+    async def error(scope, receive, send, status_code, error):
+        await JSONResponse(status_code=status_code, content={"error": error})(scope, receive, send)
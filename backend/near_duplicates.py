@@ -0,0 +1,262 @@
+# Near-duplicate lookup over analyzed texts (AnalysisRecord inputs).
+# The exact cache only matches byte-identical (normalized) inputs; resubmissions
+# with changed whitespace, a trailing edit or a different excerpt boundary miss it.
+# Each input is reduced to a MinHash signature: NUM_PERM minima of hashed
+# character shingles (whitespace-collapsed, lowercased, so it works the same for
+# English and Chinese). The fraction of equal minima estimates the Jaccard similarity
+# of two texts' shingle sets. Signatures are split into BANDS bands; texts sharing any
+# band hash become candidates (locality-sensitive hashing), and only those candidates
+# are compared, so a lookup costs BANDS binary searches plus a few row compares
+# however many records there are.
+#
+# The band tables are sorted NumPy arrays (binary-searched) plus a small dict of
+# recent insertions that is merged into them every MERGE_EVERY inserts.
+#
+# Persistence: signatures are appended to a log file next to the database
+# (DATABASE_FILE.minhash-v<SIGNATURE_VERSION>, see backend/record_log.py), one
+# fixed-size entry per record, shared by every worker process; each lookup first
+# reads the entries other workers appended. At startup the log is loaded and records it does not cover yet (older databases)
+# are added in a background thread by one worker.
+# NEAR_DUP_INDEX=false disables the index.
+
+import logging
+import os
+import threading
+
+import numpy as np
+from sqlmodel import Session, select
+
+from backend.cache import normalize_text
+from backend.database.models import AnalysisRecord, engine, sqlite_file_name
+from backend.record_log import RecordLog, RowMap, exclusive
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("NEAR_DUP_INDEX", "true").lower() != "false"
+NEAR_DUP_THRESHOLD = float(os.getenv("NEAR_DUP_THRESHOLD", "0.9")) # default minimum similarity to reuse
+SIGNATURE_VERSION = 1 # bump when anything below changes: old logs are then ignored
+SHINGLE_CHARS = 5
+NUM_PERM = 64
+BANDS = 8 # 8 bands of 8 rows: texts at 0.9 similarity become candidates 99% of the time
+ROWS = NUM_PERM // BANDS
+MAX_CANDIDATES = 5 # matches returned per lookup, most similar first
+MERGE_EVERY = 4096
+HASH_BLOCK = 4096 # shingles hashed per step, bounds the temporary matrix to NUM_PERM x HASH_BLOCK
+
+LOG_ENTRY = np.dtype([("id", "<i8"), ("signature", "<u4", (NUM_PERM,))])
+
+# Fixed seed: signatures must come out the same in every process and after restarts
+_rng = np.random.default_rng(0x5EED + SIGNATURE_VERSION)
+_MUL = _rng.integers(1, 2 ** 63, NUM_PERM, dtype=np.uint64) * np.uint64(2) + np.uint64(1) # odd multipliers
+_ADD = _rng.integers(0, 2 ** 63, NUM_PERM, dtype=np.uint64)
+_SHIFT = np.uint64(32)
+_PRIME = np.uint64(0x100000001B3)
+
+
+def shingle_hashes(text):
+    # Distinct 64-bit hashes of the SHINGLE_CHARS-character windows of text
+    text = " ".join(normalize_text(text).lower().split())
+    codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    width = min(SHINGLE_CHARS, codes.size)
+    if width == 0:
+        return codes
+    count = codes.size - width + 1
+    hashes = np.zeros(count, dtype=np.uint64)
+    for offset in range(width): # polynomial rolling hash, wrapping at 2**64
+        hashes = hashes * _PRIME + codes[offset:offset + count]
+    hashes ^= hashes >> np.uint64(29) # mix the high bits in before the multiply-shift below
+    return np.unique(hashes)
+
+
+def signature(text):
+    # MinHash signature (NUM_PERM uint32), or None for a text without any characters
+    hashes = shingle_hashes(text)
+    if hashes.size == 0:
+        return None
+    result = np.full(NUM_PERM, np.iinfo(np.uint32).max, dtype=np.uint32)
+    for start in range(0, hashes.size, HASH_BLOCK):
+        block = hashes[start:start + HASH_BLOCK]
+        values = ((_MUL[:, None] * block[None, :] + _ADD[:, None]) >> _SHIFT).astype(np.uint32)
+        np.minimum(result, values.min(axis=1), out=result)
+    return result
+
+
+def band_keys(signatures):
+    # (n, NUM_PERM) signatures -> (n, BANDS) 64-bit band hashes
+    rows = signatures.reshape(len(signatures), BANDS, ROWS).astype(np.uint64)
+    keys = np.zeros((len(signatures), BANDS), dtype=np.uint64)
+    for row in range(ROWS):
+        keys = (keys ^ rows[:, :, row]) * _PRIME
+    return keys
+
+
+class MinHashIndex:
+    def __init__(self, path):
+        self.log = RecordLog(path, LOG_ENTRY)
+        self.size = 0
+        self._ids = np.zeros(0, dtype=np.int64) # row -> record id
+        self._signatures = np.zeros((0, NUM_PERM), dtype=np.uint32)
+        self._keys = np.zeros((0, BANDS), dtype=np.uint64)
+        self._rows = RowMap()
+        self._sorted_keys = [np.zeros(0, dtype=np.uint64) for _ in range(BANDS)]
+        self._sorted_rows = [np.zeros(0, dtype=np.int64) for _ in range(BANDS)]
+        self._merged = 0 # rows [0, _merged) are in the sorted arrays
+        self._recent = [{} for _ in range(BANDS)] # band key -> rows, for rows >= _merged
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.size
+
+    def _grow(self, extra):
+        needed = self.size + extra
+        capacity = len(self._ids)
+        if needed <= capacity:
+            return
+        capacity = max(needed, 2 * capacity, 1024)
+        for name in ("_ids", "_signatures", "_keys"):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def _insert(self, ids, signatures):
+        # Adds rows for the ids not indexed yet (caller holds the lock)
+        fresh = self._rows.fresh(ids)
+        if fresh.size == 0:
+            return
+        ids, signatures = ids[fresh], signatures[fresh]
+        self._grow(len(ids))
+        start, stop = self.size, self.size + len(ids)
+        self._ids[start:stop] = ids
+        self._signatures[start:stop] = signatures
+        self._keys[start:stop] = band_keys(signatures)
+        self._rows.set(ids, np.arange(start, stop))
+        self.size = stop
+        if stop - self._merged >= MERGE_EVERY:
+            self._merge()
+        else:
+            for row in range(start, stop):
+                for band, key in enumerate(self._keys[row].tolist()):
+                    self._recent[band].setdefault(key, []).append(row)
+
+    def _merge(self):
+        # Folds every row into the sorted band arrays. The old part is already sorted,
+        # so the stable sort (timsort) merges the two runs in linear time.
+        new_rows = np.arange(self._merged, self.size)
+        for band in range(BANDS):
+            keys = np.concatenate([self._sorted_keys[band], self._keys[self._merged:self.size, band]])
+            rows = np.concatenate([self._sorted_rows[band], new_rows])
+            order = np.argsort(keys, kind="stable")
+            self._sorted_keys[band] = keys[order]
+            self._sorted_rows[band] = rows[order]
+            self._recent[band].clear()
+        self._merged = self.size
+
+    def refresh(self):
+        # Loads the log entries written since the last call (by any process)
+        if not self.log.has_new():
+            return
+        with self._lock:
+            entries = self.log.read_new()
+            self._insert(entries["id"], entries["signature"])
+
+    def add(self, record_id, text):
+        # Indexes one stored record and appends it to the log
+        sig = signature(text)
+        if sig is None:
+            return
+        entry = np.zeros(1, dtype=LOG_ENTRY)
+        entry["id"], entry["signature"] = record_id, sig
+        self.log.append(entry)
+        with self._lock:
+            self._insert(entry["id"], entry["signature"])
+
+    def query(self, text, threshold=NEAR_DUP_THRESHOLD, limit=MAX_CANDIDATES):
+        # [(record id, estimated similarity)] of indexed texts at or above threshold, best first
+        self.refresh()
+        sig = signature(text)
+        if sig is None:
+            return []
+        keys = band_keys(sig[None, :])[0]
+        with self._lock:
+            candidates = set()
+            for band in range(BANDS):
+                # searched with a uint64 key: a Python int would make NumPy convert the whole array
+                key = keys[band:band + 1]
+                sorted_keys = self._sorted_keys[band]
+                lo = sorted_keys.searchsorted(key, side="left")[0]
+                hi = sorted_keys.searchsorted(key, side="right")[0]
+                candidates.update(self._sorted_rows[band][lo:hi].tolist())
+                candidates.update(self._recent[band].get(int(key[0]), ()))
+            if not candidates:
+                return []
+            rows = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+            similarity = (self._signatures[rows] == sig).mean(axis=1)
+            ids = self._ids[rows]
+        order = np.argsort(-similarity, kind="stable")[:limit]
+        return [(int(ids[i]), float(similarity[i])) for i in order if similarity[i] >= threshold]
+
+    def backfill(self, batch_size=1000):
+        # Indexes the stored records missing from the log (all of them for a database
+        # that predates the index). Only one process at a time does this; the record
+        # ids are scanned in pages and only missing inputs are read and decompressed.
+        with exclusive(self.log.path + ".lock") as acquired:
+            if not acquired:
+                return 0
+            self.refresh()
+            last_id = 0
+            added = 0
+            while True:
+                with Session(engine) as session:
+                    ids = session.exec(
+                        select(AnalysisRecord.id).where(AnalysisRecord.id > last_id)
+                        .order_by(AnalysisRecord.id).limit(batch_size)
+                    ).all()
+                    if not ids:
+                        return added
+                    last_id = ids[-1]
+                    missing = [record_id for record_id in ids if record_id not in self._rows]
+                    rows = session.exec(
+                        select(AnalysisRecord.id, AnalysisRecord.input).where(AnalysisRecord.id.in_(missing))
+                    ).all() if missing else []
+                entries = np.zeros(len(rows), dtype=LOG_ENTRY)
+                count = 0
+                for record_id, text in rows:
+                    sig = signature(text)
+                    if sig is not None:
+                        entries[count] = (record_id, sig)
+                        count += 1
+                if count:
+                    self.log.append(entries[:count])
+                    self.refresh()
+                    added += count
+
+
+index = MinHashIndex(f"{sqlite_file_name}.minhash-v{SIGNATURE_VERSION}")
+
+
+def start():
+    # Loads the persisted signatures and indexes missing records in the background
+    if not ENABLED:
+        return
+    index.refresh()
+
+    def run_backfill():
+        try:
+            added = index.backfill()
+        except Exception:
+            logger.exception("Near-duplicate backfill failed")
+            return
+        if added:
+            logger.info("Near-duplicate index: %d records added", added)
+
+    threading.Thread(target=run_backfill, name="near-dup-backfill", daemon=True).start()
+
+
+def add(record_id, text):
+    if ENABLED:
+        index.add(record_id, text)
+
+
+def query(text, threshold=NEAR_DUP_THRESHOLD):
+    return index.query(text, threshold) if ENABLED else []
@@ -0,0 +1,107 @@
+# Resident spaCy pipeline registry.
+# Every language pipeline is loaded once per process, warmed up with a short
+# document, and then shared by all requests. Loading a pipeline takes seconds
+# and allocates hundreds of MB, so it must never happen on the request path
+# more than once (and ideally never: see preload()).
+
+# Multi-worker deployments: uvicorn's own --workers flag spawns fresh
+# interpreters, so nothing loaded in the parent survives. Run under gunicorn
+# with preload_app (see gunicorn.conf.py) instead; the master calls preload()
+# and freeze_for_fork() before forking, and every worker then shares the
+# pipeline pages copy-on-write.
+
+# Pipelines are loaded per feature profile (analyze.PROFILES) with only the components
+# that profile needs; the rest are excluded, so they are neither loaded nor run.
+# No metric uses NER. "lite" also drops the dependency parser, which otherwise
+# provides the sentence boundaries, and splits sentences with the rule-based
+# sentencizer instead. Profiles in PRELOAD_PROFILES are loaded up front, any other
+# on first use.
+
+import gc
+import os
+import threading
+
+from analyze import DEFAULT_PROFILE
+from backend import metrics
+
+# language code (as returned by lang_router.route_language) -> installed spaCy package
+MODEL_NAMES = {
+    "en": "en_core_web_sm",
+    "zh-cn": "zh_core_web_sm",
+}
+
+# Short docs run once after loading so lazily-initialised tables
+# (lexeme cache, vectors, tokenizer rules) are populated before the first request
+WARMUP_TEXTS = {
+    "en": "The quick brown fox jumps over the lazy dog, and then it runs away.",
+    "zh-cn": "我爱自然语言处理，因为它很有趣。",
+}
+
+# profile -> (components excluded when loading, components added after loading).
+# "senter" is the statistical sentence splitter the English model ships disabled.
+PROFILE_COMPONENTS = {
+    "full": (["ner", "senter"], []),
+    "lite": (["parser", "ner", "senter"], ["sentencizer"]),
+}
+PRELOAD_PROFILES = os.getenv("PRELOAD_PROFILES", "full,lite").split(",")
+
+_pipelines = {} # (lang, profile) -> pipeline
+_lock = threading.Lock()
+
+
+def load_model(name, profile=DEFAULT_PROFILE):
+    # spacy.load(name) with the components of profile; name is a package or a path
+    import spacy # heavy import, deferred until a pipeline is actually needed
+    exclude, added = PROFILE_COMPONENTS[profile]
+    nlp = spacy.load(name, exclude=exclude)
+    for component in added:
+        nlp.add_pipe(component)
+    return nlp
+
+
+def _load(lang, profile):
+    with metrics.stage("model_load"):
+        nlp = load_model(MODEL_NAMES[lang], profile)
+        nlp(WARMUP_TEXTS[lang])
+    return nlp
+
+
+def get_nlp(lang, profile=DEFAULT_PROFILE):
+    # Returns the shared pipeline for lang and profile, loading it on first use.
+    # Raises KeyError for languages without a configured model and unknown profiles.
+    key = (lang, profile)
+    nlp = _pipelines.get(key)
+    if nlp is None:
+        with _lock: # double-checked so concurrent first requests load once
+            nlp = _pipelines.get(key)
+            if nlp is None:
+                nlp = _load(lang, profile)
+                _pipelines[key] = nlp
+    return nlp
+
+
+def is_supported(lang):
+    return lang in MODEL_NAMES
+
+
+def loaded_languages():
+    return sorted({lang for lang, _ in _pipelines})
+
+
+def loaded_pipelines():
+    # [(lang, profile)] of the resident pipelines
+    return sorted(_pipelines)
+
+
+def preload(langs=None, profiles=None):
+    # Load (and warm up) every pipeline up front; no-op for ones already resident
+    for lang in langs or MODEL_NAMES:
+        for profile in profiles or PRELOAD_PROFILES:
+            get_nlp(lang, profile.strip())
+
+
+def freeze_for_fork():
+    # Move everything allocated so far into the permanent GC generation so the
+    # collector in forked workers never writes to (and thus copies) those pages.
+    gc.collect()
+    gc.freeze()
@@ -0,0 +1,200 @@
+# Process pool for spaCy parsing.
+# Parsing is CPU-bound, so running it in the request threadpool lets one large text
+# hog the worker's GIL. Here it runs in PARSE_WORKERS child processes that hold the
+# pipelines (forked after nlp_registry.preload(), so the model pages are shared).
+# The number of parses waiting for a worker is bounded: once PARSE_QUEUE_SIZE are
+# queued, new work is rejected with ParsePoolBusy (the API answers 503 + Retry-After)
+# instead of letting latency grow without bound.
+# PARSE_WORKERS=0 disables the pool and parses in the request threadpool. The default
+# divides the CPUs among the app processes (WEB_CONCURRENCY gunicorn workers, each
+# with its own pool), so a host never runs more parser processes than it has CPUs.
+# If a worker dies the pool is replaced in a background thread; requests are refused
+# with ParsePoolBusy until the new one is up. By then the process runs the event loop
+# and other threads, which a forked child could inherit held locks from, so the
+# replacement workers come from a forkserver (a fresh single-threaded process) and
+# load their own copy of the pipelines.
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from starlette.concurrency import run_in_threadpool
+
+from analyze import analyze_batch, DEFAULT_PROFILE, text_features
+from backend import metrics, nlp_registry
+
+logger = logging.getLogger(__name__)
+
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1"))) # app processes (gunicorn.conf.py)
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", str(max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY))))
+PARSE_QUEUE_SIZE = int(os.getenv("PARSE_QUEUE_SIZE", str(4 * max(PARSE_WORKERS, 1))))
+PARSE_RETRY_AFTER = int(os.getenv("PARSE_RETRY_AFTER", "5")) # seconds suggested to rejected clients
+
+_executor = None
+_lock = threading.Lock()
+_pending = 0 # submitted and not yet finished (running + queued)
+_restarting = False # a broken pool is being replaced
+rejected = 0 # total submissions refused because the queue was full
+
+
+class ParsePoolBusy(Exception):
+    def __init__(self, retry_after=PARSE_RETRY_AFTER):
+        super().__init__("Parser queue is full, please retry later.")
+        self.retry_after = retry_after
+
+
+def _parse_in_worker(text, lang, profile):
+    # runs in a pool process; the pipeline is already resident there.
+    # Returns (TextFeatures, {"parse": s, "features": s}) so the parent can report the stages.
+    timings = {}
+    features = text_features(text, nlp_registry.get_nlp(lang, profile), lang, timings=timings, profile=profile)
+    return features, timings
+
+
+def _batch_in_worker(texts, profile, batch_size):
+    # analyze.analyze_batch() in a pool process, with the resident pipelines
+    def get_nlp(lang):
+        return nlp_registry.get_nlp(lang, profile) if nlp_registry.is_supported(lang) else None
+    return analyze_batch(texts, get_nlp, batch_size=batch_size, profile=profile)
+
+
+def _report(timings, started):
+    # stage timings measured in the worker; what remains of the wait was queueing
+    for name, seconds in timings.items():
+        metrics.record(name, seconds)
+    metrics.record("parse_queue", max(0.0, time.perf_counter() - started - sum(timings.values())))
+
+
+def _warm_up():
+    return os.getpid()
+
+
+def _load_pipelines(keys):
+    # Initializer of a restarted pool's workers, which do not inherit the parent's pipelines
+    for lang, profile in keys:
+        nlp_registry.get_nlp(lang, profile)
+
+
+def start(context="fork"):
+    # Creates the pool and forks every worker now, while the process is still quiet
+    # (ProcessPoolExecutor starts all fork-context workers on the first submit).
+    # Other contexts start workers without the parent's memory; they load the
+    # pipelines the parent has loaded before taking work.
+    global _executor
+    if PARSE_WORKERS <= 0 or _executor is not None:
+        return
+    options = {} if context == "fork" else {"initializer": _load_pipelines,
+                                            "initargs": (nlp_registry.loaded_pipelines(),)}
+    _executor = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context(context),
+                                    **options)
+    _executor.submit(_warm_up).result()
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def stats():
+    workers = max(PARSE_WORKERS, 0)
+    busy = min(_pending, workers) if workers else _pending
+    return {
+        "workers": workers,
+        "busy": busy,
+        "queued": max(0, _pending - workers) if workers else 0,
+        "queue_capacity": PARSE_QUEUE_SIZE,
+        "utilization": busy / workers if workers else None,
+        "rejected": rejected,
+        "restarting": _restarting,
+    }
+
+
+def ensure_capacity():
+    # Raises ParsePoolBusy if a new parse would be rejected right now
+    global rejected
+    if _restarting or _executor is not None and _pending >= PARSE_WORKERS + PARSE_QUEUE_SIZE:
+        rejected += 1
+        metrics.parse_rejected.inc()
+        raise ParsePoolBusy()
+
+
+def _finished(_future):
+    global _pending
+    with _lock:
+        _pending -= 1
+
+
+async def _run(fn, *args):
+    # fn(*args) in a pool process (one queue slot); raises ParsePoolBusy when the queue is full
+    global _pending
+    with _lock:
+        executor = _executor
+        if executor is not None or _restarting:
+            ensure_capacity()
+            _pending += 1
+    if executor is None:
+        with metrics.in_flight.labels("parse").track_inprogress():
+            return await run_in_threadpool(fn, *args)
+    try:
+        future = executor.submit(fn, *args)
+    except BrokenProcessPool:
+        _finished(None)
+        _restart(executor)
+        raise ParsePoolBusy()
+    future.add_done_callback(_finished)
+    try:
+        with metrics.in_flight.labels("parse").track_inprogress():
+            return await asyncio.wrap_future(future)
+    except BrokenProcessPool:
+        _restart(executor)
+        raise ParsePoolBusy()
+
+
+async def parse(text, lang, profile=DEFAULT_PROFILE):
+    # TextFeatures for text; raises ParsePoolBusy when the queue is full
+    started = time.perf_counter()
+    features, timings = await _run(_parse_in_worker, text, lang, profile)
+    _report(timings, started)
+    return features
+
+
+async def parse_batch(texts, profile=DEFAULT_PROFILE, batch_size=64, parts=1):
+    # analyze.analyze_batch() results for texts, in input order. The texts are split into
+    # up to `parts` slices (at most one per worker) parsed side by side, each taking a
+    # queue slot like a single parse; raises ParsePoolBusy when the queue is full.
+    parts = max(1, min(parts, PARSE_WORKERS, len(texts)))
+    size = -(-len(texts) // parts) if texts else 1
+    slices = [texts[i:i + size] for i in range(0, len(texts), size)]
+    results = await asyncio.gather(*(_run(_batch_in_worker, part, profile, batch_size) for part in slices))
+    return [result for part in results for result in part]
+
+
+def _restart(broken):
+    # A worker died (e.g. killed for memory): refuse the affected requests and replace
+    # the pool once. The new pool is started and warmed up in a thread of its own, so
+    # the event loop never waits for it.
+    global _executor, _restarting
+    with _lock:
+        if _executor is not broken:
+            return
+        _executor = None
+        _restarting = True
+    broken.shutdown(wait=False, cancel_futures=True)
+    threading.Thread(target=_start_again, name="parse-pool-restart", daemon=True).start()
+
+
+def _start_again():
+    global _restarting
+    try:
+        start("forkserver")
+    except Exception:
+        logger.exception("Restarting the parse pool failed")
+    finally:
+        _restarting = False
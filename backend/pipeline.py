@@ -0,0 +1,335 @@
+# The /analyze pipeline, split into stages.
+# Blocking stages (SQLite, language routing) are plain functions that the async entry
+# point runs in the threadpool, spaCy parsing goes to the process pool
+# (backend/parse_pool.py), so the event loop only ever awaits; the Gemini call
+# uses the async client (backend/llm.py). Each stage opens its own
+# Session because a coalesced analysis can outlive the request that started it.
+
+import codecs
+import logging
+import os
+
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
+from starlette.concurrency import run_in_threadpool
+
+from analyze import build_prompt, prompt_version, DEFAULT_PROFILE, FeatureAccumulator, TextChunker
+from backend import llm, metrics, near_duplicates, nlp_registry, parse_pool, style_index, user_profiles
+import lang_router
+from lang_router import route_language
+from backend.cache import analysis_cache, analysis_flights, text_hash
+from backend.database.models import AnalysisRecord, engine
+from backend.feature_store import pipeline_version, load_features, save_features
+
+
+logger = logging.getLogger(__name__)
+
+
+class AnalysisError(Exception):
+    # Message is safe to return to the client as {"error": ...}
+    pass
+
+
+class UploadTooLarge(AnalysisError):
+    # An upload to be stored exceeds MAX_STORED_UPLOAD_BYTES (the API answers 413)
+    pass
+
+
+def cache_key_for(input_hash, profile=DEFAULT_PROFILE):
+    return (input_hash, llm.GEMINI_MODEL, prompt_version(profile))
+
+
+def upload_cache_key(input_hash, profile=DEFAULT_PROFILE):
+    # Upload analyses are generated from an excerpt and chunked features, so they get
+    # their own prompt version and are never served for /analyze
+    return (input_hash, llm.GEMINI_MODEL, f"{prompt_version(profile)}/upload")
+
+
+def lookup_stored(text, input_hash, cache_key, profile=DEFAULT_PROFILE):
+    # (language, analysis) of the profile's stored record if it matches the current model &
+    # prompt version (only these columns are read: the stored input body is never decompressed here)
+    with metrics.stage("cache_lookup"), Session(engine) as session:
+        record = session.exec(
+            select(AnalysisRecord.language, AnalysisRecord.llm_model,
+                   AnalysisRecord.prompt_version, AnalysisRecord.output)
+            .where(AnalysisRecord.input_hash == input_hash, AnalysisRecord.profile == profile)
+        ).first()
+    hit = bool(record) and (record.llm_model, record.prompt_version) == cache_key[1:]
+    metrics.cache_result("db", hit)
+    if hit:
+        return record.language or route_language(text), record.output
+    return None
+
+
+def lookup_similar(text, cache_key, threshold):
+    # (language, analysis, match) from the most similar stored text whose analysis matches
+    # the current model & prompt version, or None; match is {"record_id", "similarity"}
+    with metrics.stage("similar_lookup"):
+        matches = near_duplicates.query(text, threshold)
+        if matches:
+            with Session(engine) as session:
+                rows = session.exec(
+                    select(AnalysisRecord.id, AnalysisRecord.language, AnalysisRecord.llm_model,
+                           AnalysisRecord.prompt_version, AnalysisRecord.output)
+                    .where(AnalysisRecord.id.in_([record_id for record_id, _ in matches]))
+                ).all()
+            stored = {row.id: row for row in rows}
+            for record_id, similarity in matches:
+                row = stored.get(record_id)
+                if row is not None and (row.llm_model, row.prompt_version) == cache_key[1:]:
+                    metrics.cache_result("similar", True)
+                    return (row.language or route_language(text), row.output,
+                            {"record_id": record_id, "similarity": round(similarity, 3)})
+    metrics.cache_result("similar", False)
+    return None
+
+
+def warm_up():
+    # the langdetect fallback loads its language profiles on first use and that load
+    # is not thread-safe, so do it once before requests start routing in the threadpool
+    lang_router.warm_up()
+
+
+def detect_language(text):
+    with metrics.stage("lang_detect"):
+        lang = route_language(text)
+    if not nlp_registry.is_supported(lang):
+        raise AnalysisError(f"Unsupported language detected: {lang}")
+    return lang
+
+
+def load_stored_features(input_hash, lang, profile):
+    # (pipeline version, stored TextFeatures or None)
+    pipeline = pipeline_version(nlp_registry.get_nlp(lang, profile), profile)
+    with metrics.stage("feature_lookup"), Session(engine) as session:
+        features = load_features(session, input_hash, pipeline)
+    metrics.cache_result("features", features is not None)
+    return pipeline, features
+
+
+def store_features(input_hash, pipeline, features):
+    with metrics.stage("db_commit"), Session(engine) as session:
+        save_features(session, input_hash, pipeline, features)
+
+
+async def prepare_features(text, input_hash, profile=DEFAULT_PROFILE):
+    # (language, TextFeatures); raises AnalysisError for unsupported languages and
+    # parse_pool.ParsePoolBusy when the parser queue is full.
+    lang = await run_in_threadpool(detect_language, text)
+    # Features are cached separately per pipeline version: prompt / model changes skip the parse
+    pipeline, features = await run_in_threadpool(load_stored_features, input_hash, lang, profile)
+    if features is None:
+        features = await parse_pool.parse(text, lang, profile)
+        await run_in_threadpool(store_features, input_hash, pipeline, features)
+    return lang, features
+
+
+def store_analysis(text, input_hash, cache_key, lang, output, owner_id, profile=DEFAULT_PROFILE, features=None):
+    # A new record belongs to owner_id (the user whose request generated the analysis)
+    # and is merged into that user's profile; a refreshed one keeps its owner.
+    # Each profile of a text has its own record.
+    with metrics.stage("db_commit"), Session(engine) as session:
+        # refresh a stale record (older model / prompt version) in place
+        record = session.exec(
+            select(AnalysisRecord).where(AnalysisRecord.input_hash == input_hash, AnalysisRecord.profile == profile)
+        ).first() or AnalysisRecord(input=text, input_hash=input_hash, profile=profile, owner_id=owner_id)
+        is_new = record.id is None
+        record.output = output
+        record.language = lang
+        record.llm_model, record.prompt_version = cache_key[1:]
+        session.add(record)
+        try:
+            if is_new and features is not None:
+                session.flush() # inserts the record (taking the write lock) and assigns its id
+                user_profiles.add_record(session, owner_id, record.id, lang, features)
+            session.commit()
+        except IntegrityError: # stored concurrently by another worker process
+            session.rollback()
+            is_new = False
+        if is_new:
+            near_duplicates.add(record.id, text)
+            if features is not None:
+                style_index.add(record.id, lang, features)
+    analysis_cache.put(cache_key, (lang, output))
+
+
+async def run_analysis(text, input_hash, cache_key, owner_id, profile=DEFAULT_PROFILE):
+    stored = await run_in_threadpool(lookup_stored, text, input_hash, cache_key, profile)
+    if stored:
+        analysis_cache.put(cache_key, stored)
+        return stored
+
+    lang, features = await prepare_features(text, input_hash, profile)
+    with metrics.stage("prompt"):
+        prompt = build_prompt(text, features)
+    logger.debug("Gemini request sent for %s", input_hash)
+    try:
+        with metrics.stage("llm"), metrics.in_flight.labels("llm").track_inprogress():
+            output = await llm.generate(prompt)
+    except llm.LLMError as e:
+        raise AnalysisError(f"AI generation failed: {e}")
+    logger.debug("Gemini response received for %s", input_hash)
+
+    await run_in_threadpool(store_analysis, text, input_hash, cache_key, lang, output, owner_id, profile,
+                            features=features)
+    logger.debug("New analysis cached for %s", input_hash)
+    return lang, output
+
+
+async def analyze(text, owner_id, profile=DEFAULT_PROFILE):
+    # Returns (language, analysis); raises AnalysisError. A new record is stored for owner_id.
+    # In-memory tier first (no DB round-trip, no language routing); identical texts already
+    # being analyzed share that work instead of racing into the cache.
+    # The profile (analyze.PROFILES) selects the metrics, and with them the pipeline.
+    input_hash = text_hash(text)
+    cache_key = cache_key_for(input_hash, profile)
+    cached = analysis_cache.get(cache_key)
+    metrics.cache_result("memory", bool(cached))
+    if cached:
+        return cached
+    return await analysis_flights.run(cache_key, lambda: tracked_analysis(text, input_hash, cache_key, owner_id, profile))
+
+
+async def similar_styles(record_id=None, text=None, k=10):
+    # (language, [(record id, similarity)]): the k stored records of the same language
+    # closest in style to a stored record or to a new text (parsed, or read from the
+    # feature cache; never sent to Gemini)
+    if record_id is not None:
+        stored = style_index.index.vector_of(record_id)
+        if stored is None:
+            raise AnalysisError("Record has no stored features.")
+        lang, vector = stored
+    else:
+        lang, features = await prepare_features(text, text_hash(text))
+        vector = style_index.style_vector(features)
+    with metrics.stage("style_search"):
+        return lang, await run_in_threadpool(style_index.index.search, vector, lang, k, record_id)
+
+
+async def analyze_reusing_similar(text, owner_id, profile=DEFAULT_PROFILE, threshold=near_duplicates.NEAR_DUP_THRESHOLD):
+    # analyze(), except that the stored analysis of a near-duplicate text (estimated
+    # similarity >= threshold, see backend/near_duplicates.py) is served instead of
+    # generating one. Returns (language, analysis, match or None).
+    cache_key = cache_key_for(text_hash(text), profile)
+    similar = await run_in_threadpool(lookup_similar, text, cache_key, threshold)
+    if similar:
+        return similar
+    lang, output = await analyze(text, owner_id, profile)
+    return lang, output, None
+
+
+async def tracked_analysis(text, input_hash, cache_key, owner_id, profile=DEFAULT_PROFILE):
+    with metrics.in_flight.labels("analyses").track_inprogress():
+        return await run_analysis(text, input_hash, cache_key, owner_id, profile)
+
+
+async def analyze_stream(text, owner_id, profile=DEFAULT_PROFILE):
+    # Streaming variant of analyze(): an async generator of event dicts.
+    #   {"event": "meta", "language", "cached"}  first, as soon as it is known
+    #   {"event": "features", "metrics"}         computed metrics (cache misses only)
+    #   {"event": "chunk", "text"}               analysis text, forwarded as Gemini streams it
+    #   {"event": "done"} or {"event": "error", "error"}
+    # Cache hits replay the stored output as a single chunk. Streams are not coalesced;
+    # the record is written once the whole output has been received.
+    input_hash = text_hash(text)
+    cache_key = cache_key_for(input_hash, profile)
+    try:
+        cached = analysis_cache.get(cache_key)
+        metrics.cache_result("memory", bool(cached))
+        cached = cached or await run_in_threadpool(lookup_stored, text, input_hash, cache_key, profile)
+        if cached:
+            analysis_cache.put(cache_key, cached)
+            lang, output = cached
+            yield {"event": "meta", "language": lang, "cached": True}
+            yield {"event": "chunk", "text": output}
+            yield {"event": "done"}
+            return
+
+        lang, features = await prepare_features(text, input_hash, profile)
+        yield {"event": "meta", "language": lang, "cached": False}
+        yield {"event": "features", "metrics": features.summary()}
+
+        with metrics.stage("prompt"):
+            prompt = build_prompt(text, features)
+        chunks = []
+        try:
+            # (the llm stage also covers the time the client takes to read the chunks)
+            with metrics.stage("llm"), metrics.in_flight.labels("llm").track_inprogress():
+                async for chunk in llm.generate_stream(prompt):
+                    chunks.append(chunk)
+                    yield {"event": "chunk", "text": chunk}
+        except llm.LLMError as e:
+            raise AnalysisError(f"AI generation failed: {e}")
+        await run_in_threadpool(store_analysis, text, input_hash, cache_key, lang, "".join(chunks), owner_id,
+                                profile, features=features)
+        yield {"event": "done"}
+    except AnalysisError as e:
+        yield {"event": "error", "error": str(e)}
+    except parse_pool.ParsePoolBusy as e:
+        yield {"event": "error", "error": str(e), "retry_after": e.retry_after}
+
+
+LANG_SAMPLE_CHARS = 10_000 # language is routed on the start of an upload
+# Uploads analyzed with the LLM are stored as records, so their text is kept in memory
+# until then; above this size they are refused rather than held
+MAX_STORED_UPLOAD_BYTES = int(os.getenv("MAX_STORED_UPLOAD_BYTES", str(2 * 1024 * 1024)))
+
+async def analyze_upload(blocks, owner_id, with_llm=False, profile=DEFAULT_PROFILE):
+    # Long-document mode for uploads: blocks is an async iterator of raw UTF-8 bytes
+    # (the request body as it arrives). Text is cut into chunks at paragraph/sentence
+    # boundaries, each chunk is parsed in the process pool and folded into a
+    # FeatureAccumulator, so memory stays flat however large the upload is.
+    # Uploads are not looked up in the cache. With with_llm the analysis is stored as a
+    # record of owner_id, so the text is kept until then and may not exceed
+    # MAX_STORED_UPLOAD_BYTES (UploadTooLarge); features alone are not stored.
+    # Raises AnalysisError / parse_pool.ParsePoolBusy.
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    chunker = TextChunker()
+    state = {"lang": None, "accumulator": None, "excerpt": "", "chunks": 0, "chars": 0}
+    pieces = [] # the decoded text, when it is stored
+    received = 0
+
+    async def consume(chunk):
+        if state["lang"] is None:
+            state["lang"] = await run_in_threadpool(detect_language, chunk[:LANG_SAMPLE_CHARS])
+            state["accumulator"] = FeatureAccumulator(state["lang"], profile)
+            state["excerpt"] = chunk[:500]
+        state["accumulator"].add(await parse_pool.parse(chunk, state["lang"], profile))
+        state["chunks"] += 1
+        state["chars"] += len(chunk)
+
+    async for block in blocks:
+        received += len(block)
+        if with_llm and received > MAX_STORED_UPLOAD_BYTES:
+            raise UploadTooLarge(f"Uploads analyzed with llm=true are limited to {MAX_STORED_UPLOAD_BYTES} bytes.")
+        piece = decoder.decode(block)
+        if with_llm:
+            pieces.append(piece)
+        for chunk in chunker.feed(piece):
+            await consume(chunk)
+    piece = decoder.decode(b"", final=True)
+    if with_llm:
+        pieces.append(piece)
+    for chunk in chunker.feed(piece) + chunker.close():
+        await consume(chunk)
+    if state["accumulator"] is None:
+        raise AnalysisError("No text provided.")
+
+    features = state["accumulator"].result()
+    result = {"language": state["lang"], "chunks": state["chunks"], "chars": state["chars"],
+              "features": features.summary()}
+    if with_llm:
+        with metrics.stage("prompt"):
+            prompt = build_prompt(state["excerpt"], features)
+        try:
+            with metrics.stage("llm"), metrics.in_flight.labels("llm").track_inprogress():
+                result["analysis"] = await llm.generate(prompt)
+        except llm.LLMError as e:
+            raise AnalysisError(f"AI generation failed: {e}")
+        text = "".join(pieces)
+        input_hash = text_hash(text)
+        pipeline = pipeline_version(nlp_registry.get_nlp(state["lang"], profile), profile, chunked=True)
+        await run_in_threadpool(store_features, input_hash, pipeline, features)
+        await run_in_threadpool(store_analysis, text, input_hash, upload_cache_key(input_hash, profile),
+                                state["lang"], result["analysis"], owner_id, f"{profile}/upload", features=features)
+    return result
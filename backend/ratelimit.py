@@ -0,0 +1,135 @@
+# Token-bucket rate limiting for the analysis endpoints, shared by every worker process.
+# Each client (the x-user-id header, checked by the signature middleware, else the
+# client IP) has one bucket per policy: up to `capacity` tokens, refilled continuously
+# at `rate` tokens per second. The buckets live in a small SQLite file next to the
+# database (RATE_LIMIT_DB), so all workers draw from the same buckets and the state
+# survives restarts; a decision is one UPSERT ... RETURNING statement, atomic on its
+# own, that refills, checks and charges the bucket (tens of microseconds).
+# It is kept out of the main database so it never waits behind its write transactions
+# (backend/shared_store.py); if the store stays locked the request is let through.
+#
+# Cost: an /analyze request is admitted for RATE_LIMIT_HIT_COST (cache hits are cheap);
+# if it ended up calling Gemini (an "llm" stage was timed for the request, see
+# backend/metrics.py) the rest of a whole token is charged afterwards, which may leave
+# the bucket in debt. POST /jobs pays the whole token up front since its work happens
+# after the response. RATE_LIMIT=false disables limiting.
+#
+# Must be installed inside metrics.ServerTimingMiddleware, which collects the stages.
+
+import logging
+import math
+import os
+import sqlite3
+import time
+
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
+
+from backend import metrics
+from backend.database.models import sqlite_file_name
+from backend.shared_store import SharedStore
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("RATE_LIMIT", "true").lower() != "false"
+RATE_LIMIT_DB = os.getenv("RATE_LIMIT_DB", f"{sqlite_file_name}.ratelimit")
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "30")) # analyses in a burst
+RATE_LIMIT_PER_DAY = float(os.getenv("RATE_LIMIT_PER_DAY", "500")) # sustained analyses per day
+RATE_LIMIT_HIT_COST = float(os.getenv("RATE_LIMIT_HIT_COST", "0.1")) # tokens per cached analysis
+PRUNE_EVERY = 600 # seconds between deletions of idle buckets
+
+POLICIES = {
+    "analyze": {"capacity": RATE_LIMIT_BURST, "rate": RATE_LIMIT_PER_DAY / 86400,
+                "cost": RATE_LIMIT_HIT_COST, "miss_cost": 1.0},
+    "bulk": {"capacity": 10.0, "rate": 10 / 60, "cost": 1.0, "miss_cost": 1.0}, # 10 per minute
+}
+# POST path -> (policy, charged the miss cost up front)
+ROUTES = {
+    "/analyze": ("analyze", False),
+    "/analyze/stream": ("analyze", False),
+    "/jobs": ("analyze", True),
+    "/analyze/upload": ("bulk", False),
+    "/analyze/batch": ("bulk", False),
+}
+# A bucket left alone this long is full again, so it can be deleted
+IDLE_EXPIRY = max(policy["capacity"] / policy["rate"] for policy in POLICIES.values())
+
+_REFILLED = "min(:capacity, tokens + max(:now - updated, 0) * :rate)"
+TAKE_SQL = f"""
+INSERT INTO bucket (key, tokens, updated, granted) VALUES (:key, :capacity - :cost, :now, 1)
+ON CONFLICT (key) DO UPDATE SET
+    granted = {_REFILLED} >= :cost OR :force,
+    tokens = {_REFILLED} - CASE WHEN {_REFILLED} >= :cost OR :force THEN :cost ELSE 0 END,
+    updated = :now
+RETURNING tokens, granted
+"""
+
+
+class TokenBuckets:
+    def __init__(self, path):
+        self.store = SharedStore(path, [
+            "CREATE TABLE IF NOT EXISTS bucket ("
+            "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, granted INTEGER NOT NULL"
+            ") WITHOUT ROWID"])
+        self._pruned = 0.0
+
+    def take(self, key, policy, cost, force=False):
+        # (granted, tokens left); force charges even a bucket without enough tokens
+        now = time.time()
+        params = {"key": key, "capacity": policy["capacity"], "rate": policy["rate"],
+                  "cost": cost, "now": now, "force": force}
+        with self.store.connection() as conn:
+            tokens, granted = conn.execute(TAKE_SQL, params).fetchone()
+            if now - self._pruned > PRUNE_EVERY:
+                self._pruned = now
+                conn.execute("DELETE FROM bucket WHERE updated < ?", (now - IDLE_EXPIRY,))
+        return bool(granted), tokens
+
+
+buckets = TokenBuckets(RATE_LIMIT_DB)
+
+
+def client_key(scope):
+    user_id = Headers(scope=scope).get("x-user-id")
+    if user_id:
+        return f"user:{user_id}"
+    client = scope.get("client")
+    return f"ip:{client[0] if client else '127.0.0.1'}"
+
+
+class RateLimitMiddleware:
+    # Pure ASGI, like the other middlewares; only the POST routes in ROUTES are limited
+
+    def __init__(self, app, buckets=buckets):
+        self.app = app
+        self.buckets = buckets
+
+    async def __call__(self, scope, receive, send):
+        route = ROUTES.get(scope.get("path")) if scope["type"] == "http" and scope["method"] == "POST" else None
+        if route is None or not ENABLED:
+            return await self.app(scope, receive, send)
+        name, prepaid = route
+        policy = POLICIES[name]
+        key = f"{name}:{client_key(scope)}"
+        cost = policy["miss_cost"] if prepaid else policy["cost"]
+        try:
+            granted, tokens = self.buckets.take(key, policy, cost)
+        except sqlite3.Error as e: # store locked or unavailable: don't fail the request over it
+            logger.warning("Rate limiter unavailable, request let through: %s", e)
+            return await self.app(scope, receive, send)
+        if not granted:
+            metrics.rate_limited.labels(name).inc()
+            retry_after = max(1, math.ceil((cost - tokens) / policy["rate"]))
+            response = JSONResponse(status_code=429,
+                                    content={"error": "Rate limit exceeded. Please try again later."},
+                                    headers={"Retry-After": str(retry_after)})
+            return await response(scope, receive, send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            timings = metrics.current_timings()
+            if not prepaid and policy["miss_cost"] > cost and timings and "llm" in timings:
+                try:
+                    self.buckets.take(key, policy, policy["miss_cost"] - cost, force=True)
+                except sqlite3.Error as e:
+                    logger.warning("Rate limiter unavailable, Gemini call not charged: %s", e)
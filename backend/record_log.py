@@ -0,0 +1,94 @@
+# Shared plumbing for the in-process record indexes (near_duplicates, style_index).
+# Each index persists one fixed-size NumPy entry per AnalysisRecord in an append-only
+# file next to the database. An entry is written with a single O_APPEND write, so
+# every worker process can append the records it stores, and each one picks up the
+# others' entries by reading the tail it has not seen yet.
+
+import fcntl
+import os
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class RecordLog:
+    def __init__(self, path, dtype):
+        self.path = path
+        self.dtype = dtype
+        self.offset = 0 # bytes already read by this process
+
+    def append(self, entries):
+        if len(entries) == 0:
+            return
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, entries.astype(self.dtype, copy=False).tobytes())
+        finally:
+            os.close(fd)
+
+    def has_new(self):
+        # Cheap check (one stat) for entries written since the last read_new()
+        try:
+            return os.path.getsize(self.path) - self.offset >= self.dtype.itemsize
+        except OSError:
+            return False
+
+    def read_new(self):
+        # Entries written since the last call, by any process; a partially written
+        # entry at the end is left for the next call
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return np.zeros(0, dtype=self.dtype)
+        count = (size - self.offset) // self.dtype.itemsize
+        if count <= 0:
+            return np.zeros(0, dtype=self.dtype)
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            entries = np.fromfile(f, dtype=self.dtype, count=count)
+        self.offset += len(entries) * self.dtype.itemsize
+        return entries
+
+
+@contextmanager
+def exclusive(path):
+    # Yields True in the one process that holds the lock file, False elsewhere
+    with open(path, "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+
+
+class RowMap:
+    # record id -> row of an index, as a flat array indexed by id (-1: not indexed).
+    # Record ids are dense SQLite rowids, so this is 8 bytes per record.
+
+    def __init__(self):
+        self._rows = np.full(0, -1, dtype=np.int64)
+
+    def get(self, record_id):
+        if 0 <= record_id < len(self._rows):
+            row = int(self._rows[record_id])
+            return row if row >= 0 else None
+        return None
+
+    def __contains__(self, record_id):
+        return self.get(record_id) is not None
+
+    def fresh(self, ids):
+        # Positions in ids of the first occurrence of every id not mapped yet, in order
+        if len(ids) == 0:
+            return np.zeros(0, dtype=np.int64)
+        top = int(ids.max())
+        if top >= len(self._rows):
+            rows = np.full(max(top + 1, 2 * len(self._rows)), -1, dtype=np.int64)
+            rows[:len(self._rows)] = self._rows
+            self._rows = rows
+        _, first = np.unique(ids, return_index=True) # a log may hold an id twice
+        return np.sort(first[self._rows[ids[first]] < 0])
+
+    def set(self, ids, rows):
+        self._rows[ids] = rows
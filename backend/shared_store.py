@@ -0,0 +1,38 @@
+# Small SQLite files shared by all worker processes of the host, for state that must be
+# the same in every worker and survive restarts but is too hot for the main database
+# (rate-limit buckets, the signature replay cache). Each process opens one autocommit
+# connection on first use, i.e. after gunicorn forked it, and serializes its own
+# statements with a lock; single statements are atomic across processes.
+# A write waits at most BUSY_TIMEOUT for another process and then raises sqlite3.Error,
+# which callers handle rather than stall the event loop.
+
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+BUSY_TIMEOUT = 0.05 # seconds
+
+
+class SharedStore:
+    def __init__(self, path, schema):
+        self.path = path
+        self.schema = schema # CREATE TABLE IF NOT EXISTS ... statements
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            for statement in self.schema:
+                conn.execute(statement)
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    @contextmanager
+    def connection(self):
+        with self._lock:
+            yield self._connection()
@@ -0,0 +1,352 @@
+# Style-similarity search over stored features.
+# Every analyzed record's TextFeatures are reduced to a fixed-length vector:
+#   - POS, dependency and verb-tag distributions over fixed label lists (plus an
+#     "other" slot each), as square roots of their shares, so each block has unit
+#     length and dot products between blocks are Hellinger affinities;
+#   - sentence length, token length and clauses per sentence (average, stdev,
+#     oscillation), log-scaled into roughly [0, 1].
+# The blocks are weighted, concatenated and L2-normalized, so cosine similarity is a
+# plain dot product. Vectors are kept as float16 rows of one array (~150 bytes per
+# record) and persisted in an append-only log next to the database
+# (DATABASE_FILE.style-v<VECTOR_VERSION>, see backend/record_log.py).
+#
+# Search is brute force (blocked matrix products) up to IVF_MIN_ROWS records. Above
+# that the rows are partitioned around k-means centroids (an inverted file): a query
+# scans only the IVF_PROBES nearest partitions, plus the rows added since the last
+# partitioning. Results are restricted to the query's language.
+# Training and partitioning run in a background thread on a snapshot of the rows, and
+# searches keep using the previous partitions (or brute force) meanwhile. The centroids
+# are trained by one process and saved next to the log (.centroids.npz); the other
+# processes load them and only partition their own rows.
+# STYLE_INDEX=false disables the index.
+
+import logging
+import math
+import os
+import threading
+
+import numpy as np
+from sqlmodel import Session, select
+
+from backend.database.models import AnalysisRecord, engine, sqlite_file_name
+from backend.feature_store import load_any_features
+from backend.record_log import RecordLog, RowMap, exclusive
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("STYLE_INDEX", "true").lower() != "false"
+VECTOR_VERSION = 1 # bump when the vector layout changes: old logs are then ignored
+
+LANGUAGES = ("en", "zh-cn") # stored as their position; -1 for anything else
+POS_LABELS = ("ADJ", "ADP", "ADV", "AUX", "CCONJ", "DET", "INTJ", "NOUN", "NUM", "PART",
+              "PRON", "PROPN", "PUNCT", "SCONJ", "SYM", "VERB", "X")
+# English (ClearNLP) and Chinese (UD-style) labels seen most often in our corpus
+DEP_LABELS = ("ROOT", "acl", "acomp", "advcl", "advmod", "amod", "appos", "attr", "aux", "auxpass",
+              "case", "cc", "ccomp", "compound", "conj", "cop", "dep", "det", "dobj", "mark", "neg",
+              "nmod", "npadvmod", "nsubj", "nsubjpass", "nummod", "pcomp", "pobj", "poss", "prep",
+              "prt", "punct", "relcl", "xcomp", "compound:nn", "nmod:assmod", "nmod:prep",
+              "nmod:tmod", "mark:clf", "advmod:rcomp", "asp", "clf", "discourse", "etc")
+VERB_TAGS = ("VB", "VBD", "VBG", "VBN", "VBP", "VBZ", "VV", "VA", "VC", "VE")
+STAT_SCALES = (("sent_length_variance", 100), ("token_length_variance", 20), ("clause_freq_variance", 10))
+BLOCK_WEIGHTS = {"pos": 1.0, "dep": 1.0, "verb": 0.5, "stats": 1.0}
+DIM = len(POS_LABELS) + len(DEP_LABELS) + len(VERB_TAGS) + 3 + 3 * len(STAT_SCALES)
+
+IVF_MIN_ROWS = int(os.getenv("STYLE_IVF_MIN_ROWS", "50000"))
+IVF_PROBES = int(os.getenv("STYLE_IVF_PROBES", "8"))
+IVF_TRAIN_SAMPLE = 20000
+IVF_ITERATIONS = 10
+REPARTITION_EVERY = 10000 # rows added before the unpartitioned tail is assigned
+SCAN_BLOCK = 65536 # rows converted to float32 at a time during brute force
+
+LOG_ENTRY = np.dtype([("id", "<i8"), ("lang", "i1"), ("vector", "<f2", (DIM,))])
+
+
+def _shares(counter, labels):
+    # sqrt of each label's share, plus one slot for every other label
+    total = sum(counter.values())
+    values = np.zeros(len(labels) + 1, dtype=np.float32)
+    if not total:
+        return values
+    for i, label in enumerate(labels):
+        values[i] = counter.get(label, 0)
+    values[-1] = total - values[:-1].sum()
+    return np.sqrt(values / total)
+
+
+def style_vector(features):
+    # Unit-length float32 vector of a TextFeatures (dependency blocks stay zero for "lite")
+    stats = []
+    for name, scale in STAT_SCALES:
+        variance = getattr(features, name) or {}
+        stats += [math.log1p(variance.get('average', 0)) / math.log1p(scale),
+                  math.log1p(variance.get('stdev', 0)) / math.log1p(scale),
+                  variance.get('oscillation_ratio', 0)]
+    has_dependencies = features.has_dependencies()
+    vector = np.concatenate([
+        BLOCK_WEIGHTS["pos"] * _shares(features.pos_freq, POS_LABELS),
+        BLOCK_WEIGHTS["dep"] * (_shares(features.dep_freq, DEP_LABELS) if has_dependencies
+                                else np.zeros(len(DEP_LABELS) + 1, dtype=np.float32)),
+        BLOCK_WEIGHTS["verb"] * _shares(features.verb_tense_freq, VERB_TAGS),
+        BLOCK_WEIGHTS["stats"] * np.array(stats, dtype=np.float32) / math.sqrt(len(stats)),
+    ]).astype(np.float32)
+    if not has_dependencies: # clause statistics were not computed either
+        vector[-3:] = 0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def language_code(lang):
+    return LANGUAGES.index(lang) if lang in LANGUAGES else -1
+
+
+def _top_k(rows, scores, k):
+    if len(rows) > k:
+        keep = np.argpartition(-scores, k)[:k]
+        rows, scores = rows[keep], scores[keep]
+    order = np.argsort(-scores, kind="stable")
+    return rows[order], scores[order]
+
+
+def _kmeans(sample, clusters, iterations=IVF_ITERATIONS, seed=0):
+    # Spherical k-means: unit centroids, assignment by largest dot product
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(len(sample), clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        norms = np.linalg.norm(sums, axis=1)
+        filled = norms > 0 # an empty cluster keeps its previous centroid
+        centroids[filled] = sums[filled] / norms[filled, None]
+    return centroids
+
+
+def _train(vectors):
+    # ~sqrt(n) centroids computed from a sample of the rows
+    clusters = max(16, int(math.sqrt(len(vectors))))
+    rng = np.random.default_rng(len(vectors))
+    sample_rows = rng.choice(len(vectors), min(len(vectors), IVF_TRAIN_SAMPLE, clusters * 64), replace=False)
+    return _kmeans(vectors[np.sort(sample_rows)].astype(np.float32), clusters)
+
+
+def _partition(vectors, centroids):
+    # (rows grouped by nearest centroid, start of each centroid's group)
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), SCAN_BLOCK):
+        block = vectors[start:start + SCAN_BLOCK].astype(np.float32)
+        assignment[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    list_rows = np.argsort(assignment, kind="stable")
+    return list_rows, np.searchsorted(assignment[list_rows], np.arange(len(centroids) + 1))
+
+
+class StyleIndex:
+    def __init__(self, path):
+        self.log = RecordLog(path, LOG_ENTRY)
+        self.size = 0
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._langs = np.zeros(0, dtype=np.int8)
+        self._vectors = np.zeros((0, DIM), dtype=np.float16)
+        self._rows = RowMap()
+        # inverted file, built once the index holds IVF_MIN_ROWS rows
+        self._centroids = None
+        self._trained_size = 0
+        self._list_rows = np.zeros(0, dtype=np.int64) # partitioned rows, grouped by centroid
+        self._list_starts = np.zeros(1, dtype=np.int64) # centroid c owns _list_rows[starts[c]:starts[c + 1]]
+        self._partitioned = 0 # rows [0, _partitioned) are in the lists
+        self._rebuilding = False # a background thread is training / partitioning
+        self._lock = threading.Lock()
+        self.centroids_path = path + ".centroids.npz"
+
+    def __len__(self):
+        return self.size
+
+    def _grow(self, extra):
+        needed = self.size + extra
+        capacity = len(self._ids)
+        if needed <= capacity:
+            return
+        capacity = max(needed, 2 * capacity, 1024)
+        for name in ("_ids", "_langs", "_vectors"):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def _insert(self, entries):
+        # Adds the entries whose ids are not indexed yet (caller holds the lock)
+        fresh = self._rows.fresh(entries["id"])
+        if fresh.size == 0:
+            return
+        entries = entries[fresh]
+        self._grow(len(entries))
+        start, stop = self.size, self.size + len(entries)
+        self._ids[start:stop] = entries["id"]
+        self._langs[start:stop] = entries["lang"]
+        self._vectors[start:stop] = entries["vector"]
+        self._rows.set(entries["id"], np.arange(start, stop))
+        self.size = stop
+        if not self._rebuilding and (self._needs_training(self.size) or self._centroids is not None
+                                     and self.size - self._partitioned >= REPARTITION_EVERY):
+            self._rebuilding = True
+            threading.Thread(target=self._rebuild, name="style-ivf", daemon=True).start()
+
+    def _dense(self, rows):
+        return self._vectors[rows].astype(np.float32)
+
+    def _needs_training(self, size):
+        return size >= IVF_MIN_ROWS and size >= 2 * self._trained_size
+
+    def _rebuild(self):
+        # Background thread: (re)trains the centroids if due, then partitions the rows
+        # present when it started. Rows are never changed once inserted, so the snapshot
+        # is read without the lock; the result is swapped in under it.
+        try:
+            with self._lock:
+                size, vectors = self.size, self._vectors[:self.size]
+                centroids, trained_size = self._centroids, self._trained_size
+            if self._needs_training(size):
+                trained = self._shared_centroids(vectors)
+                if trained is None:
+                    return # being trained by another process; loaded on a later insert
+                centroids, trained_size = trained
+            list_rows, list_starts = _partition(vectors, centroids)
+            with self._lock:
+                self._centroids, self._trained_size = centroids, trained_size
+                self._list_rows, self._list_starts = list_rows, list_starts
+                self._partitioned = size
+        except Exception:
+            logger.exception("Style index partitioning failed")
+        finally:
+            self._rebuilding = False
+
+    def _shared_centroids(self, vectors):
+        # (centroids, rows trained on): the saved ones if still current for this many
+        # rows, else newly trained and saved; None while another process trains them
+        saved = self._load_centroids()
+        if saved is not None and len(vectors) < 2 * saved[1]:
+            return saved
+        with exclusive(self.centroids_path + ".lock") as acquired:
+            if not acquired:
+                return None
+            saved = self._load_centroids() # saved by another process since the check above
+            if saved is not None and len(vectors) < 2 * saved[1]:
+                return saved
+            centroids = _train(vectors)
+            tmp = self.centroids_path + f".{os.getpid()}.tmp.npz"
+            np.savez(tmp, centroids=centroids, trained_size=len(vectors))
+            os.replace(tmp, self.centroids_path)
+        return centroids, len(vectors)
+
+    def _load_centroids(self):
+        try:
+            with np.load(self.centroids_path) as saved:
+                if saved["centroids"].shape[1:] != (DIM,):
+                    return None
+                return saved["centroids"], int(saved["trained_size"])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def refresh(self):
+        if not self.log.has_new():
+            return
+        with self._lock:
+            self._insert(self.log.read_new())
+
+    def add(self, record_id, lang, features):
+        entry = np.zeros(1, dtype=LOG_ENTRY)
+        entry["id"], entry["lang"], entry["vector"] = record_id, language_code(lang), style_vector(features)
+        self.log.append(entry)
+        with self._lock:
+            self._insert(entry)
+
+    def vector_of(self, record_id):
+        # (language, vector) of an indexed record, or None
+        self.refresh()
+        row = self._rows.get(record_id)
+        if row is None:
+            return None
+        code = int(self._langs[row])
+        return (LANGUAGES[code] if code >= 0 else None), self._vectors[row].astype(np.float32)
+
+    def _candidates(self, query):
+        # Rows to score: everything, or the nearest partitions plus the unpartitioned tail
+        if self._centroids is None:
+            return None
+        nearest = np.argsort(-(self._centroids @ query))[:IVF_PROBES]
+        parts = [self._list_rows[self._list_starts[c]:self._list_starts[c + 1]] for c in nearest]
+        parts.append(np.arange(self._partitioned, self.size))
+        return np.concatenate(parts)
+
+    def search(self, query, lang=None, k=10, exclude_id=None):
+        # [(record id, cosine similarity)] of the k closest vectors, best first
+        self.refresh()
+        code = language_code(lang) if lang is not None else None
+        with self._lock:
+            candidates = self._candidates(query)
+            best_rows, best_scores = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+            blocks = ([candidates[i:i + SCAN_BLOCK] for i in range(0, len(candidates), SCAN_BLOCK)]
+                      if candidates is not None else
+                      [np.arange(i, min(i + SCAN_BLOCK, self.size)) for i in range(0, self.size, SCAN_BLOCK)])
+            for rows in blocks:
+                if code is not None:
+                    rows = rows[self._langs[rows] == code]
+                if exclude_id is not None:
+                    rows = rows[self._ids[rows] != exclude_id]
+                scores = self._dense(rows) @ query
+                best_rows, best_scores = _top_k(np.concatenate([best_rows, rows]),
+                                                np.concatenate([best_scores, scores]), k)
+            ids = self._ids[best_rows]
+        return [(int(record_id), round(float(score), 4)) for record_id, score in zip(ids, best_scores)]
+
+    def backfill(self, batch_size=1000):
+        # Indexes stored records missing from the log from their stored features
+        # (records without any are skipped). One process at a time, like near_duplicates.
+        with exclusive(self.log.path + ".lock") as acquired:
+            if not acquired:
+                return 0
+            self.refresh()
+            last_id = 0
+            added = 0
+            while True:
+                with Session(engine) as session:
+                    rows = session.exec(
+                        select(AnalysisRecord.id, AnalysisRecord.input_hash, AnalysisRecord.language)
+                        .where(AnalysisRecord.id > last_id).order_by(AnalysisRecord.id).limit(batch_size)
+                    ).all()
+                    if not rows:
+                        return added
+                    last_id = rows[-1].id
+                    missing = [row for row in rows if row.id not in self._rows and row.input_hash is not None]
+                    features = load_any_features(session, {row.input_hash for row in missing})
+                missing = [row for row in missing if row.input_hash in features]
+                entries = np.zeros(len(missing), dtype=LOG_ENTRY)
+                for i, row in enumerate(missing):
+                    entries[i] = (row.id, language_code(row.language), style_vector(features[row.input_hash]))
+                self.log.append(entries)
+                self.refresh()
+                added += len(entries)
+
+
+index = StyleIndex(f"{sqlite_file_name}.style-v{VECTOR_VERSION}")
+
+
+def start():
+    if not ENABLED:
+        return
+    index.refresh()
+
+    def run_backfill():
+        try:
+            added = index.backfill()
+        except Exception:
+            logger.exception("Style index backfill failed")
+            return
+        if added:
+            logger.info("Style index: %d records added", added)
+
+    threading.Thread(target=run_backfill, name="style-backfill", daemon=True).start()
+
+
+def add(record_id, lang, features):
+    if ENABLED:
+        index.add(record_id, lang, features)
@@ -0,0 +1,157 @@
+# Per-user style profiles: the features of every record a user owns, merged into one
+# row (UserStyleProfile). Frequency tables are summed and the sentence length, token
+# length and clause series are merged as RunningStats (analyze.FeatureAccumulator), so
+# the profile's stats are exactly variance_measures() of the user's series concatenated
+# in record order. Lemma counts keep the PROFILE_MAX_LEMMAS most frequent lemmas, which
+# bounds the row whatever the vocabulary.
+#
+# The row is updated in the transaction that inserts each new record
+# (pipeline.store_analysis), so GET /users/{id}/profile reads one row however many
+# records the user has. Records stored without features (POST /records/) are not
+# counted; "lite" records add nothing to the dependency metrics.
+#
+# Rebuilding from the stored features (FeatureRecord), e.g. for a database that
+# predates the profiles or after a FEATURES_VERSION bump:
+#   python -m backend.user_profiles              # every user
+#   python -m backend.user_profiles --user 3
+
+import argparse
+import json
+import os
+import sys
+import zlib
+from collections import Counter
+
+from dotenv import load_dotenv
+load_dotenv() # before the backend modules below read their settings (when run as a command)
+
+from sqlmodel import Session, select
+
+from analyze import FeatureAccumulator, TextFeatures
+from backend.database.models import AnalysisRecord, User, UserStyleProfile, create_db_and_tables, engine
+from backend.feature_store import load_any_features
+
+PROFILE_MAX_LEMMAS = int(os.getenv("PROFILE_MAX_LEMMAS", "2000"))
+PROFILE_TOP_LEMMAS = 20 # lemmas listed by GET /users/{id}/profile
+
+
+class Aggregate:
+    # A user's merged features while they are being updated
+    def __init__(self, profile=None):
+        self.features = FeatureAccumulator(None)
+        self.languages = Counter()
+        if profile is not None and profile.data:
+            data = json.loads(zlib.decompress(profile.data))
+            self.languages.update(data["languages"])
+            self.features.add(TextFeatures.from_dict(data["features"]))
+
+    def add(self, lang, features):
+        self.features.add(features)
+        self.languages[lang or "unknown"] += 1
+
+    def result(self):
+        features = self.features.result()
+        features.lemma_freq = Counter(dict(features.lemma_freq.most_common(PROFILE_MAX_LEMMAS)))
+        return features
+
+    def encode(self):
+        data = {"languages": dict(self.languages), "features": self.result().to_dict()}
+        return zlib.compress(json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8"))
+
+
+def add_record(session, owner_id, record_id, lang, features):
+    # Merges one new record into its owner's profile. Called inside the transaction that
+    # inserted the record, after the insert: that write holds SQLite's write lock, so
+    # concurrent updates of the same profile (other workers) cannot interleave.
+    profile = session.get(UserStyleProfile, owner_id)
+    if profile is not None and profile.last_record_id >= record_id:
+        return # already merged by a rebuild
+    aggregate = Aggregate(profile)
+    aggregate.add(lang, features)
+    profile = profile or UserStyleProfile(user_id=owner_id)
+    profile.records += 1
+    profile.last_record_id = record_id
+    profile.data = aggregate.encode()
+    session.add(profile)
+
+
+def load_profile(user_id):
+    # Summary of a user's profile (an empty one if nothing was merged yet)
+    with Session(engine) as session:
+        profile = session.get(UserStyleProfile, user_id)
+        aggregate = Aggregate(profile)
+        records = profile.records if profile else 0
+    features = aggregate.result()
+    return {
+        "user_id": user_id,
+        "records": records,
+        "languages": dict(aggregate.languages),
+        "sentence_length": features.sent_length_variance,
+        "token_length": features.token_length_variance,
+        "clauses_per_sentence": features.clause_freq_variance,
+        "pos_freq": dict(features.pos_freq),
+        "dep_freq": dict(features.dep_freq),
+        "verb_tense_freq": dict(features.verb_tense_freq),
+        "lemma_freq": features.lemma_freq.most_common(PROFILE_TOP_LEMMAS),
+    }
+
+
+def _merge_records(session, aggregate, user_id, after_id, limit=None):
+    # Adds the user's records with id > after_id (and stored features) in id order;
+    # returns (records merged, last id seen)
+    query = (select(AnalysisRecord.id, AnalysisRecord.input_hash, AnalysisRecord.language)
+             .where(AnalysisRecord.owner_id == user_id, AnalysisRecord.id > after_id)
+             .order_by(AnalysisRecord.id))
+    rows = session.exec(query.limit(limit) if limit else query).all()
+    features = load_any_features(session, [row.input_hash for row in rows if row.input_hash])
+    merged = 0
+    for row in rows:
+        if row.input_hash in features:
+            aggregate.add(row.language, features[row.input_hash])
+            merged += 1
+    return merged, rows[-1].id if rows else after_id
+
+
+def rebuild(user_id, batch_size=1000):
+    # Recomputes a user's profile from the stored features; returns the records merged.
+    # The bulk is read without holding a lock; the records stored meanwhile are merged
+    # after the profile row has been written, i.e. under the write lock, then committed.
+    aggregate = Aggregate()
+    records, last_id = 0, 0
+    while True:
+        with Session(engine) as session:
+            merged, next_id = _merge_records(session, aggregate, user_id, last_id, batch_size)
+        records += merged
+        if next_id == last_id:
+            break
+        last_id = next_id
+    with Session(engine) as session:
+        profile = session.get(UserStyleProfile, user_id) or UserStyleProfile(user_id=user_id)
+        profile.data = b"" # placeholder; the write below takes the lock
+        session.add(profile)
+        session.flush()
+        merged, last_id = _merge_records(session, aggregate, user_id, last_id)
+        records += merged
+        profile.records = records
+        profile.last_record_id = last_id
+        profile.data = aggregate.encode()
+        session.commit()
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute per-user style profiles from the stored features.")
+    parser.add_argument("--user", type=int, action="append", help="user id (repeatable; default: every user)")
+    args = parser.parse_args()
+    create_db_and_tables()
+    user_ids = args.user
+    if not user_ids:
+        with Session(engine) as session:
+            user_ids = session.exec(select(User.id).order_by(User.id)).all()
+    for user_id in user_ids:
+        print(f"user {user_id}: {rebuild(user_id)} records", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,81 @@
+# Benchmark: per-token Python extractor vs. the NumPy (Doc.to_array) backend.
+# Parses each input/ sample scaled up to several sizes once, then times only the
+# feature extraction step and checks that both backends return identical results.
+#
+# Usage (from the repo root):
+#   python -m bench.bench_features                      # models from backend/nlp_registry.py
+#   python -m bench.bench_features --model en=/path/to/pipeline --sizes 1 10 100
+
+import argparse
+import glob
+import os
+import time
+
+from tabulate import tabulate
+
+from analyze import extract_features
+from analyze_numpy import extract_features_np
+
+SAMPLES = {
+    "english_sample.txt": "en",
+    "chinese_sample.txt": "zh-cn",
+    "borges_chinese_sample.txt": "zh-cn",
+    "eileen_zhang_sample.txt": "zh-cn",
+    "shuihuzhuan.txt": "zh-cn",
+}
+
+
+def best_of(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def load_pipeline(lang, overrides, profile="full"):
+    from backend import nlp_registry
+    if lang in overrides:
+        return nlp_registry.load_model(overrides[lang], profile)
+    return nlp_registry.get_nlp(lang, profile)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--input-dir", default="input")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100],
+                        help="how many times each sample is repeated")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--model", action="append", default=[],
+                        help="lang=name_or_path to override a registry pipeline")
+    args = parser.parse_args()
+    overrides = dict(item.split("=", 1) for item in args.model)
+
+    pipelines = {}
+    rows = []
+    for path in sorted(glob.glob(os.path.join(args.input_dir, "*.txt"))):
+        lang = SAMPLES.get(os.path.basename(path))
+        if lang is None:
+            continue
+        if lang not in pipelines:
+            pipelines[lang] = load_pipeline(lang, overrides)
+        nlp = pipelines[lang]
+        with open(path, "r", encoding="utf-8") as f:
+            sample = f.read()
+        for size in args.sizes:
+            text = "\n".join([sample] * size)
+            nlp.max_length = max(nlp.max_length, len(text) + 1)
+            doc = nlp(text)
+            if extract_features(doc, lang) != extract_features_np(doc, lang):
+                raise SystemExit(f"backends disagree on {path} x{size}")
+            t_py = best_of(lambda: extract_features(doc, lang), args.repeat)
+            t_np = best_of(lambda: extract_features_np(doc, lang), args.repeat)
+            rows.append([os.path.basename(path), size, len(doc),
+                         f"{t_py * 1000:.2f}", f"{t_np * 1000:.2f}", f"{t_py / t_np:.1f}x"])
+
+    print(tabulate(rows, headers=["sample", "x", "tokens", "python ms", "numpy ms", "speedup"]))
+
+
+if __name__ == "__main__":
+    main()
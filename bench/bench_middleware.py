@@ -0,0 +1,108 @@
+# Benchmark: per-request overhead of the rSec signature middleware.
+# Drives the middleware directly over ASGI (no server, no routing) in front of a
+# handler that reads the body and answers 200, and reports the time per request
+# minus the time of the bare handler. Every request carries its own valid
+# signature (distinct user ids) so the replay cache does not reject them.
+# For reference it also times an empty BaseHTTPMiddleware, the old base class.
+#
+# Usage (from the repo root):
+#   python -m bench.bench_middleware
+#   python -m bench.bench_middleware --sizes 0 1024 1048576 --requests 5000
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import time
+
+from starlette.middleware.base import BaseHTTPMiddleware
+from tabulate import tabulate
+
+from backend.middleware import MAX_SIGNED_BODY_BYTES, RSignatureMiddleware
+
+SECRET = "bench"
+CHUNK = 64 * 1024 # body message size, like uvicorn's reads
+
+
+async def handler(scope, receive, send):
+    more = True
+    while more:
+        message = await receive()
+        more = message.get("more_body", False)
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+class EmptyBaseHTTPMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        return await call_next(request)
+
+
+def signed_requests(n, size, path="/analyze"):
+    # (scope, body messages) pairs, each signed for a different user id
+    body = b"x" * size
+    chunks = [body[i:i + CHUNK] for i in range(0, size, CHUNK)] or [b""]
+    ts = str(int(time.time()))
+    requests = []
+    # bodies too large to be signed directly are signed through their SHA-256
+    digest = hashlib.sha256(body).hexdigest() if size > MAX_SIGNED_BODY_BYTES else None
+    for user_id in range(n):
+        signed = digest.encode() if digest else body
+        signature = hmac.new(SECRET.encode(), f"{user_id}.{ts}.POST.{path}.".encode() + signed,
+                             hashlib.sha256).hexdigest()
+        headers = [
+            (b"x-rsec-timestamp", ts.encode()),
+            (b"x-rsec-signature", signature.encode()),
+            (b"x-user-id", str(user_id).encode()),
+        ]
+        if digest:
+            headers.append((b"x-rsec-content-sha256", digest.encode()))
+        scope = {"type": "http", "method": "POST", "path": path, "headers": headers}
+        messages = [{"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1}
+                    for i, chunk in enumerate(chunks)]
+        requests.append((scope, messages))
+    return requests
+
+
+async def run(app, requests):
+    # seconds per request; fails loudly if any request was not answered with 200
+    statuses = []
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            statuses.append(message["status"])
+
+    start = time.perf_counter()
+    for scope, messages in requests:
+        queue = iter(messages)
+
+        async def receive():
+            return next(queue, {"type": "http.disconnect"})
+
+        await app(scope, receive, send)
+    elapsed = time.perf_counter() - start
+    assert statuses == [200] * len(requests), set(statuses)
+    return elapsed / len(requests)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[0, 1024, 64 * 1024, 1024 * 1024],
+                        help="request body sizes in bytes")
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    rows = []
+    for size in args.sizes:
+        n = max(50, args.requests * 1024 // max(size, 1024)) # fewer requests for big bodies
+        bare = asyncio.run(run(handler, signed_requests(n, size)))
+        signed = asyncio.run(run(RSignatureMiddleware(handler, secret_key=SECRET), signed_requests(n, size)))
+        base = asyncio.run(run(EmptyBaseHTTPMiddleware(handler), signed_requests(n, size)))
+        rows.append([size, n, round(bare * 1e6, 1), round((signed - bare) * 1e6, 1),
+                     round((base - bare) * 1e6, 1)])
+    print(tabulate(rows, headers=["body bytes", "requests", "handler µs",
+                                  "rSec overhead µs", "empty BaseHTTPMiddleware µs"]))
+
+
+if __name__ == "__main__":
+    main()
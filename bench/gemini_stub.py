@@ -0,0 +1,60 @@
+# Local stand-in for the Gemini API, for load tests of /analyze without network
+# access or quota. Answers the two REST calls google-genai makes
+# (models/{model}:generateContent and :streamGenerateContent?alt=sse) with a fixed
+# text after GEMINI_STUB_DELAY seconds, so the measured latency is the API's own
+# plus a known, constant generation time.
+#
+# Usage (from the repo root):
+#   GEMINI_STUB_DELAY=0.5 uvicorn bench.gemini_stub:app --port 8090
+#   GEMINI_BASE_URL=http://127.0.0.1:8090 GEMINI_API_KEY=stub uvicorn backend.app:app
+
+import asyncio
+import json
+import os
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+DELAY = float(os.getenv("GEMINI_STUB_DELAY", "0.2")) # seconds per generation
+STREAM_CHUNKS = 8
+calls = 0
+
+
+def _answer(prompt_chars):
+    return f"Stub analysis of a {prompt_chars}-character prompt. " * 4
+
+
+def _response(text):
+    return {
+        "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}],
+        "usageMetadata": {"promptTokenCount": 0, "candidatesTokenCount": 0},
+    }
+
+
+async def generate(request):
+    global calls
+    calls += 1
+    body = await request.json()
+    prompt_chars = sum(len(part.get("text", "")) for content in body.get("contents", [])
+                       for part in content.get("parts", []))
+    text = _answer(prompt_chars)
+    if request.path_params["action"].endswith(":streamGenerateContent"):
+        async def events():
+            step = -(-len(text) // STREAM_CHUNKS)
+            for i in range(0, len(text), step):
+                await asyncio.sleep(DELAY / STREAM_CHUNKS)
+                yield f"data: {json.dumps(_response(text[i:i + step]))}\r\n\r\n"
+        return StreamingResponse(events(), media_type="text/event-stream")
+    await asyncio.sleep(DELAY)
+    return JSONResponse(_response(text))
+
+
+async def stats(request):
+    return JSONResponse({"calls": calls, "delay": DELAY})
+
+
+app = Starlette(routes=[
+    Route("/{version}/models/{action}", generate, methods=["POST"]),
+    Route("/stats", stats),
+])
@@ -0,0 +1,448 @@
+# Benchmark suite for the analysis pipeline and the API.
+#
+#   stages   times each pipeline stage (language routing, spaCy parse, feature
+#            extraction, variance_measures, prompt assembly, DB cache lookup) on the
+#            input/ samples and on synthetic corpora cut from them at 1 KB ... 10 MB
+#   api      starts the API and bench/gemini_stub.py as local servers and load-tests
+#            POST /analyze: a cache-miss phase (unique texts) and a cache-hit phase
+#            (the same texts again), each at a fixed client concurrency
+#   compare  compares two result files
+#
+# Every run writes machine-readable JSON (--output) with latency percentiles,
+# throughput and peak RSS per row; --baseline compares against an earlier file and
+# exits with status 1 if any p50 regressed by more than --tolerance. An api run also
+# exits with status 1 if any request failed.
+# The database is always a scratch file, never the repo's database.db.
+#
+# Usage (from the repo root):
+#   python -m bench.suite stages --output stages.json
+#   python -m bench.suite stages --sizes 1K 100K --baseline stages.json
+#   python -m bench.suite stages --profile lite --baseline stages.json   # lite vs full
+#   python -m bench.suite api --requests 200 --concurrency 16 --output api.json
+#   python -m bench.suite compare api-new.json api.json
+
+import argparse
+import asyncio
+import glob
+import hashlib
+import hmac
+import json
+import math
+import os
+import platform
+import resource
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from collections import Counter
+
+from tabulate import tabulate
+
+from bench.bench_features import SAMPLES, load_pipeline
+
+SIZES = ["1K", "10K", "100K", "1M", "10M"]
+SECRET = "bench"
+
+
+def parse_size(size):
+    units = {"K": 1024, "M": 1024 ** 2}
+    return int(float(size[:-1]) * units[size[-1].upper()]) if size[-1].upper() in units else int(size)
+
+
+def percentile(sorted_values, q):
+    # nearest-rank percentile of an already sorted list
+    return sorted_values[max(0, math.ceil(q * len(sorted_values)) - 1)]
+
+
+def summarize(latencies):
+    # latencies in seconds -> milliseconds summary
+    values = sorted(latencies)
+    return {
+        "runs": len(values),
+        "mean_ms": round(1000 * sum(values) / len(values), 3),
+        "p50_ms": round(1000 * percentile(values, 0.50), 3),
+        "p95_ms": round(1000 * percentile(values, 0.95), 3),
+        "p99_ms": round(1000 * percentile(values, 0.99), 3),
+        "max_ms": round(1000 * values[-1], 3),
+    }
+
+
+def peak_rss_mb():
+    # peak resident set of this process so far (ru_maxrss is in KiB on Linux)
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def process_peak_rss_mb(pid):
+    # VmHWM of another process and its children (parse pool workers), Linux only
+    total = 0
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/status") as f:
+                total += next(int(line.split()[1]) for line in f if line.startswith("VmHWM:"))
+        except (OSError, StopIteration):
+            pass
+    return round(total / 1024, 1) if total else None
+
+
+def metadata(args):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "command": args.command,
+        "args": {k: v for k, v in vars(args).items() if k not in ("command", "func")},
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def measure(fn, repeat, budget):
+    # Latencies of up to repeat calls of fn (at least one; stops once budget seconds
+    # are spent, so 10 MB corpora run once) and the last return value
+    latencies = []
+    result = None
+    while len(latencies) < repeat and sum(latencies) < budget:
+        start = time.perf_counter()
+        result = fn()
+        latencies.append(time.perf_counter() - start)
+    return latencies, result
+
+
+# --- stages -----------------------------------------------------------------
+
+def load_corpora(input_dir, sizes):
+    # [(name, lang, text)]: every known sample as-is, then per language the samples
+    # concatenated and repeated, cut at each size in UTF-8 bytes
+    corpora = []
+    by_lang = {}
+    for path in sorted(glob.glob(os.path.join(input_dir, "*.txt"))):
+        lang = SAMPLES.get(os.path.basename(path))
+        if lang is None:
+            continue
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read().strip()
+        corpora.append((os.path.splitext(os.path.basename(path))[0], lang, text))
+        by_lang.setdefault(lang, []).append(text)
+    for lang, texts in by_lang.items():
+        unit = "\n\n".join(texts).encode("utf-8")
+        for size in sizes:
+            data = (unit + b"\n\n") * (parse_size(size) // (len(unit) + 2) + 1)
+            corpora.append((f"{lang}-{size}", lang, data[:parse_size(size)].decode("utf-8", "ignore")))
+    return corpora
+
+
+def parse_and_extract(text, nlp, lang, profile="full"):
+    # Same work as analyze.text_features, with parse and feature time kept apart:
+    # (parse seconds, feature seconds, TextFeatures, per-sentence/token value lists).
+    # The lists are gathered across chunks because merged long-text features keep
+    # only running statistics, and variance_measures is timed on the full lists.
+    from analyze import FeatureAccumulator, features_from_doc, iter_text_chunks
+    chunks = [text] if len(text) <= nlp.max_length else iter_text_chunks([text])
+    accumulator = FeatureAccumulator(lang, profile)
+    parse_s = features_s = 0.0
+    features = None
+    values = {"sent_lengths": [], "token_lengths": [], "clauses_per_sent": []}
+    for chunk in chunks:
+        start = time.perf_counter()
+        doc = nlp(chunk)
+        parsed = time.perf_counter()
+        features = features_from_doc(doc, lang, profile=profile)
+        accumulator.add(features)
+        features_s += time.perf_counter() - parsed
+        parse_s += parsed - start
+        for name, lst in values.items():
+            lst.extend(getattr(features, name))
+    if len(text) > nlp.max_length:
+        start = time.perf_counter()
+        features = accumulator.result()
+        features_s += time.perf_counter() - start
+    return parse_s, features_s, features, values
+
+
+def fill_database(n):
+    # n filler records so cache lookups probe an index of realistic depth
+    from backend.database.models import engine
+    empty = zlib.compress(b"")
+    with engine.begin() as conn:
+        conn.exec_driver_sql("INSERT OR IGNORE INTO user (id, username) VALUES (1, 'bench')")
+        conn.exec_driver_sql(
+            "INSERT INTO analysisrecord (owner_id, input, output, input_hash, language) VALUES (1, ?, ?, ?, 'en')",
+            [(empty, empty, hashlib.sha256(str(i).encode()).hexdigest()) for i in range(n)])
+
+
+def run_stages(args):
+    os.environ["DATABASE_FILE"] = os.path.join(tempfile.mkdtemp(prefix="bench-"), "bench.db")
+    from analyze import variance_measures, build_prompt
+    from lang_router import route_language
+    from backend import pipeline
+    from backend.cache import text_hash
+    from backend.database.models import create_db_and_tables
+
+    create_db_and_tables()
+    fill_database(args.db_records)
+    overrides = dict(item.split("=", 1) for item in args.model)
+    pipelines = {}
+    rows = []
+    for name, lang, text in load_corpora(args.input_dir, args.sizes):
+        if lang not in pipelines:
+            pipelines[lang] = load_pipeline(lang, overrides, args.profile)
+        nlp = pipelines[lang]
+        size = len(text.encode("utf-8"))
+        timings = {}
+
+        timings["route_language"], _ = measure(lambda: route_language(text), args.repeat, args.budget)
+        runs = [] # parse_and_extract times its two stages itself
+        measure(lambda: runs.append(parse_and_extract(text, nlp, lang, args.profile)), args.repeat, args.budget)
+        timings["parse"] = [run[0] for run in runs]
+        timings["features"] = [run[1] for run in runs]
+        features, values = runs[-1][2:]
+        timings["variance_measures"], _ = measure(
+            lambda: [variance_measures(lst) for lst in values.values()], args.repeat, args.budget)
+        timings["prompt"], _ = measure(lambda: build_prompt(text, features), args.repeat, args.budget)
+
+        input_hash = text_hash(text)
+        cache_key = pipeline.cache_key_for(input_hash, args.profile)
+        pipeline.store_analysis(text, input_hash, cache_key, lang, "bench output", 1, args.profile)
+        timings["db_lookup"], stored = measure(
+            lambda: pipeline.lookup_stored(text, text_hash(text), cache_key, args.profile), args.repeat, args.budget)
+        assert stored is not None
+
+        rss = peak_rss_mb()
+        for stage, latencies in timings.items():
+            row = {"name": f"{name}/{stage}", "corpus": name, "stage": stage, "bytes": size}
+            row.update(summarize(latencies))
+            row["throughput_mb_s"] = round(size / 1024 ** 2 / (row["p50_ms"] / 1000), 3) if row["p50_ms"] else None
+            row["peak_rss_mb"] = rss
+            rows.append(row)
+        print(f"{name}: {size} bytes done (peak RSS {rss} MB)", file=sys.stderr)
+    return rows
+
+
+# --- api --------------------------------------------------------------------
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def sign(method, path, body, user_id):
+    ts = str(int(time.time()))
+    message = f"{user_id}.{ts}.{method}.{path}.".encode() + body
+    signature = hmac.new(SECRET.encode(), message, hashlib.sha256).hexdigest()
+    return {"X-rSec-Timestamp": ts, "X-rSec-Signature": signature, "x-user-id": str(user_id),
+            "content-type": "application/json"}
+
+
+def seed_users(database, n):
+    # Users 1..n in the server's scratch database (created at its startup); /analyze
+    # only accepts requests of existing users
+    with sqlite3.connect(database, timeout=30) as conn:
+        conn.executemany("INSERT OR IGNORE INTO user (id, username) VALUES (?, ?)",
+                         [(i, f"bench{i}") for i in range(1, n + 1)])
+
+
+def start_server(cmd, env, port, ready_path, timeout):
+    process = subprocess.Popen(cmd, env=env)
+    import httpx
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"server exited: {' '.join(cmd)}")
+        try:
+            headers = sign("GET", ready_path, b"", 0)
+            if httpx.get(f"http://127.0.0.1:{port}{ready_path}", headers=headers, timeout=1).status_code < 500:
+                return process
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise SystemExit(f"server did not come up within {timeout}s: {' '.join(cmd)}")
+
+
+async def load_phase(url, texts, concurrency, first_user_id):
+    # Sends every text once; (latencies, failures, wall seconds) where failures counts
+    # the failed requests by status code / error message. Every request is signed for
+    # its own user id, so repeated texts are never taken for replays.
+    import httpx
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = Counter()
+
+    async def one(client, i, text):
+        body = json.dumps({"text": text}).encode()
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await client.post(url, content=body, headers=sign("POST", "/analyze", body, first_user_id + i))
+                if response.status_code != 200:
+                    failures[str(response.status_code)] += 1
+                elif "error" in response.json():
+                    failures[response.json()["error"][:80]] += 1
+            except httpx.HTTPError as e:
+                failures[type(e).__name__] += 1
+            latencies.append(time.perf_counter() - start)
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(timeout=300, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(one(client, i, text) for i, text in enumerate(texts)))
+        return latencies, failures, time.perf_counter() - start
+
+
+def run_api(args):
+    import httpx
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    stub_port, api_port = free_port(), free_port()
+    env = dict(os.environ,
+               DATABASE_FILE=os.path.join(workdir, "bench.db"),
+               GEMINI_BASE_URL=f"http://127.0.0.1:{stub_port}",
+               GEMINI_API_KEY="stub",
+               GEMINI_STUB_DELAY=str(args.gemini_delay),
+               RSEC_SECRET_KEY=SECRET,
+               RATE_LIMIT="false") # the load test must not be throttled (backend/ratelimit.py)
+    uvicorn = [sys.executable, "-m", "uvicorn", "--host", "127.0.0.1", "--log-level", "warning"]
+    stub = start_server(uvicorn + ["bench.gemini_stub:app", "--port", str(stub_port)],
+                        env, stub_port, "/stats", 30)
+    server = None
+    try:
+        server = start_server(uvicorn + [args.app, "--port", str(api_port)], env, api_port, "/", args.startup_timeout)
+        seed_users(env["DATABASE_FILE"], 2 * args.requests) # one per request of each phase
+        samples = [text for _, _, text in load_corpora(args.input_dir, [])]
+        texts = [f"Request {i}. " + samples[i % len(samples)] * args.scale for i in range(args.requests)]
+        url = f"http://127.0.0.1:{api_port}/analyze"
+        rows = []
+        for phase, first_user_id in (("miss", 1), ("hit", 1 + args.requests)):
+            calls_before = httpx.get(f"http://127.0.0.1:{stub_port}/stats").json()["calls"]
+            latencies, failures, wall = asyncio.run(load_phase(url, texts, args.concurrency, first_user_id))
+            calls = httpx.get(f"http://127.0.0.1:{stub_port}/stats").json()["calls"] - calls_before
+            row = {"name": f"api/analyze-{phase}", "phase": phase, "requests": len(texts),
+                   "concurrency": args.concurrency, "errors": sum(failures.values()),
+                   "failures": dict(failures), "gemini_calls": calls}
+            row.update(summarize(latencies))
+            row["throughput_rps"] = round(len(texts) / wall, 2)
+            row["server_peak_rss_mb"] = process_peak_rss_mb(server.pid)
+            rows.append(row)
+            print(f"{phase}: {len(texts)} requests in {wall:.1f}s", file=sys.stderr)
+        return rows
+    finally:
+        for process in (server, stub):
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+
+# --- reporting --------------------------------------------------------------
+
+def print_rows(rows):
+    columns = ["name", "runs", "p50_ms", "p95_ms", "p99_ms", "throughput_mb_s", "throughput_rps",
+               "errors", "peak_rss_mb", "server_peak_rss_mb"]
+    columns = [c for c in columns if any(c in row for row in rows)]
+    print(tabulate([[row.get(c, "") for c in columns] for row in rows], headers=columns))
+
+
+def compare(rows, baseline_rows, tolerance):
+    # Prints p50/p95 changes against the baseline; returns the names that regressed
+    baseline = {row["name"]: row for row in baseline_rows}
+    table = []
+    regressed = []
+    for row in rows:
+        old = baseline.get(row["name"])
+        if old is None or not old["p50_ms"]:
+            continue
+        change = row["p50_ms"] / old["p50_ms"] - 1
+        status = "REGRESSED" if change > tolerance else ("improved" if change < -tolerance else "")
+        if status == "REGRESSED":
+            regressed.append(row["name"])
+        table.append([row["name"], old["p50_ms"], row["p50_ms"], f"{change:+.1%}",
+                      old["p95_ms"], row["p95_ms"], status])
+    print(tabulate(table, headers=["name", "base p50", "p50", "change", "base p95", "p95", ""]))
+    return regressed
+
+
+def finish(args, rows):
+    report = {"meta": metadata(args), "results": rows}
+    print_rows(rows)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    failed = [row["name"] for row in rows if row.get("errors")]
+    if failed: # timings of error responses are not comparable
+        print(f"\nrequests failed in: {', '.join(failed)}", file=sys.stderr)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        print()
+        if compare(rows, baseline, args.tolerance):
+            sys.exit(1)
+    if failed:
+        sys.exit(1)
+
+
+def run_compare(args):
+    with open(args.results, "r", encoding="utf-8") as f:
+        rows = json.load(f)["results"]
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    if compare(rows, baseline, args.tolerance):
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark suite for the analysis pipeline and API")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def common(sub):
+        sub.add_argument("--input-dir", default="input")
+        sub.add_argument("--output", help="write JSON results here")
+        sub.add_argument("--baseline", help="JSON results to compare against")
+        sub.add_argument("--tolerance", type=float, default=0.10, help="allowed p50 slowdown (0.10 = 10%%)")
+
+    stages = commands.add_parser("stages", help="per-stage timings on samples and synthetic corpora")
+    common(stages)
+    stages.add_argument("--sizes", nargs="*", default=SIZES, help="synthetic corpus sizes (bytes, K, M)")
+    stages.add_argument("--repeat", type=int, default=5)
+    stages.add_argument("--budget", type=float, default=5.0, help="max seconds of repeats per stage")
+    stages.add_argument("--db-records", type=int, default=10_000, help="filler records in the scratch DB")
+    stages.add_argument("--model", action="append", default=[],
+                        help="lang=name_or_path to override a registry pipeline")
+    stages.add_argument("--profile", default="full", choices=["full", "lite"], help="feature profile to parse with")
+    stages.set_defaults(func=lambda args: finish(args, run_stages(args)))
+
+    api = commands.add_parser("api", help="load test POST /analyze against a Gemini stub")
+    common(api)
+    api.add_argument("--requests", type=int, default=100, help="requests per phase")
+    api.add_argument("--concurrency", type=int, default=8)
+    api.add_argument("--scale", type=int, default=1, help="repeat each sample this many times per text")
+    api.add_argument("--gemini-delay", type=float, default=0.2, help="stub generation time in seconds")
+    api.add_argument("--app", default="backend.app:app", help="ASGI app to serve")
+    api.add_argument("--startup-timeout", type=float, default=120)
+    api.set_defaults(func=lambda args: finish(args, run_api(args)))
+
+    comparison = commands.add_parser("compare", help="compare two result files")
+    comparison.add_argument("results")
+    comparison.add_argument("baseline")
+    comparison.add_argument("--tolerance", type=float, default=0.10)
+    comparison.set_defaults(func=run_compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+# Gunicorn settings for multi-worker deployments.
+# Usage: gunicorn backend.app:app -c gunicorn.conf.py
+# The app (and the spaCy pipelines) are loaded once in the master process and
+# shared copy-on-write by the forked uvicorn workers.
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "1")) # each has its own parse pool of CPUs / workers processes
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True # import backend.app in the master before forking
+
+
+def on_starting(server):
+    # Runs in the master after the app is imported and before any worker is forked
+    from backend.nlp_registry import preload, freeze_for_fork
+    preload()
+    freeze_for_fork()
+
+
+def child_exit(server, worker):
+    # With PROMETHEUS_MULTIPROC_DIR set, /metrics sums every worker's files; drop the
+    # live gauges of a worker that is gone
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,112 @@
+# Language routing for the analyzer.
+# Only two pipelines exist (en, zh-cn), so most texts can be routed by the script
+# they are written in: a bounded sample is taken from the start, middle and end of
+# the text and its letters are counted per Unicode script. Han-dominant text goes
+# to zh-cn, Latin text that reads as English goes to en. Only when the counts are
+# ambiguous (other Latin-script languages, mixed scripts, no letters) does the
+# statistical detector (langdetect) run, on the same sample and with a fixed seed.
+# The cost is therefore bounded regardless of text length, and the same text always
+# routes the same way (the result feeds cache keys).
+#
+# Codes follow langdetect's ("en", "zh-cn", "ja", ...); "unknown" if nothing fits.
+
+import re
+
+SAMPLE_CHARS = 1024 # per slice; long texts are sampled at start, middle and end
+LANGDETECT_SEED = 0
+
+LETTER_RE = re.compile(r"[^\W\d_]")
+HAN_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\U00020000-\U0002ffff]")
+KANA_RE = re.compile(r"[\u3040-\u30ff\u31f0-\u31ff\uff66-\uff9f]")
+HANGUL_RE = re.compile(r"[\u1100-\u11ff\u3130-\u318f\uac00-\ud7af]")
+ASCII_LETTER_RE = re.compile(r"[A-Za-z]")
+LATIN_EXTENDED_RE = re.compile(r"[\u00c0-\u00d6\u00d8-\u00f6\u00f8-\u024f\u1e00-\u1eff]")
+WORD_RE = re.compile(r"[a-z]+(?:'[a-z]+)?")
+
+# Frequent English function words that are rare as words in other Latin-script languages
+ENGLISH_WORDS = frozenset("""
+the and of to is was that it with for as he she his her you they this have had
+be are were not but at by from which would there their what when been has
+who will can could them him we my your our or if an its into than then
+""".split())
+
+HAN_SHARE = 0.5 # of letters; each Han character counts as one letter
+KANA_SHARE = 0.05
+HANGUL_SHARE = 0.3
+LATIN_SHARE = 0.9
+ENGLISH_WORD_SHARE = 0.2 # of words in the sample
+NON_ENGLISH_LETTER_SHARE = 0.02 # accented Latin letters tolerated in English text
+
+
+def sample_text(text, size=SAMPLE_CHARS):
+    # At most 3 * size characters: the whole text if short, else start + middle + end
+    if len(text) <= 3 * size:
+        return text
+    middle = (len(text) - size) // 2
+    return "\n".join((text[:size], text[middle:middle + size], text[-size:]))
+
+
+def script_counts(sample):
+    return {
+        "letters": len(LETTER_RE.findall(sample)),
+        "han": len(HAN_RE.findall(sample)),
+        "kana": len(KANA_RE.findall(sample)),
+        "hangul": len(HANGUL_RE.findall(sample)),
+        "latin": len(ASCII_LETTER_RE.findall(sample)) + len(LATIN_EXTENDED_RE.findall(sample)),
+        "latin_extended": len(LATIN_EXTENDED_RE.findall(sample)),
+    }
+
+
+def _reads_as_english(sample, counts):
+    if counts["latin_extended"] > NON_ENGLISH_LETTER_SHARE * counts["latin"]:
+        return False
+    words = WORD_RE.findall(sample.lower())
+    if not words:
+        return False
+    return sum(word in ENGLISH_WORDS for word in words) >= ENGLISH_WORD_SHARE * len(words)
+
+
+def route_by_script(sample):
+    # Language code decided from script counts alone, or None if ambiguous
+    counts = script_counts(sample)
+    letters = counts["letters"]
+    if not letters:
+        return None
+    if counts["kana"] >= KANA_SHARE * letters:
+        return "ja"
+    if counts["hangul"] >= HANGUL_SHARE * letters:
+        return "ko"
+    if counts["han"] >= HAN_SHARE * letters:
+        return "zh-cn"
+    if counts["latin"] >= LATIN_SHARE * letters and _reads_as_english(sample, counts):
+        return "en"
+    return None
+
+
+def _factory():
+    from langdetect import detector_factory # profiles are loaded on first use
+    detector_factory.init_factory()
+    return detector_factory._factory
+
+
+def detect_statistical(sample):
+    # Seeded langdetect on the (already bounded) sample; "unknown" if it finds no features
+    from langdetect import LangDetectException
+    detector = _factory().create()
+    detector.seed = LANGDETECT_SEED
+    detector.set_max_text_length(len(sample))
+    detector.append(sample)
+    try:
+        return detector.detect()
+    except LangDetectException:
+        return "unknown"
+
+
+def route_language(text):
+    sample = sample_text(text)
+    return route_by_script(sample) or detect_statistical(sample)
+
+
+def warm_up():
+    # langdetect's profile load is not thread-safe; do it once before threads detect
+    _factory()
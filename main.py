@@ -1,39 +1,272 @@
-import spacy
-from spacy.lang.zh.examples import sentences
-from spacy import displacy
-from collections import Counter
-from textblob import TextBlob
-from analyze import text_analyze_eng, text_analyze_chn
+# Corpus command line: analyzes many documents offline, without the HTTP API.
+#
+# Documents come from a directory (every *.txt below it, id = relative path), a
+# single text file, or a JSONL file / stdin ("-") with one {"id": ..., "text": ...}
+# object per line (id defaults to the line number). Each document is routed to a
+# language and parsed in a pool of worker processes; the parent writes one JSON line
+# per document to the output, in completion order:
+#   {"id", "language", "profile", "chars", "features", "analysis"?}  or  {"id", "error"}
+#
+# The Gemini analysis is generated as well unless --no-llm is given (at most
+# --llm-concurrency calls at a time). Documents whose LLM call fails are not written,
+# so a later run retries them; neither are the documents being parsed when a worker
+# process dies (the pool is restarted for the rest). A document whose parse raises
+# gets an {"id", "error"} line. The exit status is 1 if any document failed.
+#
+# Resuming: every written document is recorded in the checkpoint file (default
+# OUTPUT.checkpoint) together with the output size after it. A rerun with the same
+# output skips the recorded documents and first truncates the output to the last
+# recorded size, dropping any line that was cut off when the previous run stopped.
+#
+# Usage:
+#   python main.py input/ -o features.jsonl
+#   python main.py corpus.jsonl -o features.jsonl --no-llm --workers 8 --profile lite
+#   cat corpus.jsonl | python main.py - -o features.jsonl --no-llm
 
-from langdetect import detect
-
-from google import genai
+import argparse
+import asyncio
+import json
+import multiprocessing
 import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from dotenv import load_dotenv
+
+from analyze import build_prompt, text_features, DEFAULT_PROFILE, PROFILES
+from backend import llm, nlp_registry
+from lang_router import route_language
+
+
+class CheckpointError(Exception):
+    pass
+
+
+# --- input ------------------------------------------------------------------
+
+def iter_directory(root):
+    # (id, path, None) for every .txt file below root, in a stable order
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith(".txt"):
+                path = os.path.join(dirpath, filename)
+                yield os.path.relpath(path, root), path, None
+
+
+def iter_jsonl(stream):
+    # (id, None, text) per line; blank lines are skipped, malformed ones reported
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+            text = item["text"]
+        except (ValueError, KeyError, TypeError):
+            print(f"line {line_number}: expected an object with a 'text' field, skipped", file=sys.stderr)
+            continue
+        yield str(item.get("id", line_number)), None, text
+
+
+def iter_documents(source):
+    if source == "-":
+        yield from iter_jsonl(sys.stdin)
+    elif os.path.isdir(source):
+        yield from iter_directory(source)
+    elif source.endswith(".jsonl"):
+        with open(source, "r", encoding="utf-8") as f:
+            yield from iter_jsonl(f)
+    else:
+        yield os.path.basename(source), source, None
+
+
+# --- parsing (runs in the worker processes) ---------------------------------
+
+def analyze_document(doc_id, path, text, profile, with_prompt):
+    # (output record, prompt or None). Files are read here, not in the parent, so
+    # document bodies are never shipped through the pool's pipes twice.
+    if path is not None:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            text = f.read()
+    if not text.strip():
+        return {"id": doc_id, "error": "No text provided."}, None
+    lang = route_language(text)
+    if not nlp_registry.is_supported(lang):
+        return {"id": doc_id, "error": f"Unsupported language detected: {lang}"}, None
+    features = text_features(text, nlp_registry.get_nlp(lang, profile), lang, profile=profile)
+    record = {"id": doc_id, "language": lang, "profile": profile, "chars": len(text),
+              "features": features.summary()}
+    return record, build_prompt(text, features) if with_prompt else None
+
+
+# --- output and checkpoint --------------------------------------------------
+
+class Checkpoint:
+    # Append-only log of {"id", "offset"}: the document ids already in the output and
+    # the output size right after each one was written.
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self.offset = 0
+        self.size = 0 # bytes of complete entries; a line cut off by an interruption is dropped
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                entry = json.loads(line)
+                self.done.add(entry["id"])
+                self.offset = entry["offset"]
+                self.size += len(line)
+
+    def open(self):
+        self.file = open(self.path, "a+", encoding="utf-8")
+        self.file.truncate(self.size)
+
+    def record(self, doc_id, offset):
+        self.file.write(json.dumps({"id": doc_id, "offset": offset}, ensure_ascii=False) + "\n")
+        self.file.flush()
+        self.done.add(doc_id)
+
+    def close(self):
+        self.file.close()
+
+
+def open_output(path, checkpoint):
+    # Output file positioned after the last checkpointed document
+    if checkpoint.offset:
+        if not os.path.exists(path) or os.path.getsize(path) < checkpoint.offset:
+            raise CheckpointError(f"{path} is shorter than its checkpoint {checkpoint.path}; "
+                                  f"remove the checkpoint (or pass --restart) to start over")
+        output = open(path, "r+b")
+        output.truncate(checkpoint.offset)
+        output.seek(checkpoint.offset)
+        return output
+    return open(path, "wb")
+
+
+# --- driver -----------------------------------------------------------------
+
+async def run(args):
+    checkpoint = Checkpoint(args.checkpoint or args.output + ".checkpoint")
+    if args.restart and os.path.exists(checkpoint.path):
+        os.remove(checkpoint.path)
+    checkpoint.load()
+    output = open_output(args.output, checkpoint)
+    checkpoint.open()
+
+    with_llm = not args.no_llm
+    llm.LLM_MAX_IN_FLIGHT = args.llm_concurrency # llm.generate's own semaphore caps the calls
+    # Pipelines are loaded once here and shared copy-on-write by the forked workers
+    nlp_registry.preload(profiles=[args.profile])
+    nlp_registry.freeze_for_fork()
+    def new_executor():
+        return ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("fork"))
+
+    pool = {"executor": new_executor()}
+    # Bounds the documents in progress (parsing or waiting for Gemini), and so memory
+    slots = asyncio.Semaphore(args.workers * 4 + (args.llm_concurrency if with_llm else 0))
+    loop = asyncio.get_running_loop()
+    counts = {"written": 0, "errors": 0, "skipped": 0, "llm_failed": 0, "crashed": 0}
+    fatal = [] # unexpected exceptions (e.g. the output cannot be written): the run stops
+
+    def write(record):
+        output.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+        output.flush()
+        checkpoint.record(record["id"], output.tell())
+        counts["errors" if "error" in record else "written"] += 1
+
+    async def process(doc_id, path, text):
+        executor = pool["executor"]
+        try:
+            try:
+                record, prompt = await loop.run_in_executor(
+                    executor, analyze_document, doc_id, path, text, args.profile, with_llm)
+            except BrokenProcessPool:
+                # a worker died (e.g. killed for memory) and took every document it was
+                # given with it; the first of them to get here replaces the pool
+                counts["crashed"] += 1
+                print(f"{doc_id}: parser process died, not written", file=sys.stderr)
+                if pool["executor"] is executor:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    pool["executor"] = new_executor()
+                return
+            except Exception as e: # raised while parsing this document
+                record, prompt = {"id": doc_id, "error": f"Analysis failed: {type(e).__name__}: {e}"}, None
+            if prompt is not None:
+                try:
+                    record["analysis"] = await llm.generate(prompt)
+                except llm.LLMError as e:
+                    counts["llm_failed"] += 1
+                    print(f"{doc_id}: AI generation failed: {e}", file=sys.stderr)
+                    return
+            write(record)
+        finally:
+            slots.release()
+
+    def finished(task):
+        tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            fatal.append(task.exception())
 
-api_key = os.getenv("GEMINI_API_KEY")
-client = genai.Client(api_key=api_key)
+    started = time.perf_counter()
+    tasks = set()
+    try:
+        for doc_id, path, text in iter_documents(args.source):
+            if doc_id in checkpoint.done:
+                counts["skipped"] += 1
+                continue
+            await slots.acquire()
+            if fatal:
+                break
+            task = asyncio.create_task(process(doc_id, path, text))
+            tasks.add(task)
+            task.add_done_callback(finished)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        if fatal:
+            raise fatal[0]
+        pool["executor"].shutdown() # idle by now; waiting lets the workers exit cleanly
+    finally:
+        pool["executor"].shutdown(wait=False, cancel_futures=True)
+        output.close()
+        checkpoint.close()
+    elapsed = time.perf_counter() - started
+    print(f"{counts['written']} analyzed, {counts['errors']} errors, {counts['llm_failed']} LLM failures, "
+          f"{counts['crashed']} lost to crashed workers, {counts['skipped']} already done ({elapsed:.1f}s)",
+          file=sys.stderr)
+    return 1 if counts["errors"] or counts["llm_failed"] or counts["crashed"] else 0
 
 
 def main():
-    input_filename = 'borges_chinese_sample.txt'
-    # connecting to Gemini
-    with open("input/"+input_filename, "r", encoding="utf-8") as f:
-        input_text = f.read()
-    lang = detect(input_text)
-    print(lang)
-    if lang and lang == 'en':
-        # nlp = spacy.load("en_core_web_md")
-        prompt = text_analyze_eng(input_text)
-    elif lang and lang == 'zh-cn':
-       #  nlp = spacy.load("zh_core_web_sm")
-        prompt = text_analyze_chn(input_text) + "\nThe text is a Chinese text and your audience are native Chinese speakers. Therefore, analyze it using Chinese."
-    
-    # print(prompt)
-    
-    response = client.models.generate_content(
-    model="gemini-2.5-flash", contents=prompt)
-    print(f"\n------------- \n{response.text}")
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Analyze a corpus of texts into a JSONL file of features.")
+    parser.add_argument("source", help="directory of .txt files, a .txt or .jsonl file, or - for JSONL on stdin")
+    parser.add_argument("-o", "--output", required=True, help="JSONL file to write")
+    parser.add_argument("--checkpoint", help="checkpoint file (default: OUTPUT.checkpoint)")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and overwrite the output")
+    parser.add_argument("--no-llm", action="store_true", help="features only, skip the Gemini analysis")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="parser processes")
+    parser.add_argument("--llm-concurrency", type=int, default=4, help="Gemini calls in flight at once")
+    parser.add_argument("--profile", default=DEFAULT_PROFILE, choices=PROFILES, help="feature profile")
+    args = parser.parse_args()
+    args.workers = max(1, args.workers)
+    args.llm_concurrency = max(1, args.llm_concurrency)
+    try:
+        return asyncio.run(run(args))
+    except CheckpointError as e:
+        print(e, file=sys.stderr)
+        return 2
+    except KeyboardInterrupt:
+        print("interrupted; rerun the same command to resume", file=sys.stderr)
+        return 130
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,195 @@
+# Prompt templates for the Gemini analysis.
+# Templates live in prompts/ (resolved next to this file, not the working directory)
+# and are selected per language and template version (PROMPT_VERSION). Each one is
+# read and validated once - every {placeholder} must be a known field and a trial
+# render must succeed - and read again only when its file changes on disk. A reload
+# that fails validation keeps serving the previous text.
+#
+# Features are rendered compactly: frequency tables become "NOUN 24%, VERB 15%, ..."
+# limited to their top-k entries, morphology becomes counts of the most common
+# features, and numbers are rounded. Metrics a feature profile skipped (the dependency
+# ones under "lite") render as "n/a". If the estimated prompt size exceeds
+# PROMPT_TOKEN_BUDGET the top-k limits are halved until it fits.
+#
+# version() hashes the selected templates together with the encoding settings; it is
+# part of the analysis cache key, so any change to either re-generates analyses.
+
+import hashlib
+import logging
+import os
+import string
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+PROMPT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts")
+
+# (language, version) -> template file
+TEMPLATES = {
+    ("en", "v1"): "prompt_template_old1.txt",
+    ("en", "v2"): "prompt_template.txt",
+    ("zh-cn", "v1"): "prompt_template_Chn_old1.txt",
+    ("zh-cn", "v2"): "prompt_template_Chn.txt",
+}
+DEFAULT_LANGUAGE = "en" # template used for languages without their own
+PROMPT_VERSION = os.getenv("PROMPT_VERSION", "v2")
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "1000"))
+
+ENCODING_VERSION = 1 # bump when the rendering below changes
+TOP_K = {"pos_freq": 10, "dep_freq": 12, "verb_tense_freq": 6, "lemma_freq": 8, "morphs_sample": 8}
+MIN_TOP_K = 2
+
+NUMERIC_FIELDS = [f"{stat}_{measure}" for stat in ("avg", "std", "range", "osc")
+                  for measure in ("sentence_length", "token_length", "clauses_per_sentence")]
+TEXT_FIELDS = ["text_excerpt", "pos_freq", "dep_freq", "verb_tense_freq", "lemma_freq", "morphs_sample"]
+FIELDS = frozenset(NUMERIC_FIELDS + TEXT_FIELDS)
+
+
+class PromptTemplateError(ValueError):
+    pass
+
+
+def estimate_tokens(text):
+    # Rough Gemini token count: ~4 characters per token, one per CJK character
+    wide = sum(1 for ch in text if ord(ch) > 0x2E7F)
+    return wide + (len(text) - wide + 3) // 4
+
+
+def _shares(counter, k):
+    # "KEY 24%, KEY 15%, ... +N more" for the k most common keys
+    total = sum(counter.values())
+    if not total:
+        return "none"
+    parts = [f"{key} {100 * count / total:.0f}%" for key, count in counter.most_common(k)]
+    if len(counter) > k:
+        parts.append(f"+{len(counter) - k} more")
+    return ", ".join(parts)
+
+
+def _counts(counter, k):
+    parts = [f"{key}×{count}" for key, count in counter.most_common(k)]
+    return ", ".join(parts) or "none"
+
+
+class _NotComputed:
+    # "n/a" whatever the placeholder's format spec (e.g. {osc_clauses_per_sentence:.1%})
+    def __format__(self, spec):
+        return "n/a"
+
+
+NOT_COMPUTED = _NotComputed()
+
+
+def _morph_counts(morphs_sample):
+    counter = Counter()
+    for sentence in morphs_sample:
+        for token_features in sentence:
+            counter.update(token_features)
+    return counter
+
+
+def encode_features(features, top_k=TOP_K, text=""):
+    # Template fields for a TextFeatures
+    values = {"text_excerpt": text[:500]}
+    for measure, variance in (("sentence_length", features.sent_length_variance),
+                              ("token_length", features.token_length_variance),
+                              ("clauses_per_sentence", features.clause_freq_variance)):
+        values[f"avg_{measure}"] = round(variance['average'], 1)
+        values[f"std_{measure}"] = round(variance['stdev'], 1)
+        values[f"range_{measure}"] = variance['range']
+        values[f"osc_{measure}"] = variance['oscillation_ratio']
+    values["pos_freq"] = _shares(features.pos_freq, top_k["pos_freq"])
+    values["dep_freq"] = _shares(features.dep_freq, top_k["dep_freq"])
+    if not features.has_dependencies():
+        for stat in ("avg", "std", "range", "osc"):
+            values[f"{stat}_clauses_per_sentence"] = NOT_COMPUTED
+        values["dep_freq"] = NOT_COMPUTED
+    values["verb_tense_freq"] = _shares(features.verb_tense_freq, top_k["verb_tense_freq"])
+    values["lemma_freq"] = _counts(features.lemma_freq, top_k["lemma_freq"])
+    values["morphs_sample"] = _counts(_morph_counts(features.morphs_sample), top_k["morphs_sample"])
+    return values
+
+
+class PromptTemplate:
+    def __init__(self, path):
+        self.path = path
+        self.text = None
+        self.digest = None
+        self.mtime = None
+
+    def refresh(self):
+        # Re-reads the file if it changed; raises PromptTemplateError if it never loaded
+        try:
+            mtime = os.path.getmtime(self.path)
+            if mtime == self.mtime:
+                return
+            with open(self.path, "r", encoding="utf-8") as file:
+                text = file.read()
+            validate(text, self.path)
+        except (OSError, PromptTemplateError) as e:
+            if self.text is None:
+                raise PromptTemplateError(str(e)) from e
+            logger.error("Keeping the previous prompt template: %s", e)
+            return
+        self.text = text
+        self.digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        self.mtime = mtime
+
+    def render(self, values):
+        return self.text.format(**values)
+
+
+def validate(text, name):
+    try:
+        fields = {field for _, field, _, _ in string.Formatter().parse(text) if field is not None}
+    except ValueError as e:
+        raise PromptTemplateError(f"{name}: {e}")
+    unknown = fields - FIELDS
+    if unknown:
+        raise PromptTemplateError(f"{name}: unknown placeholders {sorted(unknown)}")
+    trial = {field: 0.0 for field in NUMERIC_FIELDS}
+    trial.update({field: "" for field in TEXT_FIELDS})
+    try:
+        text.format(**trial)
+    except (ValueError, IndexError, KeyError) as e:
+        raise PromptTemplateError(f"{name}: {e!r}")
+
+
+class PromptRegistry:
+    def __init__(self, directory=PROMPT_DIR, templates=TEMPLATES, version=PROMPT_VERSION,
+                 token_budget=PROMPT_TOKEN_BUDGET):
+        self.version_name = version
+        self.token_budget = token_budget
+        self._templates = {lang: PromptTemplate(os.path.join(directory, filename))
+                           for (lang, name), filename in templates.items() if name == version}
+        if DEFAULT_LANGUAGE not in self._templates:
+            raise PromptTemplateError(f"no {DEFAULT_LANGUAGE} prompt template for version {version}")
+        self._lock = threading.Lock()
+
+    def get(self, lang):
+        template = self._templates.get(lang) or self._templates[DEFAULT_LANGUAGE]
+        with self._lock:
+            template.refresh()
+        return template
+
+    def version(self):
+        # Short hash of the selected templates and the encoding settings
+        digest = hashlib.sha256()
+        for lang in sorted(self._templates):
+            digest.update(f"{lang}:{self.get(lang).digest}\n".encode())
+        digest.update(f"{self.version_name}:{ENCODING_VERSION}:{self.token_budget}:{sorted(TOP_K.items())}".encode())
+        return digest.hexdigest()[:12]
+
+    def render(self, features, text=""):
+        # Prompt for a TextFeatures, in the template of its language, within the token budget
+        template = self.get(features.language)
+        top_k = dict(TOP_K)
+        while True:
+            prompt = template.render(encode_features(features, top_k, text))
+            if estimate_tokens(prompt) <= self.token_budget or all(k <= MIN_TOP_K for k in top_k.values()):
+                return prompt
+            top_k = {name: max(MIN_TOP_K, k // 2) for name, k in top_k.items()}
+
+
+registry = PromptRegistry()